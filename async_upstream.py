@@ -0,0 +1,173 @@
+import asyncio
+import concurrent.futures
+import importlib.util
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from loguru import logger
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# 按优先顺序尝试的异步HTTP库
+ASYNC_BACKENDS = ("aiohttp", "httpx")
+
+
+def resolve_backend(name: str) -> Optional[str]:
+    """解析 upstream_client 配置：auto 选择已安装的第一个异步库，都未安装时返回None（使用 requests）"""
+    if name == "requests":
+        return None
+    if name == "auto":
+        return next((backend for backend in ASYNC_BACKENDS if importlib.util.find_spec(backend)), None)
+    if name not in ASYNC_BACKENDS:
+        raise ValueError(f"不支持的 upstream_client: {name}，可选 auto / requests / {' / '.join(ASYNC_BACKENDS)}")
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(f"upstream_client 设为 {name} 需要安装 {name} 包：pip install {name}")
+    return name
+
+
+def _build_response(url: str, status: int, reason: str, headers: Any, content: bytes) -> requests.Response:
+    """把异步库的响应转换为 requests.Response，调用方按原来的方式读取状态码和内容"""
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response.encoding = get_encoding_from_headers(response.headers)
+    return response
+
+
+def _proxy_url(proxies: Optional[Dict[str, str]], url: str) -> Optional[str]:
+    """从 requests 风格的 proxies 中取出目标地址对应的代理"""
+    if not proxies:
+        return None
+    return proxies.get("https" if url.startswith("https") else "http") or proxies.get("all")
+
+
+class AsyncUpstreamClient:
+    """在专用事件循环线程上执行上游HTTP请求
+
+    所有请求共享一个连接池（最多 max_connections 个连接），等待响应不占用额外线程，
+    数百个请求同时进行时也只有一个事件循环线程在处理网络读写。post() 是同步桥接：
+    参数与 requests.post 一致（headers/params/json/proxies/timeout），返回 requests.Response，
+    超时和连接错误转换为 requests 的异常类型，调用方的错误处理无需修改。
+    abort_check 抛出异常时（命令被取消或超过截止时间）立即取消正在进行的请求并关闭连接。
+    """
+
+    def __init__(self, backend: str, max_connections: int = 100, poll_interval: float = 0.2):
+        self.backend = backend
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.in_flight = 0
+        self._clients: Dict[Optional[str], Any] = {}  # 代理地址 -> 客户端（httpx 的代理按客户端配置）
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name=f"gemini-{backend}-loop", daemon=True)
+        self._thread.start()
+        if backend == "aiohttp":
+            import aiohttp
+            self._aiohttp = aiohttp
+        else:
+            import httpx
+            self._httpx = httpx
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def _client(self, proxy: Optional[str]) -> Any:
+        # 只在事件循环线程中调用，不需要加锁
+        client = self._clients.get(proxy)
+        if client is None:
+            if self.backend == "aiohttp":
+                # aiohttp 的代理按请求指定，所有请求共用一个会话
+                client = self._clients.get(None)
+                if client is None:
+                    connector = self._aiohttp.TCPConnector(limit=self.max_connections)
+                    client = self._clients[None] = self._aiohttp.ClientSession(connector=connector, trust_env=True)
+                return client
+            limits = self._httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            client = self._clients[proxy] = self._httpx.AsyncClient(limits=limits, proxy=proxy, trust_env=True)
+        return client
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None, params: Optional[Dict[str, Any]] = None,
+                      json: Any = None, proxies: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> requests.Response:
+        """在事件循环中发送请求；timeout 与 requests 相同，分别作用于连接和每次读取"""
+        proxy = _proxy_url(proxies, url)
+        self.in_flight += 1
+        try:
+            if self.backend == "aiohttp":
+                return await self._aiohttp_request(method, url, headers, params, json, proxy, timeout)
+            return await self._httpx_request(method, url, headers, params, json, proxy, timeout)
+        finally:
+            self.in_flight -= 1
+
+    async def _aiohttp_request(self, method, url, headers, params, json, proxy, timeout) -> requests.Response:
+        aiohttp = self._aiohttp
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        try:
+            async with self._client(proxy).request(method, url, headers=headers, params=params, json=json,
+                                                   proxy=proxy, timeout=client_timeout) as response:
+                content = await response.read()
+                return _build_response(str(response.url), response.status, response.reason or "", response.headers, content)
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout(f"请求超时: {url}") from e
+        except aiohttp.ClientConnectionError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    async def _httpx_request(self, method, url, headers, params, json, proxy, timeout) -> requests.Response:
+        httpx = self._httpx
+        try:
+            response = await self._client(proxy).request(method, url, headers=headers, params=params, json=json,
+                                                          timeout=httpx.Timeout(timeout))
+            return _build_response(str(response.url), response.status_code, response.reason_phrase, response.headers, response.content)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(f"请求超时: {url}") from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    def submit(self, method: str, url: str, **kwargs) -> concurrent.futures.Future:
+        """提交请求，立即返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(self.request(method, url, **kwargs), self._loop)
+
+    def post(self, url: str, abort_check: Optional[Callable[[], None]] = None, **kwargs) -> requests.Response:
+        """同步桥接：等待请求完成，期间按 poll_interval 调用 abort_check"""
+        future = self.submit("POST", url, **kwargs)
+        while True:
+            done, _ = concurrent.futures.wait([future], timeout=self.poll_interval if abort_check else None)
+            if done:
+                return future.result()
+            try:
+                abort_check()
+            except BaseException:
+                future.cancel()
+                raise
+
+    def close(self, timeout: float = 5) -> None:
+        """关闭所有连接并停止事件循环"""
+        async def _close():
+            for client in self._clients.values():
+                await (client.close() if self.backend == "aiohttp" else client.aclose())
+            self._clients.clear()
+
+        if not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"关闭上游连接失败: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def create_upstream_client(config: Dict[str, Any]) -> Optional[AsyncUpstreamClient]:
+    """根据 upstream_client 配置创建异步客户端，使用 requests 时返回None"""
+    backend = resolve_backend(config.get("upstream_client", "auto"))
+    if backend is None:
+        return None
+    client = AsyncUpstreamClient(backend, max_connections=config.get("upstream_max_connections", 100))
+    logger.info(f"上游请求使用异步客户端: {backend}，最大连接数 {client.max_connections}")
+    return client
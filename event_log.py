@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+# 按接口约定存放base64内容的字段：Gemini的 inlineData/inline_data.data、Imagen的 bytesBase64Encoded、
+# OpenAI兼容接口的 b64_json，以及插件内部使用的 image_base64
+BASE64_FIELDS = frozenset({"data", "bytesBase64Encoded", "b64_json", "image_base64"})
+
+
+def _summarize_blob(value: str) -> str:
+    return f"{value[:20]}... [长度: {len(value)}字符]"
+
+
+def redact_payload(obj: Any, max_string: int = 2000) -> Any:
+    """生成适合记录日志的API请求/响应副本
+
+    按字段名（以及 data: URI 前缀）识别base64内容并替换为长度说明，其余字符串超过
+    max_string 时截断。只遍历结构、不逐字符扫描字符串，多MB的响应也能很快完成。
+    """
+    if isinstance(obj, dict):
+        return {key: _redact_field(key, value, max_string) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [redact_payload(item, max_string) for item in obj]
+    if isinstance(obj, str) and len(obj) > max_string:
+        return _summarize_blob(obj) if obj.startswith("data:") else f"{obj[:max_string]}... [长度: {len(obj)}字符]"
+    return obj
+
+
+def _redact_field(key: str, value: Any, max_string: int) -> Any:
+    if isinstance(value, str) and len(value) > 64 and (key in BASE64_FIELDS or value.startswith("data:")):
+        return _summarize_blob(value)
+    return redact_payload(value, max_string)
+
+
+class _EventState:
+    __slots__ = ("tokens", "updated_at", "suppressed")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.suppressed = 0
+
+
+class EventLog:
+    """带采样和限流的结构化日志
+
+    每条日志对应一个事件名，事件名和字段通过 logger.bind 写入 extra，序列化的日志接收端可直接按字段检索。
+    规则按事件名配置：
+        sample: 采样比例(0-1)，只记录部分事件
+        rate: 每秒最多记录的条数（令牌桶，burst 为桶容量），超出的条数在下一次记录时一并报告
+    消息参数按 loguru 的 lazy 方式传入可调用对象，只有在日志真正输出时才会计算。
+    """
+
+    def __init__(self, rules: Optional[Dict[str, Dict[str, float]]] = None):
+        self.rules: Dict[str, Dict[str, float]] = dict(rules or {})
+        self._states: Dict[str, _EventState] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, rules: Optional[Dict[str, Dict[str, float]]]) -> None:
+        """合并规则，配置中的规则覆盖默认值"""
+        for event, rule in (rules or {}).items():
+            self.rules[event] = {**self.rules.get(event, {}), **rule}
+
+    def _admit(self, event: str) -> Optional[int]:
+        """判断事件是否记录，记录时返回此前被省略的条数，不记录时返回None"""
+        rule = self.rules.get(event)
+        if not rule:
+            return 0
+        sample = rule.get("sample", 1.0)
+        rate = rule.get("rate")
+        with self._lock:
+            state = self._states.get(event)
+            if state is None:
+                state = self._states[event] = _EventState(rule.get("burst", 1.0))
+            if sample < 1.0 and random.random() >= sample:
+                state.suppressed += 1
+                return None
+            if rate:
+                now = time.monotonic()
+                state.tokens = min(rule.get("burst", 1.0), state.tokens + (now - state.updated_at) * rate)
+                state.updated_at = now
+                if state.tokens < 1:
+                    state.suppressed += 1
+                    return None
+                state.tokens -= 1
+            suppressed, state.suppressed = state.suppressed, 0
+            return suppressed
+
+    def _log(self, level: str, event: str, message: str, args: tuple, fields: Dict[str, Any]) -> None:
+        suppressed = self._admit(event)
+        if suppressed is None:
+            return
+        if suppressed:
+            message += f" (省略了{suppressed}条同类日志)"
+        # depth=2：跳过本函数和公开的包装方法，日志位置显示为调用方
+        logger.bind(event=event, **fields).opt(lazy=True, depth=2).log(level, message, *args)
+
+    def log(self, level: str, event: str, message: str, *args, **fields) -> None:
+        self._log(level, event, message, args, fields)
+
+    def debug(self, event: str, message: str, *args, **fields) -> None:
+        self._log("DEBUG", event, message, args, fields)
+
+    def info(self, event: str, message: str, *args, **fields) -> None:
+        self._log("INFO", event, message, args, fields)
+
+    def warning(self, event: str, message: str, *args, **fields) -> None:
+        self._log("WARNING", event, message, args, fields)
@@ -0,0 +1,285 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Hashable, Iterator, Optional
+
+
+class JobInterrupted(BaseException):
+    """命令被中断的基类
+
+    继承 BaseException（与 asyncio.CancelledError 相同），不会被各处理流程中的
+    except Exception 吞掉，能够一直传播到命令入口，中断后不再重试或发送结果。
+    """
+
+
+class JobCancelled(JobInterrupted):
+    """用户结束了对话，命令被取消"""
+
+
+class DeadlineExceeded(JobInterrupted):
+    """命令超过了端到端截止时间"""
+
+
+class Job:
+    """一次用户命令的执行上下文，通过 current_job 在线程池之间传递
+
+    各阶段（翻译、压缩、HTTP请求、重试等待、发送）开始前调用 check()，并用 timeout()
+    将自身的超时时间收缩到剩余时间以内。
+    """
+
+    __slots__ = ("user_id", "is_admin", "created_at", "deadline", "cancelled")
+
+    def __init__(self, user_id: str, is_admin: bool = False, deadline: Optional[float] = None):
+        self.user_id = user_id
+        self.is_admin = is_admin
+        self.created_at = time.time()
+        self.deadline = deadline  # 绝对时间戳，None 表示不限制
+        self.cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def remaining(self) -> Optional[float]:
+        """距离截止时间的秒数，不限制时返回None"""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def check(self, stage: str = "") -> None:
+        """已取消或已超时时抛出对应异常"""
+        if self.cancelled.is_set():
+            raise JobCancelled(stage)
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, default: Optional[float], stage: str = "") -> Optional[float]:
+        """返回不超过剩余时间的超时值"""
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+    def sleep(self, seconds: float, stage: str = "") -> None:
+        """可被取消的等待，等待时间超过剩余时间时直接抛出 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self.cancelled.wait(max(0, remaining))
+            self.check(stage)
+            raise DeadlineExceeded(stage)
+        if self.cancelled.wait(seconds):
+            raise JobCancelled(stage)
+
+
+# 当前线程正在处理的命令，提交到线程池时需配合 contextvars.copy_context() 传递
+current_job: ContextVar[Optional[Job]] = ContextVar("gemini_current_job", default=None)
+
+# 当前请求所属的批次（如一条 -n 命令的多张变体），同一批次的并发请求只占用一个用户名额
+current_batch: ContextVar[Optional[Hashable]] = ContextVar("gemini_current_batch", default=None)
+
+
+class _Ticket:
+    __slots__ = ("user_id", "cost", "kind", "priority", "batch", "granted", "enqueued_at")
+
+    def __init__(self, user_id: str, cost: int, kind: str, priority: bool, batch: Optional[Hashable] = None):
+        self.user_id = user_id
+        self.cost = cost
+        self.kind = kind
+        self.priority = priority
+        self.batch = batch
+        self.granted = False
+        self.enqueued_at = time.time()
+
+
+class FairScheduler:
+    """按用户公平调度的上游请求准入控制
+
+    - 全局最多 max_concurrent 个请求同时执行，kind_limits 可再限制某类请求（如图像模型）的并发
+    - 每个用户最多 per_user_limit 个请求同时执行（exempt_users 不受限制）；同一批次（batch）的请求
+      合计只占一个用户名额，但该用户同时执行的请求总数不超过 per_user_batch_limit（默认为该类请求
+      上限减1，至少为 per_user_limit），保证其他用户始终至少有一个名额
+    - 优先通道（管理员、轻量文本操作）先于普通请求放行
+    - 普通请求按赤字轮转（Deficit Round Robin）在用户之间分配名额：每轮每个用户获得
+      quantum 的额度，请求按 cost 扣减额度，单个用户排队再多也只能按轮次获得名额
+    """
+
+    def __init__(self, max_concurrent: int = 6, per_user_limit: int = 2, quantum: int = 2, kind_limits: Optional[Dict[str, int]] = None,
+                 per_user_batch_limit: Optional[int] = None):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.per_user_limit = max(1, int(per_user_limit))
+        self.per_user_batch_limit = int(per_user_batch_limit) if per_user_batch_limit else None
+        self.quantum = max(1, int(quantum))
+        self.kind_limits = dict(kind_limits or {})
+        self.exempt_users = set()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._running_by_user: Dict[str, int] = defaultdict(int)  # 用户 -> 占用的名额（一个批次算一个）
+        self._requests_by_user: Dict[str, int] = defaultdict(int)  # 用户 -> 正在执行的请求数
+        self._running_by_kind: Dict[str, int] = defaultdict(int)
+        self._running_by_batch: Dict[Any, int] = {}  # 批次 -> 正在执行的请求数，批次的第一个请求占用用户名额
+        self._priority: Deque[_Ticket] = deque()
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()  # 用户 -> 排队中的请求，顺序即轮转顺序
+        self._deficits: Dict[str, int] = defaultdict(int)
+        self.stats = defaultdict(int)  # granted / priority_granted / timeouts / total_wait_ms
+
+    def _user_request_limit(self, kind: str) -> int:
+        """单个用户（含批次请求）同时执行的请求总数上限"""
+        if self.per_user_batch_limit:
+            return max(self.per_user_limit, self.per_user_batch_limit)
+        limit = min(self.kind_limits.get(kind, self.max_concurrent), self.max_concurrent)
+        return max(self.per_user_limit, limit - 1)
+
+    def _eligible(self, ticket: _Ticket) -> bool:
+        if ticket.user_id not in self.exempt_users:
+            holds_user_slot = ticket.batch is not None and ticket.batch in self._running_by_batch
+            if not holds_user_slot and self._running_by_user[ticket.user_id] >= self.per_user_limit:
+                return False
+            if self._requests_by_user.get(ticket.user_id, 0) >= self._user_request_limit(ticket.kind):
+                return False
+        limit = self.kind_limits.get(ticket.kind)
+        return limit is None or self._running_by_kind[ticket.kind] < limit
+
+    def _grant(self, ticket: _Ticket) -> None:
+        ticket.granted = True
+        self._running += 1
+        self._requests_by_user[ticket.user_id] += 1
+        if ticket.batch is None:
+            self._running_by_user[ticket.user_id] += 1
+        else:
+            if ticket.batch not in self._running_by_batch:
+                self._running_by_user[ticket.user_id] += 1
+            self._running_by_batch[ticket.batch] = self._running_by_batch.get(ticket.batch, 0) + 1
+        self._running_by_kind[ticket.kind] += 1
+        self.stats["priority_granted" if ticket.priority else "granted"] += 1
+        self.stats["total_wait_ms"] += int((time.time() - ticket.enqueued_at) * 1000)
+
+    def _dispatch(self) -> None:
+        """在持锁状态下尽可能多地放行排队请求"""
+        while self._running < self.max_concurrent:
+            # 优先通道：按到达顺序放行第一个可执行的请求
+            for ticket in self._priority:
+                if self._eligible(ticket):
+                    self._priority.remove(ticket)
+                    self._grant(ticket)
+                    break
+            else:
+                if not self._dispatch_round_robin():
+                    return
+
+    def _dispatch_round_robin(self) -> bool:
+        """赤字轮转放行一个普通请求，没有可放行的请求时返回False"""
+        if not self._queues:
+            return False
+        # 每轮至少为可执行的用户增加 quantum 的额度，额度随轮次增长，最多 max_cost/quantum 轮内必有放行
+        for _ in range(64):
+            progressed = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                head = queue[0]
+                if not self._eligible(head):
+                    continue
+                progressed = True
+                if self._deficits[user_id] < head.cost:
+                    self._deficits[user_id] += self.quantum
+                if self._deficits[user_id] >= head.cost:
+                    queue.popleft()
+                    self._deficits[user_id] -= head.cost
+                    # 放行后把该用户移到轮转队尾，其他用户先获得下一个名额
+                    self._queues.move_to_end(user_id)
+                    if not queue:
+                        del self._queues[user_id]
+                        self._deficits.pop(user_id, None)
+                    self._grant(head)
+                    return True
+            if not progressed:
+                return False
+        return False
+
+    def _release(self, ticket: _Ticket) -> None:
+        with self._cond:
+            self._running -= 1
+            self._requests_by_user[ticket.user_id] -= 1
+            if self._requests_by_user[ticket.user_id] <= 0:
+                del self._requests_by_user[ticket.user_id]
+            releases_user_slot = True
+            if ticket.batch is not None:
+                self._running_by_batch[ticket.batch] -= 1
+                if self._running_by_batch[ticket.batch] > 0:
+                    releases_user_slot = False  # 批次中还有请求在执行，继续占用用户名额
+                else:
+                    del self._running_by_batch[ticket.batch]
+            if releases_user_slot:
+                self._running_by_user[ticket.user_id] -= 1
+                if self._running_by_user[ticket.user_id] <= 0:
+                    del self._running_by_user[ticket.user_id]
+            self._running_by_kind[ticket.kind] -= 1
+            self._dispatch()
+            self._cond.notify_all()
+
+    def _cancel(self, ticket: _Ticket) -> None:
+        """从队列中移除未放行的请求（调用方需持锁）"""
+        if ticket.priority:
+            if ticket in self._priority:
+                self._priority.remove(ticket)
+            return
+        queue = self._queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+                self._deficits.pop(ticket.user_id, None)
+
+    @contextmanager
+    def slot(self, user_id: str, cost: int = 1, kind: str = "default", priority: bool = False, timeout: Optional[float] = None,
+             abort_check: Optional[Callable[[], None]] = None, batch: Optional[Hashable] = None) -> Iterator[None]:
+        """获取一个执行名额，退出上下文时归还
+
+        Args:
+            batch: 批次标识，同一批次正在执行的请求合计只占用一个用户名额
+            abort_check: 排队期间定期调用，抛出异常时放弃排队并将异常原样抛出（用于取消）
+
+        Raises:
+            TimeoutError: 在 timeout 秒内没有获得名额
+        """
+        ticket = _Ticket(user_id, max(1, int(cost)), kind, priority, batch)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if priority:
+                self._priority.append(ticket)
+            else:
+                self._queues.setdefault(user_id, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._cancel(ticket)
+                    self.stats["timeouts"] += 1
+                    raise TimeoutError("等待执行名额超时")
+                if abort_check is not None:
+                    try:
+                        abort_check()
+                    except BaseException:
+                        self._cancel(ticket)
+                        self.stats["aborted"] += 1
+                        raise
+                    # 需要定期检查取消状态，不能无限期等待
+                    remaining = 0.5 if remaining is None else min(remaining, 0.5)
+                self._cond.wait(remaining)
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def snapshot(self) -> Dict[str, object]:
+        """返回当前调度状态，用于状态查询和调试"""
+        with self._cond:
+            return {
+                "running": self._running,
+                "running_by_user": dict(self._running_by_user),
+                "running_by_kind": dict(self._running_by_kind),
+                "running_batches": len(self._running_by_batch),
+                "priority_waiting": len(self._priority),
+                "waiting_by_user": {user_id: len(queue) for user_id, queue in self._queues.items()},
+                "stats": dict(self.stats),
+            }
@@ -26,13 +26,36 @@ import traceback
 import copy
 import threading
 import urllib.parse
+import contextvars
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 
 import random
 import string
 import hashlib
 import re
+import atexit
+import contextlib
 from common.tmp_dir import TmpDir
 
+from .ttl_cache import TTLCache
+from .singleflight import SingleFlight
+from .session_store import SessionStateManager, create_session_store
+from .state_backend import BackendDict, create_state_backend
+from .striped_lock import StripedLock
+from .fair_scheduler import FairScheduler, Job, current_batch, current_job, JobInterrupted, JobCancelled, DeadlineExceeded
+from .metrics import MetricsRegistry, cached, start_metrics_server
+from .tracing import NOOP_SPAN, create_tracer
+from .event_log import EventLog, redact_payload
+from .sampling_profiler import SamplingProfiler
+from .traffic_capture import create_recorder
+from .async_upstream import create_upstream_client
+from .hedging import HedgePolicy, race
+from .response_classifier import RETRYABLE_KINDS, REFUSAL, classify_text_response, is_blocked, reprompt_instruction
+
+# 当前生效的插件实例；dow 重载插件时会重新执行本模块，但不会通知旧实例，由新实例负责释放旧实例的资源
+_active_instance = globals().get("_active_instance")
+
 @plugins.register(
     name="GeminiImage",
     desire_priority=20,
@@ -58,7 +81,9 @@ class GeminiImage(Plugin):
     MAX_REQUEST_SIZE = 4 * 1024 * 1024
     # 会话中保留的最大消息数量
     MAX_CONVERSATION_MESSAGES = 10
-    
+    # 识图未提供问题时使用的默认提示词
+    DEFAULT_ANALYSIS_QUESTION = "请仔细观察这张图片的内容，然后用简洁清晰的中文回答用户的问题。如用户没有提出额外问题，则简单描述图片中的主体、场景、风格、颜色等关键要素。如果图片包含文字，也请提取出来。"
+
     # 会话类型常量
     SESSION_TYPE_GENERATE = "generate"  # 生成图片模式
     SESSION_TYPE_EDIT = "edit"          # 编辑图片模式
@@ -66,6 +91,50 @@ class GeminiImage(Plugin):
     SESSION_TYPE_MERGE = "merge"        # 融图模式
     SESSION_TYPE_ANALYSIS = "analysis"   # 图片分析模式
     
+    # 上游请求的调度代价（赤字轮转中扣减的额度），图像类请求占用时间长，代价更高
+    UPSTREAM_OP_COSTS = {
+        "generate": 2, "edit": 2, "merge": 3,
+        "analysis": 1, "reverse": 1, "chat": 1, "expand": 1, "translate": 1, "context_cache": 1, "summary": 1,
+    }
+    # 使用图像模型的请求，受 max_concurrent_image_requests 限制
+    IMAGE_OPS = {"generate", "edit", "merge"}
+    # 轻量文本请求走优先通道，不排在图像请求后面
+    PRIORITY_OPS = {"chat", "expand", "translate"}
+    # 开启对冲时，耗时长尾明显的图像生成/编辑请求可以发出对冲请求
+    HEDGE_OPS = {"generate", "edit"}
+    
+    # 高频日志事件的默认采样/限流规则，可通过 log_event_rules 配置覆盖
+    LOG_EVENT_RULES = {
+        "request.user": {"rate": 0.2, "burst": 5},           # 每条消息都会识别用户ID
+        "image_cache.keys": {"rate": 1 / 60, "burst": 1},     # 图片查找未命中时打印缓存键
+        "response.part": {"sample": 0.1},                     # 多图响应的逐part调试信息
+    }
+    
+    # 多进程部署时放到共享状态后端的属性 -> 过期时间对应的配置属性
+    SHARED_STATE_TTLS = {
+        "waiting_for_reference_image": "reference_image_wait_timeout",
+        "waiting_for_reference_image_time": "reference_image_wait_timeout",
+        "waiting_for_reverse_image": "reverse_image_wait_timeout",
+        "waiting_for_reverse_image_time": "reverse_image_wait_timeout",
+        "waiting_for_analysis_image": "analysis_image_wait_timeout",
+        "waiting_for_analysis_image_time": "analysis_image_wait_timeout",
+        "waiting_for_merge_image": "merge_image_wait_timeout",
+        "waiting_for_merge_image_time": "merge_image_wait_timeout",
+        "merge_images": "merge_image_wait_timeout",
+        "image_cache": "image_cache_timeout",
+    }
+    
+    # 需要持久化到会话存储的状态属性，插件重载或重启后恢复
+    PERSISTENT_STATE_ATTRS = (
+        "conversations", "conversation_session_types", "last_conversation_time", "last_images", "chat_sessions",
+        "user_translate_settings", "image_cache",
+        "waiting_for_reference_image", "waiting_for_reference_image_time",
+        "waiting_for_reverse_image", "waiting_for_reverse_image_time",
+        "waiting_for_analysis_image", "waiting_for_analysis_image_time",
+        "waiting_for_merge_image", "waiting_for_merge_image_time", "merge_images",
+        "last_analysis_image", "last_analysis_time", "analysis_sessions",
+    )
+    
     # 默认配置
     DEFAULT_CONFIG = {
         "enable": True,
@@ -112,6 +181,13 @@ class GeminiImage(Plugin):
             logging.getLogger("requests").setLevel(logging.WARNING)
             logger.debug(f"INIT - urllib3 effective level: {logging.getLogger('urllib3').getEffectiveLevel()}, requests effective level: {logging.getLogger('requests').getEffectiveLevel()}")
 
+            # 插件重载：先释放旧实例的线程池、后台线程和退出回调，并让它保存翻译缓存、写回会话状态
+            global _active_instance
+            previous, _active_instance = _active_instance, self
+            if previous is not None:
+                previous._release_resources()
+            self._atexit_callbacks = []  # (函数, 参数)，重载时注销并立即执行
+
             # 载入配置
             self.config = super().load_config() or self._load_config_template()
             
@@ -122,6 +198,10 @@ class GeminiImage(Plugin):
             
             # 设置配置参数
             self.enable = self.config.get("enable", True)
+            
+            # 结构化日志：高频事件按规则采样和限流，参数延迟到真正输出时才计算
+            self.event_log = EventLog(self.LOG_EVENT_RULES)
+            self.event_log.configure(self.config.get("log_event_rules"))
             self.api_key = self.config.get("gemini_api_key", "")
             
             # 模型配置
@@ -151,6 +231,8 @@ class GeminiImage(Plugin):
             self.expand_commands = self.config.get("expand_commands", ["g扩写"])
             self.chat_commands = self.config.get("chat_commands", ["g对话", "g回答"])
             self.print_model_commands = self.config.get("print_model_commands", ["g打印对话模型", "g打印模型"])
+            self.metrics_commands = self.config.get("metrics_commands", ["g运行指标", "g指标"])
+            self.profiler_commands = self.config.get("profiler_commands", ["g性能分析"])
             self.switch_model_commands = self.config.get("switch_model_commands", ["g切换对话模型", "g切换模型"])
             
             # 获取积分配置
@@ -180,6 +262,21 @@ class GeminiImage(Plugin):
             self.translate_api_key = self.config.get("translate_api_key", "")
             self.translate_model = self.config.get("translate_model", "glm-4-flash")
             
+            # 翻译结果缓存（LRU+TTL，持久化到文件，重启后仍可复用）
+            self.translate_cache = TTLCache(
+                max_entries=self.config.get("translate_cache_size", 1000),
+                ttl=self.config.get("translate_cache_ttl", 7 * 24 * 3600)
+            )
+            self.translate_cache_file = os.path.join(os.path.dirname(__file__), self.config.get("translate_cache_file", "translate_cache.json"))
+            self.translate_cache_save_interval = self.config.get("translate_cache_save_interval", 60)  # 持久化最小间隔(秒)
+            self.translate_cache_dirty = False
+            self.translate_cache_last_save = time.time()
+            self.translate_cache_save_lock = threading.Lock()  # 预处理线程可能同时触发保存
+            self.translate_cache_stats = defaultdict(int)  # hits / misses / skipped
+            self.translate_inflight = SingleFlight()  # 合并并发的相同翻译请求
+            self._load_translate_cache()
+            self._register_atexit(self._save_translate_cache, True)
+            
             # 获取翻译控制命令配置
             self.translate_on_commands = self.config.get("translate_on_commands", ["g开启翻译", "g启用翻译"])
             self.translate_off_commands = self.config.get("translate_off_commands", ["g关闭翻译", "g禁用翻译"])
@@ -188,11 +285,19 @@ class GeminiImage(Plugin):
             self.expand_prompt = self.config.get("expand_prompt", "请帮我扩写以下提示词，使其更加详细和具体：{prompt}")
             self.expand_model = self.config.get("expand_model", "gemini-2.0-flash-thinking-exp-01-21")
             
+            # 请求预处理配置：翻译/扩写（网络）与图片校验/压缩/编码（CPU）并行执行
+            self.auto_expand_prompt = self.config.get("auto_expand_prompt", False)  # 生成/编辑前是否自动扩写提示词
+            self.edit_image_compress_threshold = self.config.get("edit_image_compress_threshold", 2 * 1024 * 1024)  # 超过该大小的待编辑图片先压缩
+            self.prep_executor = ThreadPoolExecutor(max_workers=self.config.get("prep_workers", 4), thread_name_prefix="gemini_prep")
+            
             # 用户翻译设置缓存，用于存储每个用户的翻译设置
             self.user_translate_settings = {}  # 用户ID -> 是否启用翻译
             
             # 初始化会话状态，用于保存上下文
             self.conversations = defaultdict(list)  # 存储会话历史，默认初始化为空列表
+            # 纯文本对话会话：会话ID -> {"messages": 消息列表, "tokens": 每条消息的估算token数, "total_tokens": 累计值}
+            self.chat_sessions = {}
+            self.chat_history_tokens = self.config.get("chat_history_tokens", 4000)  # 对话历史的token预算
             self.last_conversation_time = {}  # 记录每个会话的最后活动时间        
             self.conversation_session_types = {}  # 记录每个会话的类型
             self.conversation_expire_seconds = 180  # 会话过期时间(秒)，改为3分钟
@@ -216,20 +321,132 @@ class GeminiImage(Plugin):
             self.waiting_for_merge_image = {}  # 用户ID -> 等待的融图提示词
             self.waiting_for_merge_image_time = {}  # 用户ID -> 开始等待融图的时间戳
             self.merge_image_wait_timeout = 180  # 等待融图图片的超时时间(秒)，3分钟
-            self.merge_first_image = {}  # 用户ID -> 第一张图片数据            
+            self.merge_images = {}  # 用户ID -> 已收到的融图图片 [{"sha256": 内容哈希, "data": 原图二进制}]，按上传顺序；二进制在会话存储中按内容哈希存为blob
+            self.merge_ingest = {}  # 用户ID -> {图片哈希: 预处理Future}，图片到达时即开始校验/压缩/编码，只在本进程内有效
+            self.merge_max_images = self.config.get("merge_max_images", 4)  # 单次融图最多的图片数量（g融图 -n 3 描述）
+            self.merge_max_total_size = self.config.get("merge_max_total_size", int(3.5 * 1024 * 1024))  # 所有图片的总大小上限，超过时按张数平分后压缩
+            # 融图没有返回图片时，复用已编码的请求追加一轮纠正提示重试的次数，以及每次重试的传输层重试次数
+            self.merge_reprompt_attempts = self.config.get("merge_reprompt_attempts", 1)
+            self.merge_reprompt_max_retries = self.config.get("merge_reprompt_max_retries", 2)
 
             # 初始化图片缓存，用于存储用户上传的图片
             self.image_cache = {}  # 会话ID/用户ID -> {"data": 图片数据, "timestamp": 时间戳}
+            # 缓存键 -> (写入时间, 字节数)：过期清理和占用统计只读这个索引，不会从会话存储加载图片内容
+            self.image_cache_index = {}
+            self._image_cache_index_seeded = False
             self.image_cache_timeout = 600  # 图片缓存过期时间(秒)
             
             # 初始化追问状态
             self.last_analysis_image = {}  # 用户ID -> 最后一次识图的图片数据
             self.last_analysis_time = {}  # 用户ID -> 最后一次识图的时间戳
             self.follow_up_timeout = 180  # 追问超时时间(秒)，3分钟
+            self.analysis_sessions = {}  # 用户ID -> {"turns": [{"role", "text", "tokens"}], "tokens": 历史总估算token数}
+            self.follow_up_history_tokens = self.config.get("follow_up_history_tokens", 2000)  # 追问时携带的历史问答token预算
+            
+            # 初始化识图/反推结果缓存，同一张图片+同一问题+同一模型直接复用结果
+            self.enable_analysis_cache = self.config.get("enable_analysis_cache", True)
+            self.analysis_cache = TTLCache(
+                max_entries=self.config.get("analysis_cache_size", 200),
+                ttl=self.config.get("analysis_cache_ttl", 3600)
+            )
+            self.analysis_cache_phash = self.config.get("analysis_cache_phash", False)  # 是否启用感知哈希近似匹配
+            self.analysis_cache_phash_threshold = self.config.get("analysis_cache_phash_threshold", 4)  # 汉明距离阈值(0-64)
+            self.analysis_cache_stats = defaultdict(int)  # hits / phash_hits / misses
+            
+            # 进行中的Gemini请求登记表，相同请求并发到达时共享同一次上游调用
+            self.gemini_inflight = SingleFlight()
+            
+            # 上下文缓存（Gemini cachedContents）：长系统提示词和追问图片只上传一次，后续请求按名称引用
+            self.enable_context_cache = self.config.get("enable_context_cache", False)
+            self.context_cache_ttl = self.config.get("context_cache_ttl", 600)  # 缓存有效期(秒)
+            self.context_cache_min_tokens = self.config.get("context_cache_min_tokens", 1024)  # 低于该估算token数的内容不创建缓存
+            # 缓存键 -> {"name": cachedContents名称或None, "expire_at": 过期时间戳}，条目在上游缓存过期时一起淘汰
+            self.context_caches = TTLCache(
+                max_entries=self.config.get("context_cache_size", 256),
+                ttl=self.context_cache_ttl
+            )
+            self.context_cache_stats = defaultdict(int)  # created / reused / failed / skipped
+            
+            # 多图变体生成配置：一次命令并发生成多张图片
+            self.max_variants = self.config.get("max_variants", 4)  # 单次命令最多生成的图片数量
+            # 上游请求公平调度：按用户赤字轮转分配并发名额，管理员和轻量文本请求走优先通道
+            self.scheduler = FairScheduler(
+                max_concurrent=self.config.get("max_concurrent_upstream_requests", 8),
+                per_user_limit=self.config.get("per_user_max_concurrent", 2),
+                per_user_batch_limit=self.config.get("per_user_max_batch_concurrent", 0),
+                quantum=self.config.get("scheduler_quantum", 2),
+                # 图像模型并发请求上限，所有生成/编辑/融图请求共享
+                kind_limits={"image": self.config.get("max_concurrent_image_requests", 4)}
+            )
+            self.scheduler.exempt_users.update(self.admins)
+            
+            # 端到端截止时间：每条命令从收到开始计时，各阶段按剩余时间收缩自身超时，超时或结束对话后不再继续消耗配额
+            self.job_timeout = self.config.get("job_timeout", 300)
+            self.active_jobs = defaultdict(set)  # 用户ID -> 正在执行的命令
+            self.variant_executor = ThreadPoolExecutor(max_workers=self.max_variants, thread_name_prefix="gemini_variant")
+            
+            # 长会话后台摘要：会话超过阈值时，用文本模型将较早的轮次（含其中的图片）压缩为一段文字
+            self.enable_session_summary = self.config.get("enable_session_summary", False)
+            self.session_summary_model = self.config.get("session_summary_model", "gemini-2.0-flash")
+            self.session_summary_threshold = self.config.get("session_summary_threshold", 1200)  # 触发摘要的会话估算token数
+            self.session_summary_keep_messages = self.config.get("session_summary_keep_messages", 4)  # 保留不参与摘要的最近消息数
+            self.summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini_summary")
+            self.summary_pending = set()  # 正在摘要的会话ID
+            self.summary_lock = threading.Lock()
             
             # 获取图片分析提示词
             self.reverse_prompt = self.config.get("reverse_prompt", "请详细分析这张图片的内容，包括主要对象、场景、风格、颜色等关键特征。如果图片包含文字，也请提取出来。请用简洁清晰的中文进行描述。")
             
+            # 按用户分片的状态锁：同一用户的会话/等待状态修改互斥，不同用户之间互不阻塞
+            self.user_locks = StripedLock(self.config.get("state_lock_stripes", 64))
+            
+            # 共享状态后端：多个机器人进程共享等待状态和图片缓存，过期由后端负责
+            self.state_backend = None
+            self._init_state_backend()
+            
+            # 会话状态持久化：插件重载或重启后恢复进行中的会话，图片按内容哈希只保存一份
+            self.session_state = None
+            self._init_session_store()
+            
+            # 异步上游客户端：所有上游请求在专用事件循环线程上执行，共享连接池，未安装 aiohttp/httpx 时使用 requests
+            self.upstream_client = create_upstream_client(self.config)
+            if self.upstream_client is not None:
+                self._register_atexit(self.upstream_client.close)
+            
+            # 对冲请求：图像请求超过近期耗时分位数仍未返回时，向备用密钥/路由再发一次，先成功的为准，另一个立即取消
+            self.hedge_policy = None
+            self.hedge_targets = self.config.get("hedge_targets", [])  # [{"base_url", "api_key", "auth": "key"/"bearer", "proxy"}]，为空时发往原地址
+            self._hedge_target_counter = itertools.count()  # 多个处理线程并发轮转，next() 是原子的
+            if self.config.get("enable_hedging", False):
+                if self.upstream_client is None:
+                    logger.warning("对冲请求需要异步上游客户端（安装 aiohttp 或 httpx），已关闭对冲")
+                else:
+                    self.hedge_policy = HedgePolicy(
+                        percentile=self.config.get("hedge_percentile", 0.95),
+                        budget_ratio=self.config.get("hedge_budget", 0.05),
+                        min_samples=self.config.get("hedge_min_samples", 20),
+                        min_delay=self.config.get("hedge_min_delay", 5),
+                    )
+            
+            # 运行指标：按操作/模型/上游路由统计请求数和耗时，可通过本地HTTP端点或管理员命令查看
+            self.metrics = MetricsRegistry(prefix="gemini_image")
+            self.metrics_server = None
+            self._init_metrics()
+            
+            # 请求追踪：每条命令一个根span，翻译、预处理、每次上游请求（含重试）、重试等待和发送各为子span
+            self.tracer = create_tracer(self.config, os.path.dirname(__file__))
+            
+            # 流量录制：记录命令、图片摘要、耗时和上游请求的状态/耗时（不含图片内容和密钥），用 tools/replay.py 回放
+            self.traffic_capture = create_recorder(self.config, os.path.dirname(__file__))
+            
+            # 采样式性能分析：管理员命令开启，只统计经过插件代码的调用栈，结果写入保存目录
+            self.profiler_max_seconds = self.config.get("profiler_max_seconds", 600)
+            self.profiler = SamplingProfiler(
+                interval=self.config.get("profiler_interval", 0.01),
+                path_filter=os.path.dirname(os.path.abspath(__file__)),
+                max_duration=self.profiler_max_seconds
+            )
+            
             # 验证关键配置
             if not self.api_key:
                 logger.warning("GeminiImage插件未配置API密钥")
@@ -280,11 +497,509 @@ class GeminiImage(Plugin):
             # For detailed debugging, one might log: logger.error(traceback.format_exc())
             return False
 
+    def _init_state_backend(self):
+        """创建共享状态后端，并将等待状态和图片缓存替换为后端字典（TTL下推到后端）"""
+        try:
+            self.state_backend = create_state_backend(self.config.get("state_backend", "memory"), self.config.get("state_backend_url", ""))
+        except Exception as e:
+            logger.error(f"初始化共享状态后端失败，状态仅保存在本进程中: {str(e)}")
+            self.state_backend = None
+        if self.state_backend is None:
+            return
+        
+        prefix = self.config.get("state_backend_prefix", "gemini_image")
+        for attr, ttl_attr in self.SHARED_STATE_TTLS.items():
+            setattr(self, attr, BackendDict(self.state_backend, attr, ttl=getattr(self, ttl_attr), prefix=prefix))
+
+    def _init_session_store(self):
+        """创建会话存储，并将需要持久化的状态字典替换为绑定存储的字典（首次访问时才加载）"""
+        store_path = os.path.join(os.path.dirname(__file__), self.config.get("session_store_path", "sessions.db"))
+        try:
+            session_store = create_session_store(self.config.get("session_store", "sqlite"), store_path)
+        except Exception as e:
+            logger.error(f"初始化会话存储失败，会话状态仅保存在内存中: {str(e)}")
+            return
+        if session_store is None:
+            return
+        
+        self.session_state = SessionStateManager(session_store, flush_interval=self.config.get("session_store_flush_interval", 2))
+        for attr in self.PERSISTENT_STATE_ATTRS:
+            if self.state_backend and attr in self.SHARED_STATE_TTLS:
+                continue  # 已由共享状态后端保存
+            default_factory = list if attr == "conversations" else None
+            setattr(self, attr, self.session_state.bind(attr, default_factory))
+        
+        pruned = session_store.prune_blobs()
+        if pruned:
+            logger.info(f"已清理 {pruned} 个不再被引用的会话图片")
+        self.session_state.start()
+        self._register_atexit(self.session_state.close)
+        logger.info(f"会话状态已启用持久化存储: {store_path}")
+
+    def _register_atexit(self, func, *args):
+        """注册进程退出回调，并记录下来以便插件重载时注销"""
+        atexit.register(func, *args)
+        self._atexit_callbacks.append((func, args))
+
+    def _release_resources(self):
+        """释放实例持有的线程池、后台线程和退出回调，由重载后的新实例调用"""
+        for name in ("prep_executor", "variant_executor", "summary_executor"):
+            executor = getattr(self, name, None)
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        for name, method in (("profiler", "stop"), ("tracer", "close"), ("traffic_capture", "close")):
+            resource = getattr(self, name, None)
+            if resource is None:
+                continue
+            try:
+                getattr(resource, method)()
+            except Exception as e:
+                logger.warning(f"释放旧插件实例的 {name} 失败: {e}")
+        # 退出回调负责保存翻译缓存、关闭上游连接和写回会话状态，注销后立即执行一次
+        for func, args in getattr(self, "_atexit_callbacks", []):
+            atexit.unregister(func)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning(f"执行旧插件实例的退出回调失败: {e}")
+        self._atexit_callbacks = []
+        logger.info("已释放旧GeminiImage插件实例的资源")
+
+    def _init_metrics(self):
+        """注册指标，并按配置启动 /metrics 端点"""
+        self.command_counter = self.metrics.counter("commands_total", "按操作统计的命令数", ("command", "status"))
+        self.command_duration = self.metrics.histogram("command_duration_seconds", "命令端到端耗时", ("command",))
+        self.upstream_counter = self.metrics.counter("upstream_requests_total", "上游API请求数", ("op", "model", "route", "status"))
+        self.upstream_duration = self.metrics.histogram("upstream_request_duration_seconds", "上游API请求耗时（不含排队）", ("op", "model", "route"))
+        self.upstream_queue_wait = self.metrics.histogram("upstream_queue_wait_seconds", "等待调度名额的时间", ("kind",), buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+        
+        self.metrics.gauge("scheduler_running", "正在执行的上游请求数", lambda: self.scheduler.snapshot()["running"])
+        self.metrics.gauge("upstream_in_flight", "异步客户端中正在进行的HTTP请求数", lambda: self.upstream_client.in_flight if self.upstream_client else 0)
+        self.hedge_counter = self.metrics.counter("hedge_requests_total", "对冲请求统计：sent 发出 / hedge_won 对冲获胜 / primary_won 主请求获胜 / budget_exhausted 预算不足未发出", ("op", "outcome"))
+        self.reprompt_counter = self.metrics.counter("image_reprompts_total", "没有返回图片时追加提示重试的次数：按回复类型和结果（image 获得图片 / no_image 仍无图片 / error 请求失败 / skipped 拒绝未重试）", ("op", "kind", "outcome"))
+        self.metrics.gauge("hedge_budget_tokens", "剩余的对冲预算", lambda: self.hedge_policy.budget.tokens if self.hedge_policy else 0)
+        self.metrics.gauge("scheduler_queue_depth", "排队等待的上游请求数", self._scheduler_queue_depth, ("lane",))
+        self.metrics.gauge("active_jobs", "正在处理的命令数", lambda: sum(len(jobs) for jobs in list(self.active_jobs.values())))
+        self.metrics.gauge("active_sessions", "活跃会话数", lambda: {
+            "conversation": len(self.conversations),
+            "chat": len(self.chat_sessions),
+            "analysis": len(self.analysis_sessions),
+        }, ("type",))
+        self.metrics.gauge("image_cache_entries", "图片缓存条目数", lambda: len(self.image_cache_index))
+        self.metrics.gauge("image_cache_bytes", "图片缓存占用字节数", cached(self._image_cache_bytes, ttl=15))
+        self.metrics.gauge("save_dir_bytes", "图片保存目录占用字节数", cached(self._save_dir_bytes, ttl=60))
+        self.metrics.gauge("cache_events", "结果缓存和上下文缓存的命中统计", lambda: {
+            **{("analysis", event): count for event, count in self.analysis_cache_stats.items()},
+            **{("context", event): count for event, count in self.context_cache_stats.items()},
+        }, ("cache", "event"))
+        
+        port = self.config.get("metrics_port", 0)
+        if port:
+            self.metrics_server = start_metrics_server(self.metrics, self.config.get("metrics_host", "127.0.0.1"), port)
+
+    def _scheduler_queue_depth(self) -> Dict[str, int]:
+        snapshot = self.scheduler.snapshot()
+        return {"priority": snapshot["priority_waiting"], "normal": sum(snapshot["waiting_by_user"].values())}
+
+    def _image_cache_bytes(self) -> int:
+        return sum(size for _, size in list(self.image_cache_index.values()))
+
+    def _put_image_cache(self, key: str, image_data: bytes) -> None:
+        """写入图片缓存并更新索引"""
+        now = time.time()
+        self.image_cache[key] = {"content": image_data, "timestamp": now}
+        self.image_cache_index[key] = (now, len(image_data))
+
+    def _save_dir_bytes(self) -> int:
+        total = 0
+        with os.scandir(self.save_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat().st_size
+        return total
+
+    def _classify_command(self, context, user_id: str) -> Optional[str]:
+        """识别消息对应的操作名，用于指标统计；图片消息按等待中的操作归类，其他消息返回None"""
+        if context.type == ContextType.IMAGE:
+            for op, waiting in (("reference", self.waiting_for_reference_image), ("merge", self.waiting_for_merge_image),
+                                ("analysis", self.waiting_for_analysis_image), ("reverse", self.waiting_for_reverse_image)):
+                if user_id in waiting:
+                    return op
+            return None
+        if context.type != ContextType.TEXT or not context.content:
+            return None
+        content = context.content.strip()
+        for op, commands in (("reference", self.reference_edit_commands), ("edit", self.edit_commands),
+                             ("merge", self.merge_commands), ("analysis", self.image_analysis_commands),
+                             ("follow_up", self.follow_up_commands), ("reverse", self.image_reverse_commands),
+                             ("chat", self.chat_commands), ("expand", self.expand_commands), ("generate", self.commands)):
+            if any(content.startswith(cmd) for cmd in commands):
+                return op
+        return None
+
+    @staticmethod
+    def _upstream_model(url: str, payload: Any) -> str:
+        """从请求地址（models/xxx:method）或请求体中提取模型名"""
+        match = re.search(r"models/([^:/?]+)", url)
+        if match:
+            return match.group(1)
+        if isinstance(payload, dict) and payload.get("model"):
+            return str(payload["model"]).split("/")[-1]
+        return "unknown"
+
+    def _submit_prep(self, fn, *args, **kwargs) -> Future:
+        """将预处理任务提交到线程池，并携带当前线程的上下文变量"""
+        ctx = contextvars.copy_context()
+        return self.prep_executor.submit(ctx.run, fn, *args, **kwargs)
+
+    def _prepare_prompt(self, prompt: str, user_id: str = None) -> str:
+        """预处理提示词：可选的自动扩写，随后翻译
+        
+        Args:
+            prompt: 原始提示词
+            user_id: 用户ID，用于获取用户的翻译设置
+            
+        Returns:
+            发送给图像模型的提示词
+        """
+        with self.tracer.span("prepare_prompt", **{"prompt.length": len(prompt)}):
+            if self.auto_expand_prompt:
+                expanded = self._expand_prompt(prompt)
+                english_prompt = self._extract_english_prompt(expanded)
+                if english_prompt:
+                    logger.info(f"自动扩写提示词成功，长度: {len(prompt)} -> {len(english_prompt)}")
+                    return english_prompt
+            return self._translate_prompt(prompt, user_id)
+
+    def _extract_english_prompt(self, expanded: Optional[str]) -> Optional[str]:
+        """从扩写结果中提取"英文版"段落"""
+        if not expanded:
+            return None
+        match = re.search(r"英文版[:：]?\s*(.+?)(?:\n\s*\n|```|$)", expanded, re.S)
+        if match and match.group(1).strip():
+            return match.group(1).strip()
+        return None
+
+    def _guess_image_mime_type(self, image_data: bytes) -> str:
+        """根据文件头判断图片的MIME类型，无法识别时按PNG处理"""
+        if image_data[:3] == b"\xff\xd8\xff":
+            return "image/jpeg"
+        if image_data[:4] == b"GIF8":
+            return "image/gif"
+        if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+            return "image/webp"
+        return "image/png"
+
+    def _prepare_edit_image(self, image_data: bytes, operation_name: str, image_identifier: str = "input_image", compress_threshold: Optional[int] = None) -> Optional[Dict]:
+        """校验、按需压缩并编码待编辑的图片
+        
+        Args:
+            image_data: 图片二进制数据
+            operation_name: 操作名称，用于日志
+            image_identifier: 图片标识，用于日志
+            compress_threshold: 超过该大小时压缩，默认使用edit_image_compress_threshold
+            
+        Returns:
+            {"data": 图片数据, "base64": base64编码, "mime_type": MIME类型}，图片无效时返回None
+        """
+        with self.tracer.span("prepare_image", **{"image.bytes": len(image_data or b"")}) as span:
+            self._check_job("图片预处理")
+            if not self._verify_image_integrity(image_data, operation_name, image_identifier):
+                return None
+        
+            if len(image_data) > (compress_threshold or self.edit_image_compress_threshold):
+                original_size = len(image_data)
+                image_data = self._compress_image(image_data, max_size=1200, quality=95)
+                logger.info(f"{operation_name}图片过大，已压缩: {original_size} -> {len(image_data)} 字节")
+                span.set_attribute("image.compressed_bytes", len(image_data))
+        
+            return {
+                "data": image_data,
+                "base64": base64.b64encode(image_data).decode("utf-8"),
+                "mime_type": self._guess_image_mime_type(image_data)
+            }
+
+    def _context_user_id(self, context) -> Optional[str]:
+        """获取消息发送者ID：群聊优先actual_user_id，私聊优先from_user_id，否则使用session_id"""
+        msg = context.kwargs.get("msg") if hasattr(context, "kwargs") else None
+        if context.get("isgroup", False):
+            if msg is not None and getattr(msg, "actual_user_id", None):
+                return msg.actual_user_id
+        elif msg is not None and getattr(msg, "from_user_id", None):
+            return msg.from_user_id
+        return context.get("session_id") or context.get("from_user_id")
+
+    def _upstream_post(self, op: str, url: str, **kwargs) -> requests.Response:
+        """所有上游API请求的统一出口：按公平调度获得执行名额后再发送
+        
+        Args:
+            op: 请求类型，决定调度代价、是否走优先通道以及是否受图像并发上限约束
+            url: 请求地址，其余参数原样传给 requests.post（或参数相同的异步客户端）
+        """
+        with self.tracer.span(f"upstream.{op}") as span:
+            job = current_job.get()
+            user_id = job.user_id if job else "__system__"
+            priority = op in self.PRIORITY_OPS or bool(job and job.is_admin)
+            kind = "image" if op in self.IMAGE_OPS else "text"
+            model = self._upstream_model(url, kwargs.get("json"))
+            route = urllib.parse.urlparse(url).netloc or "unknown"
+            # 同一阶段内的第几次请求，重试时递增
+            span.set_attribute("attempt", span.sequence)
+            span.set_attribute("gemini.model", model)
+            span.set_attribute("server.address", route)
+        
+            # 排队等待名额和HTTP请求都不能超过命令的剩余时间
+            slot_limits = {}
+            if job is not None:
+                job.check(op)
+                slot_limits = {"timeout": job.remaining(), "abort_check": job.check}
+            status = "error"
+            queued_at = time.time()
+            queue_wait = latency = None
+            try:
+                with self.scheduler.slot(user_id, cost=self.UPSTREAM_OP_COSTS.get(op, 1), kind=kind, priority=priority, batch=current_batch.get(), **slot_limits):
+                    queue_wait = time.time() - queued_at
+                    self.upstream_queue_wait.observe(queue_wait, kind=kind)
+                    span.set_attribute("queue_wait_ms", int(queue_wait * 1000))
+                    if job is not None:
+                        kwargs["timeout"] = job.timeout(kwargs.get("timeout"), op)
+                    started_at = time.time()
+                    try:
+                        if self.upstream_client is not None:
+                            # 等待期间命令被取消或超时会立即中止请求，不必等到HTTP超时
+                            abort_check = (lambda: job.check(op)) if job else None
+                            if self.hedge_policy is not None and op in self.HEDGE_OPS:
+                                response = self._hedged_post(op, url, kwargs, abort_check, span)
+                            else:
+                                response = self.upstream_client.post(url, abort_check=abort_check, **kwargs)
+                        else:
+                            response = requests.post(url, **kwargs)
+                    finally:
+                        latency = time.time() - started_at
+                        self.upstream_duration.observe(latency, op=op, model=model, route=route)
+                status = str(response.status_code)
+            except TimeoutError:
+                status = "deadline"
+                raise DeadlineExceeded(f"{op}排队")
+            except requests.exceptions.Timeout:
+                status = "timeout"
+                if job is not None:
+                    job.check(op)  # 因截止时间收缩了超时而超时，按截止处理
+                raise
+            except JobInterrupted as e:
+                status = "cancelled" if isinstance(e, JobCancelled) else "deadline"
+                raise
+            finally:
+                self.upstream_counter.inc(op=op, model=model, route=route, status=status)
+                self.traffic_capture.note_upstream(op, kind, model, status, latency, queue_wait, queued_at)
+                span.set_attribute("http.status_code", int(status) if status.isdigit() else status)
+                if status != "200":
+                    span.set_status(False, status)
+            # 请求期间用户结束了对话：丢弃结果，不再进行后续处理
+            if job is not None:
+                job.check(op)
+            return response
+
+    def _hedged_post(self, op: str, url: str, kwargs: Dict[str, Any], abort_check, span) -> requests.Response:
+        """发送可对冲的请求：超过对冲触发时间仍未返回时，在预算允许的情况下向备用目标再发一次，先成功（200）的为准"""
+        policy = self.hedge_policy
+        policy.budget.deposit()
+        sent_at = []
+        
+        def start(target_url: str, target_kwargs: Dict[str, Any]) -> Future:
+            sent_at.append(time.time())
+            return self.upstream_client.submit("POST", target_url, **target_kwargs)
+        
+        def start_hedge() -> Optional[Future]:
+            if not policy.budget.try_spend():
+                self.hedge_counter.inc(op=op, outcome="budget_exhausted")
+                return None
+            hedge_url, hedge_kwargs = self._hedge_target(url, kwargs)
+            self.hedge_counter.inc(op=op, outcome="sent")
+            span.add_event("hedge", **{"server.address": urllib.parse.urlparse(hedge_url).netloc})
+            logger.info(f"{op}请求超过 {time.time() - sent_at[0]:.1f} 秒未返回，发出对冲请求")
+            return start(hedge_url, hedge_kwargs)
+        
+        delay = policy.delay(op)
+        response, winner, hedged = race(lambda: start(url, kwargs), start_hedge, delay, lambda r: r.status_code == 200,
+                                        abort_check, self.upstream_client.poll_interval)
+        if response.status_code == 200:
+            # 对冲获胜时主请求的实际耗时未知，按已等待的时间计入（下限），避免触发时间被获胜的对冲请求拉低
+            policy.observe(op, time.time() - sent_at[0])
+        if hedged:
+            self.hedge_counter.inc(op=op, outcome="hedge_won" if winner else "primary_won")
+            span.set_attribute("hedge.winner", "hedge" if winner else "primary")
+        return response
+
+    def _hedge_target(self, url: str, kwargs: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """按 hedge_targets 轮流选择对冲请求的地址和密钥，未配置时发往原地址"""
+        if not self.hedge_targets or "/v1beta/" not in url:
+            return url, kwargs
+        target = self.hedge_targets[next(self._hedge_target_counter) % len(self.hedge_targets)]
+        base_url = target.get("base_url", "https://generativelanguage.googleapis.com").rstrip("/")
+        headers = {key: value for key, value in (kwargs.get("headers") or {}).items() if key.lower() != "authorization"}
+        params = {key: value for key, value in (kwargs.get("params") or {}).items() if key != "key"}
+        api_key = target.get("api_key") or self.api_key
+        # Google官方接口使用URL参数传递密钥，代理服务使用Bearer认证
+        if target.get("auth", "key" if "googleapis.com" in base_url else "bearer") == "key":
+            params["key"] = api_key
+        else:
+            headers["Authorization"] = f"Bearer {api_key}"
+        # 目标未单独配置代理时沿用主请求的代理
+        proxies = {"http": target["proxy"], "https": target["proxy"]} if target.get("proxy") else kwargs.get("proxies")
+        return base_url + url[url.index("/v1beta/"):], {**kwargs, "headers": headers, "params": params, "proxies": proxies}
+
     def on_handle_context(self, e_context: EventContext):
-        """处理消息事件"""
+        """处理消息事件，在当前命令的执行上下文中分发"""
         if not self.enable:
             return
         
+        context = e_context["context"]
+        # 记录当前命令所属用户，后续所有上游请求（包括提交到线程池的任务）都按该用户调度
+        user_id = self._context_user_id(context) or "__unknown__"
+        
+        # 结束对话时取消该用户仍在执行的命令
+        if context.type == ContextType.TEXT and context.content in self.exit_commands:
+            self._cancel_user_jobs(user_id)
+        
+        job = Job(user_id, is_admin=user_id in self.admins, deadline=time.time() + self.job_timeout if self.job_timeout else None)
+        with self.user_locks(user_id):
+            self.active_jobs[user_id].add(job)
+        token = current_job.set(job)
+        command = self._classify_command(context, user_id)
+        status = "error"
+        # 流量录制：命令、图片消息和结束对话命令（会改变用户状态，回放时需要），普通聊天不录制
+        recorded = bool(command) or context.type == ContextType.IMAGE or (context.type == ContextType.TEXT and context.content in self.exit_commands)
+        capture = self.traffic_capture.record(
+            context.get("session_id"), user_id, context.get("isgroup", False), context.type.name,
+            text=context.content if context.type == ContextType.TEXT else None, command=command
+        ) if recorded else contextlib.nullcontext()
+        with capture:
+            try:
+                trace = self.tracer.trace(f"command.{command}", **{"gemini.command": command, "enduser.id": user_id}) if command else contextlib.nullcontext(NOOP_SPAN)
+                with trace:
+                    self._handle_context(e_context)
+                    self._record_reply_handoff(e_context)
+                status = "ok"
+            except JobCancelled as e:
+                status = "cancelled"
+                logger.info(f"用户 {user_id} 的命令已取消 (阶段: {e})")
+                e_context["reply"] = None
+                e_context.action = EventAction.BREAK_PASS
+            except DeadlineExceeded as e:
+                status = "deadline"
+                logger.warning(f"用户 {user_id} 的命令超过截止时间 {self.job_timeout} 秒 (阶段: {e})，已停止处理")
+                e_context["reply"] = Reply(ReplyType.TEXT, "处理超时，已停止本次请求，请稍后重试")
+                e_context.action = EventAction.BREAK_PASS
+            finally:
+                current_job.reset(token)
+                if command:
+                    self.command_counter.inc(command=command, status=status)
+                    self.command_duration.observe(time.time() - job.created_at, command=command)
+                    self.profiler.record_request()
+                with self.user_locks(user_id):
+                    self.active_jobs[user_id].discard(job)
+                    if not self.active_jobs[user_id]:
+                        del self.active_jobs[user_id]
+                reply = e_context["reply"]
+                self.traffic_capture.note(status=status, reply=getattr(reply.type, "name", None) if reply else None)
+
+    def _handle_profiler_command(self, e_context: EventContext, args: str, user_id: str) -> None:
+        """处理性能采样命令
+        
+        用法：g性能分析 [秒数] 采样指定秒数（默认30秒）；g性能分析 N条 处理完N条命令后停止；g性能分析 停止
+        """
+        e_context.action = EventAction.BREAK_PASS
+        if user_id not in self.admins:
+            e_context["reply"] = Reply(ReplyType.TEXT, "仅管理员可以使用性能分析")
+            return
+        
+        if args in ("停止", "stop"):
+            stopped = self.profiler.stop()
+            e_context["reply"] = Reply(ReplyType.TEXT, "正在停止性能采样，结果稍后发送" if stopped else "当前没有进行中的性能采样")
+            return
+        
+        match = re.fullmatch(r"(\d+)?\s*(条|次)?", args)
+        if not match:
+            e_context["reply"] = Reply(ReplyType.TEXT, f"用法：{self.profiler_commands[0]} [秒数] 或 {self.profiler_commands[0]} N条")
+            return
+        count = int(match.group(1) or 30)
+        if count < 1:
+            e_context["reply"] = Reply(ReplyType.TEXT, "采样秒数或命令条数至少为1")
+            return
+        if match.group(2):
+            duration, max_requests, target = self.profiler_max_seconds, count, f"处理完 {count} 条命令"
+        else:
+            duration, max_requests, target = min(count, self.profiler_max_seconds), None, f"{min(count, self.profiler_max_seconds)} 秒"
+        
+        channel = e_context["channel"]
+        context = e_context["context"]
+        
+        def on_finish(result):
+            collapsed_path, summary_path = result.write(self.save_dir)
+            text = f"性能采样完成\n{result.summary(top=10)}\n\n火焰图数据: {collapsed_path}\n函数统计: {summary_path}"
+            self._send_reply(channel, Reply(ReplyType.TEXT, text), context)
+        
+        if not self.profiler.start(duration=duration, max_requests=max_requests, on_finish=on_finish):
+            e_context["reply"] = Reply(ReplyType.TEXT, "性能采样正在进行中")
+            return
+        logger.info(f"管理员 {user_id} 开启性能采样: {target}")
+        e_context["reply"] = Reply(ReplyType.TEXT, f"已开启性能采样，{target}后（最长 {self.profiler_max_seconds} 秒）发送结果")
+
+    def _cancel_user_jobs(self, user_id: str) -> int:
+        """取消用户正在执行的所有命令，返回取消的数量"""
+        with self.user_locks(user_id):
+            jobs = list(self.active_jobs.get(user_id, ()))
+        for job in jobs:
+            job.cancel()
+        if jobs:
+            logger.info(f"用户 {user_id} 结束对话，已取消 {len(jobs)} 个进行中的命令")
+        return len(jobs)
+
+    def _send_reply(self, channel, reply: Reply, context) -> None:
+        """通过消息通道发送中间结果，发送耗时计入追踪"""
+        self.traffic_capture.note_reply(reply.type)
+        with self.tracer.span("deliver", **{"reply.type": getattr(reply.type, "name", str(reply.type))}):
+            channel.send(reply, context)
+
+    def _record_reply_handoff(self, e_context: EventContext) -> None:
+        """最终回复由框架在插件返回后发送，无法计入发送耗时，在交给框架时记录一个发送span"""
+        reply = e_context["reply"]
+        if reply is None:
+            return
+        with self.tracer.span("deliver", **{"reply.type": getattr(reply.type, "name", str(reply.type)), "deliver.via": "framework"}):
+            pass
+
+    def _check_job(self, stage: str) -> None:
+        """检查当前命令是否已取消或超时，是则抛出异常终止后续阶段"""
+        job = current_job.get()
+        if job is not None:
+            job.check(stage)
+
+    def _job_sleep(self, seconds: float, stage: str = "重试等待") -> None:
+        """可被取消的等待，不会睡过当前命令的截止时间"""
+        job = current_job.get()
+        with self.tracer.span("backoff", stage=stage, seconds=seconds):
+            if job is None:
+                time.sleep(seconds)
+            else:
+                job.sleep(seconds, stage)
+
+    def _singleflight_call(self, flight: SingleFlight, key: str, fn, *args) -> Tuple[Any, bool]:
+        """通过合并登记表执行调用
+        
+        合并的是其他命令的调用时，对方被取消或超时不应影响本命令：此时由本命令自己重新执行一次。
+        """
+        try:
+            return flight.do_with_status(key, fn, *args)
+        except JobInterrupted:
+            self._check_job("等待合并请求")
+            logger.info("合并的请求因其他命令中断而失败，重新执行")
+            return fn(*args), False
+
+    def _handle_context(self, e_context: EventContext):
+        """处理消息事件"""
+        
         # 获取上下文
         context = e_context['context']
         
@@ -319,12 +1034,12 @@ class GeminiImage(Plugin):
             # 在群聊中，优先使用actual_user_id作为用户标识
             if is_group and hasattr(msg, 'actual_user_id') and msg.actual_user_id:
                 user_id = msg.actual_user_id
-                logger.info(f"群聊中使用actual_user_id作为用户ID: {user_id}")
+                self.event_log.info("request.user", "群聊中使用actual_user_id作为用户ID: {}", lambda: user_id, user_id=user_id)
             elif not is_group:
                 # 私聊中使用from_user_id
                 if hasattr(msg, 'from_user_id') and msg.from_user_id:
                     user_id = msg.from_user_id
-                    logger.info(f"私聊中使用from_user_id作为用户ID: {user_id}")
+                    self.event_log.info("request.user", "私聊中使用from_user_id作为用户ID: {}", lambda: user_id, user_id=user_id)
         
         if not user_id:
             logger.error("无法获取用户ID")
@@ -378,13 +1093,12 @@ class GeminiImage(Plugin):
                             try:
                                 # 发送处理中消息 (可选，但推荐)
                                 processing_reply = Reply(ReplyType.INFO, "Gemini正在分析引用的图片...")
-                                e_context["channel"].send(processing_reply, context)
+                                self._send_reply(e_context["channel"], processing_reply, context)
 
                                 analysis_result = self._analyze_image(image_data, question)
                                 if analysis_result:
                                     # 更新追问相关的状态 (如果需要，GeminiImage 已有此逻辑)
-                                    self.last_analysis_image[user_id] = image_data
-                                    self.last_analysis_time[user_id] = time.time()
+                                    self._start_analysis_session(user_id, image_data, question, analysis_result)
                                     analysis_result += "\n💬3min内输入g追问+问题，可继续追问" # 与现有逻辑保持一致
                                     reply = Reply(ReplyType.TEXT, analysis_result)
                                 else:
@@ -420,7 +1134,7 @@ class GeminiImage(Plugin):
                             try:
                                 # 发送处理中消息 (可选)
                                 processing_reply = Reply(ReplyType.INFO, "Gemini正在反推引用的图片...")
-                                e_context["channel"].send(processing_reply, context)
+                                self._send_reply(e_context["channel"], processing_reply, context)
 
                                 reverse_result = self._reverse_image(image_data) # _reverse_image 内部有默认prompt
                                 if reverse_result:
@@ -468,14 +1182,13 @@ class GeminiImage(Plugin):
                                 # Ensure base64 is imported at the top of the file.
                                 # If not, this line will cause an error.
                                 # Consider adding 'import base64' if it's missing from the file's imports.
-                                image_base64_str = base64.b64encode(image_data_bytes).decode('utf-8')
-
                                 processing_reply = Reply(ReplyType.INFO, f'Gemini正在对引用的图片进行编辑...')
-                                e_context["channel"].send(processing_reply, context)
+                                self._send_reply(e_context["channel"], processing_reply, context)
 
                                 # _handle_reference_image_edit is expected to handle API calls,
                                 # errors, and setting the final reply on e_context.
-                                self._handle_reference_image_edit(e_context, user_id, prompt_for_ref_edit, image_base64_str)
+                                # Raw bytes are passed directly, so no base64 round-trip is needed.
+                                self._handle_reference_image_edit(e_context, user_id, prompt_for_ref_edit, None, image_data=image_data_bytes)
                             
                             except ImportError:
                                 logger.critical(f"[{self.name}] CRITICAL ERROR: base64 module not imported. Cannot process referenced image edit for '{ref_cmd}'.")
@@ -496,6 +1209,22 @@ class GeminiImage(Plugin):
                             e_context.action = EventAction.BREAK_PASS
                             return # Important: End processing here
         # --- END: New logic for handling referenced images ---        
+        # 查看运行指标（仅管理员）
+        if content in self.metrics_commands:
+            if user_id not in self.admins:
+                reply = Reply(ReplyType.TEXT, "仅管理员可以查看运行指标")
+            else:
+                reply = Reply(ReplyType.TEXT, "GeminiImage运行指标：\n" + (self.metrics.render_summary() or "暂无数据"))
+            e_context["reply"] = reply
+            e_context.action = EventAction.BREAK_PASS
+            return
+        
+        # 性能采样（仅管理员）
+        for cmd in self.profiler_commands:
+            if content.startswith(cmd):
+                self._handle_profiler_command(e_context, content[len(cmd):].strip(), user_id)
+                return
+        
         # 检查是否是打印模型命令
         for cmd in self.print_model_commands:
             if content == cmd:
@@ -603,6 +1332,7 @@ class GeminiImage(Plugin):
                     # 清理状态
                     del self.last_analysis_image[user_id]
                     del self.last_analysis_time[user_id]
+                    self.analysis_sessions.pop(user_id, None)
                     
                     reply = Reply(ReplyType.TEXT, "追问超时，请重新使用识图功能")
                     e_context["reply"] = reply
@@ -615,11 +1345,15 @@ class GeminiImage(Plugin):
                 question = question + "，请用简洁的中文进行回答。"
                 
                 try:
-                    # 调用API分析图片
-                    analysis_result = self._analyze_image(self.last_analysis_image[user_id], question)
+                    # 调用API分析图片，携带本次识图会话中此前的问答，模型无需重新推导已回答过的内容
+                    with self.user_locks(user_id):
+                        session = self.analysis_sessions.get(user_id)
+                        history = list(session["turns"]) if session else None
+                    analysis_result = self._analyze_image(self.last_analysis_image[user_id], question, use_context_cache=True, history=history)
                     if analysis_result:
                         # 更新时间戳
                         self.last_analysis_time[user_id] = time.time()
+                        self._append_analysis_turns(user_id, question, analysis_result)
                         
                         # 添加追问提示
                         analysis_result += "\n💬3min内输入g追问+问题，可继续追问"
@@ -656,7 +1390,7 @@ class GeminiImage(Plugin):
                 try:
                     # 发送处理中消息
                     processing_reply = Reply(ReplyType.TEXT, f"正在使用{self.expand_model}扩写提示词...")
-                    e_context["channel"].send(processing_reply, e_context["context"])
+                    self._send_reply(e_context["channel"], processing_reply, e_context["context"])
                     
                     # 调用API进行提示词扩写
                     response = self._expand_prompt(prompt)
@@ -701,32 +1435,22 @@ class GeminiImage(Plugin):
                 try:
                     # 发送处理中消息
                     processing_reply = Reply(ReplyType.TEXT, f"正在调用{self.chat_model}回答您的问题...")
-                    e_context["channel"].send(processing_reply, e_context["context"])
+                    self._send_reply(e_context["channel"], processing_reply, e_context["context"])
                     
                     # 获取会话历史
-                    conversation_history = self.conversations[conversation_key]
+                    chat_session = self._get_chat_session(conversation_key)
                     
                     # 翻译提示词
                     translated_prompt = self._translate_prompt(prompt, user_id)
                     
                     # 调用API进行对话
-                    response = self._chat_with_gemini(translated_prompt, conversation_history)
+                    response = self._chat_with_gemini(translated_prompt, chat_session["messages"])
                     
                     if response:
-                        # 添加用户提示到会话
-                        user_message = {"role": "user", "parts": [{"text": prompt}]}
-                        conversation_history.append(user_message)
-                        
-                        # 添加助手回复到会话
-                        assistant_message = {
-                            "role": "model", 
-                            "parts": [{"text": response}]
-                        }
-                        conversation_history.append(assistant_message)
-                        
-                        # 限制会话历史长度
-                        if len(conversation_history) > 10:  # 保留最近5轮对话
-                            conversation_history = conversation_history[-10:]
+                        # 添加本轮问答到会话，超出token预算时淘汰最早的轮次
+                        self._append_chat_message(conversation_key, "user", [{"text": prompt}])
+                        self._append_chat_message(conversation_key, "model", [{"text": response}])
+                        self._trim_chat_session(conversation_key)
                         
                         # 更新会话时间戳
                         self.last_conversation_time[conversation_key] = time.time()
@@ -778,9 +1502,8 @@ class GeminiImage(Plugin):
                 prompt = self.waiting_for_reference_image[user_id]
                 
                 # 清除等待状态
-                del self.waiting_for_reference_image[user_id]
-                if user_id in self.waiting_for_reference_image_time:
-                    del self.waiting_for_reference_image_time[user_id]
+                self.waiting_for_reference_image.pop(user_id, None)
+                self.waiting_for_reference_image_time.pop(user_id, None)
                 
                 # 发送超时提示
                 reply = Reply(ReplyType.TEXT, f"等待上传参考图片超时（超过{self.reference_image_wait_timeout//60}分钟），已自动取消操作。如需继续，请重新发送参考图编辑命令。")
@@ -816,16 +1539,18 @@ class GeminiImage(Plugin):
             
             # 如果成功获取到图片数据
             if image_base64:
-                # 清除等待状态
-                del self.waiting_for_reference_image[user_id]
-                if user_id in self.waiting_for_reference_image_time:
-                    del self.waiting_for_reference_image_time[user_id]
+                # 原子地认领等待状态，多进程部署时同一张图片只会被一个进程处理
+                if self.waiting_for_reference_image.pop(user_id, None) is None:
+                    logger.info(f"用户 {user_id} 的参考图等待状态已被其他进程处理")
+                    e_context.action = EventAction.BREAK_PASS
+                    return
+                self.waiting_for_reference_image_time.pop(user_id, None)
                 
                 # 发送成功获取图片的提示
                 success_reply = Reply(ReplyType.TEXT, "成功获取图片，正在处理中...")
                 e_context["reply"] = success_reply
                 e_context.action = EventAction.BREAK_PASS
-                e_context["channel"].send(success_reply, e_context["context"])
+                self._send_reply(e_context["channel"], success_reply, e_context["context"])
                 
                 # 处理参考图片编辑
                 self._handle_reference_image_edit(e_context, user_id, prompt, image_base64)
@@ -839,21 +1564,21 @@ class GeminiImage(Plugin):
         
         # 检查是否是结束对话命令
         if content in self.exit_commands:
-            if conversation_key in self.conversations:
+            if conversation_key in self.conversations or conversation_key in self.chat_sessions:
                 # 清除会话数据
-                del self.conversations[conversation_key]
-                if conversation_key in self.last_conversation_time:
-                    del self.last_conversation_time[conversation_key]
-                if conversation_key in self.last_images:
-                    del self.last_images[conversation_key]
+                with self.user_locks(conversation_key):
+                    self.conversations.pop(conversation_key, None)
+                    self.chat_sessions.pop(conversation_key, None)
+                    self.last_conversation_time.pop(conversation_key, None)
+                    self.last_images.pop(conversation_key, None)
                 
                 reply = Reply(ReplyType.TEXT, "已结束Gemini图像生成对话，下次需要时请使用命令重新开始")
-                e_context["channel"].send(reply, e_context["context"])
+                self._send_reply(e_context["channel"], reply, e_context["context"])
                 e_context.action = EventAction.BREAK_PASS
             else:
                 # 没有活跃会话
                 reply = Reply(ReplyType.TEXT, "您当前没有活跃的Gemini图像生成对话")
-                e_context["channel"].send(reply, e_context["context"])
+                self._send_reply(e_context["channel"], reply, e_context["context"])
                 e_context.action = EventAction.BREAK_PASS
             return
 
@@ -864,22 +1589,28 @@ class GeminiImage(Plugin):
                 prompt = content[len(cmd):].strip()
                 if not prompt:
                     reply = Reply(ReplyType.TEXT, f"请提供描述内容，格式：{cmd} [描述]")
-                    e_context["channel"].send(reply, e_context["context"])
+                    self._send_reply(e_context["channel"], reply, e_context["context"])
                     e_context.action = EventAction.BREAK_PASS
                     return
                 
                 # 检查API密钥是否配置
                 if not self.api_key:
                     reply = Reply(ReplyType.TEXT, "请先在配置文件中设置Gemini API密钥")
-                    e_context["channel"].send(reply, e_context["context"])
+                    self._send_reply(e_context["channel"], reply, e_context["context"])
                     e_context.action = EventAction.BREAK_PASS
                     return
                 
+                # 检查是否要求一次生成多张图片，例如：g画图 -n 3 一只猫
+                variant_count, prompt = self._parse_variant_count(prompt)
+                if variant_count > 1:
+                    self._handle_generate_variants(e_context, conversation_key, user_id, prompt, variant_count)
+                    return
+                
                 # 尝试生成图片
                 try:
                     # 发送处理中消息
                     processing_reply = Reply(ReplyType.TEXT, "正在调用gemini生成图片，请稍候...")
-                    e_context["channel"].send(processing_reply, e_context["context"])
+                    self._send_reply(e_context["channel"], processing_reply, e_context["context"])
                     
                     # 初始化会话状态
                     if conversation_key not in self.conversations:
@@ -894,7 +1625,7 @@ class GeminiImage(Plugin):
                     translated_prompt = self._translate_prompt(prompt, user_id)
                     
                     # 生成图片
-                    image_datas, text_responses = self._generate_image(prompt, conversation_history)
+                    image_datas, text_responses = self._generate_image(prompt, conversation_history, user_id=conversation_key)
 
                     
                     if image_datas:
@@ -950,11 +1681,14 @@ class GeminiImage(Plugin):
                             # 更新会话时间戳
                             self.last_conversation_time[conversation_key] = time.time()
                             
+                            # 会话过长时在后台压缩较早的轮次
+                            self._maybe_schedule_summary(conversation_key)
+                            
                             # 先发送文本消息
                             has_sent_text = False
                             for i, (text_response, image_data) in enumerate(zip(text_responses, image_datas)):
                                 if text_response:  # 如果有文本，先发送文本
-                                    e_context["channel"].send(Reply(ReplyType.TEXT, text_response), e_context["context"])
+                                    self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, text_response), e_context["context"])
                                     has_sent_text = True  # 标记已发送文本
                                 
                                 if image_data:  # 如果有图片，再发送图片
@@ -965,7 +1699,7 @@ class GeminiImage(Plugin):
                                     
                                     # 单独发送每张图片
                                     image_file = open(temp_image_path, "rb")
-                                    e_context["channel"].send(Reply(ReplyType.IMAGE, image_file), e_context["context"])
+                                    self._send_reply(e_context["channel"], Reply(ReplyType.IMAGE, image_file), e_context["context"])
                             
                             # 如果已经发送了文本，则不再重复发送
                             if not has_sent_text:
@@ -975,7 +1709,7 @@ class GeminiImage(Plugin):
                                     if valid_responses:
                                         translated_responses = [self._translate_gemini_message(text) for text in valid_responses]
                                         reply_text = "\n".join([resp for resp in translated_responses if resp])
-                                        e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                                        self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                                 else:
                                     # 检查是否有文本响应，可能是内容被拒绝
                                     if text_responses and any(text is not None for text in text_responses):
@@ -985,9 +1719,9 @@ class GeminiImage(Plugin):
                                             # 内容审核拒绝的情况，翻译并发送拒绝消息
                                             translated_responses = [self._translate_gemini_message(text) for text in valid_responses]
                                             reply_text = "\n".join([resp for resp in translated_responses if resp])
-                                            e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                                            self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                                         else:
-                                            e_context["channel"].send(Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
+                                            self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
                             # 确保只设置一次action
                             e_context.action = EventAction.BREAK_PASS
                     else:
@@ -999,19 +1733,19 @@ class GeminiImage(Plugin):
                                 # 内容审核拒绝的情况，翻译并发送拒绝消息
                                 translated_responses = [self._translate_gemini_message(text) for text in valid_responses]
                                 reply_text = "\n".join([resp for resp in translated_responses if resp])
-                                e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                                self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                             else:
-                                e_context["channel"].send(Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
+                                self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
                             e_context.action = EventAction.BREAK_PASS
                         else:
                             # 没有有效的文本响应或图片，返回一个通用错误消息并中断处理
-                            e_context["channel"].send(Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
+                            self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, "图片生成失败，请稍后再试或修改提示词"), e_context["context"])
                             e_context.action = EventAction.BREAK_PASS
                 except Exception as e:
                     logger.error(f"生成图片失败: {str(e)}")
                     logger.exception(e)
                     reply_text = f"生成图片失败: {str(e)}"
-                    e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                    self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                     # 确保在异常情况下也设置正确的action，防止命令继续传递
                     e_context.action = EventAction.BREAK_PASS
                 return
@@ -1065,11 +1799,13 @@ class GeminiImage(Plugin):
                             conversation_history = self.conversations[conversation_key]["messages"]
 
 
-                        # 翻译提示词
-                        translated_prompt = self._translate_prompt(prompt, user_id)
+                        # 翻译提示词与图片预处理并行执行
+                        translate_future = self._submit_prep(self._prepare_prompt, prompt, user_id)
+                        prepared_image = self._prepare_edit_image(image_data, "图片编辑")
+                        translated_prompt = translate_future.result()
                         
                         # 编辑图片
-                        result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history)
+                        result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history, prepared_image, user_id=conversation_key)
                         
                         if result_image:
                             # 保存编辑后的图片
@@ -1109,13 +1845,16 @@ class GeminiImage(Plugin):
                             # 更新会话时间戳
                             self.last_conversation_time[conversation_key] = time.time()
                             
+                            # 会话过长时在后台压缩较早的轮次
+                            self._maybe_schedule_summary(conversation_key)
+                            
                             # 准备回复文本
                             reply_text = text_response if text_response else "图片编辑成功！"
                             if not conversation_history or len(conversation_history) <= 2:  # 如果是新会话
                                 reply_text += f"（已开始图像对话，可以继续发送命令修改图片。需要结束时请发送\"{self.exit_commands[0]}\"）"
                             
                             # 先发送文本消息
-                            e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                            self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                             
                             # 创建文件对象，由框架负责关闭
                             image_file = open(image_path, "rb")
@@ -1171,11 +1910,13 @@ class GeminiImage(Plugin):
                                     self.conversations[conversation_key] = {"messages": [], "conversation_id": ""}
                                     conversation_history = self.conversations[conversation_key]["messages"]
 
-                                # 翻译提示词
-                                translated_prompt = self._translate_prompt(prompt, user_id)
+                                # 翻译提示词与图片预处理并行执行
+                                translate_future = self._submit_prep(self._prepare_prompt, prompt, user_id)
+                                prepared_image = self._prepare_edit_image(image_data, "图片编辑")
+                                translated_prompt = translate_future.result()
                                 
                                 # 编辑图片
-                                result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history)
+                                result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history, prepared_image, user_id=conversation_key)
                                 
                                 if result_image:
                                     # 保存编辑后的图片
@@ -1213,13 +1954,16 @@ class GeminiImage(Plugin):
                                     # 更新会话时间戳
                                     self.last_conversation_time[conversation_key] = time.time()
                                     
+                                    # 会话过长时在后台压缩较早的轮次
+                                    self._maybe_schedule_summary(conversation_key)
+                                    
                                     # 准备回复文本
                                     reply_text = text_response if text_response else "图片编辑成功！"
                                     if not conversation_history or len(conversation_history) <= 2:  # 如果是新会话
                                         reply_text += f"（已开始图像对话，可以继续发送命令修改图片。需要结束时请发送\"{self.exit_commands[0]}\"）"
                                     
                                     # 先发送文本消息
-                                    e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                                    self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                                     
                                     # 创建文件对象，由框架负责关闭
                                     image_file = open(image_path, "rb")
@@ -1309,19 +2053,136 @@ class GeminiImage(Plugin):
                     e_context.action = EventAction.BREAK_PASS
                     return
                 
-                # 记录用户正在等待上传融图的第一张图片
-                self.waiting_for_merge_image[user_id] = prompt
-                self.waiting_for_merge_image_time[user_id] = time.time()
+                # 记录用户正在等待上传融图图片；提示词原样保存（含 -n 参数），每张图片到达时重新解析所需张数
+                image_count, _ = self._parse_merge_count(prompt)
+                with self.user_locks(user_id):
+                    self.merge_images.pop(user_id, None)
+                    self._discard_merge_ingest(user_id)
+                    self.waiting_for_merge_image[user_id] = prompt
+                    self.waiting_for_merge_image_time[user_id] = time.time()
                 
                 # 记录日志
-                logger.info(f"用户 {user_id} 开始等待上传融图的第一张图片，提示词: {prompt}")
+                logger.info(f"用户 {user_id} 开始等待上传融图的 {image_count} 张图片，提示词: {prompt}")
                 
                 # 发送提示消息
-                reply = Reply(ReplyType.TEXT, "请发送需要gemini融图的第一张图片")
+                if image_count == 2:
+                    reply = Reply(ReplyType.TEXT, "请发送需要gemini融图的第一张图片")
+                else:
+                    reply = Reply(ReplyType.TEXT, f"请依次发送需要gemini融图的{image_count}张图片")
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS
                 return
 
+    def _parse_merge_count(self, prompt: str) -> Tuple[int, str]:
+        """解析融图提示词开头的图片数量参数（-n 3），默认2张，返回数量和去掉参数后的提示词"""
+        match = re.match(r"^-n\s*(\d+)\s+(.+)$", prompt, re.S)
+        if not match:
+            return 2, prompt
+        image_count = max(2, min(int(match.group(1)), self.merge_max_images))
+        return image_count, match.group(2).strip()
+
+    def _parse_variant_count(self, prompt: str) -> Tuple[int, str]:
+        """解析提示词开头的变体数量参数（-n 3 或 -n3），返回数量和去掉参数后的提示词"""
+        match = re.match(r"^-n\s*(\d+)\s+(.+)$", prompt, re.S)
+        if not match:
+            return 1, prompt
+        variant_count = max(1, min(int(match.group(1)), self.max_variants))
+        return variant_count, match.group(2).strip()
+
+    def _handle_generate_variants(self, e_context: EventContext, conversation_key: str, user_id: str, prompt: str, variant_count: int) -> None:
+        """
+        并发生成同一提示词的多张图片，每完成一张立即发送
+        
+        Args:
+            e_context: 事件上下文
+            conversation_key: 会话标识
+            user_id: 用户ID
+            prompt: 提示词
+            variant_count: 生成的图片数量
+        """
+        channel = e_context["channel"]
+        context = e_context["context"]
+        e_context.action = EventAction.BREAK_PASS
+        
+        try:
+            self._send_reply(channel, Reply(ReplyType.TEXT, f"正在调用gemini并行生成{variant_count}张图片，请稍候..."), context)
+            
+            translated_prompt = self._prepare_prompt(prompt, user_id)
+            
+            # 每个变体都是独立的一次生成，不携带会话历史，也不参与请求合并；同一命令的变体合计只占用一个用户并发名额
+            ctx = contextvars.copy_context()
+            ctx.run(current_batch.set, object())
+            futures = {
+                self.variant_executor.submit(ctx.copy().run, self._request_image_generation, translated_prompt, None): index
+                for index in range(variant_count)
+            }
+            
+            image_paths = []
+            first_text = None
+            failed_texts = []
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                    self._check_job("发送结果")
+                except JobInterrupted:
+                    # 命令已取消或超时：撤销尚未开始的变体，正在执行的变体会在各自的检查点退出
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                except Exception as e:
+                    logger.error(f"生成第{futures[future] + 1}张变体图片失败: {str(e)}")
+                    continue
+                
+                image_datas = result[0] or []
+                text_responses = result[1] or []
+                if len(result) > 2 and result[2]:
+                    failed_texts.append(result[2])
+                
+                valid_texts = [text for text in text_responses if text]
+                valid_images = [image for image in image_datas if image]
+                if not valid_images:
+                    failed_texts.extend(valid_texts)
+                    continue
+                
+                for image_data in valid_images:
+                    image_path = os.path.join(self.save_dir, f"gemini_{int(time.time())}_{uuid.uuid4().hex[:8]}_variant_{len(image_paths) + 1}.png")
+                    with open(image_path, "wb") as f:
+                        f.write(image_data)
+                    image_paths.append(image_path)
+                    
+                    # 完成一张发送一张，不等待其他变体
+                    label = f"第{len(image_paths)}/{variant_count}张"
+                    if valid_texts and first_text is None:
+                        first_text = valid_texts[0]
+                    self._send_reply(channel, Reply(ReplyType.TEXT, f"{label}：{valid_texts[0]}" if valid_texts else label), context)
+                    self._send_reply(channel, Reply(ReplyType.IMAGE, open(image_path, "rb")), context)
+            
+            if not image_paths:
+                if failed_texts:
+                    reply_text = "\n".join(dict.fromkeys(self._translate_gemini_message(text) for text in failed_texts))
+                else:
+                    reply_text = "图片生成失败，请稍后再试或修改提示词"
+                self._send_reply(channel, Reply(ReplyType.TEXT, reply_text), context)
+                return
+            
+            # 合并为一次会话记录，后续编辑默认使用第一张图片
+            self.last_images[conversation_key] = image_paths
+            self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_GENERATE, False)
+            self._add_message_to_conversation(conversation_key, "user", [{"text": prompt}])
+            self._add_message_to_conversation(conversation_key, "model", [
+                {"text": first_text if first_text else "图片生成成功！"},
+                {"image_url": image_paths[0]}
+            ])
+            
+            summary = f"已完成{len(image_paths)}/{variant_count}张图片的生成"
+            if len(image_paths) < variant_count:
+                summary += "，部分图片生成失败"
+            self._send_reply(channel, Reply(ReplyType.TEXT, summary), context)
+        except Exception as e:
+            logger.error(f"批量生成图片失败: {str(e)}")
+            logger.exception(e)
+            self._send_reply(channel, Reply(ReplyType.TEXT, f"生成图片失败: {str(e)}"), context)
+
     def _handle_image_message(self, e_context: EventContext):
         """处理图片消息，缓存图片数据以备后续编辑使用"""
         context = e_context['context']
@@ -1342,12 +2203,12 @@ class GeminiImage(Plugin):
             # 在群聊中，优先使用actual_user_id作为用户标识
             if is_group and hasattr(msg_obj, 'actual_user_id') and msg_obj.actual_user_id:
                 sender_id = msg_obj.actual_user_id
-                logger.info(f"群聊中使用actual_user_id作为发送者ID: {sender_id}")
+                self.event_log.info("request.user", "群聊中使用actual_user_id作为发送者ID: {}", lambda: sender_id, user_id=sender_id)
             elif not is_group:
                 # 私聊中使用from_user_id或session_id
                 if hasattr(msg_obj, 'from_user_id') and msg_obj.from_user_id:
                     sender_id = msg_obj.from_user_id
-                    logger.info(f"私聊中使用from_user_id作为发送者ID: {sender_id}")
+                    self.event_log.info("request.user", "私聊中使用from_user_id作为发送者ID: {}", lambda: sender_id, user_id=sender_id)
                 else:
                     sender_id = session_id # Fallback to session_id if from_user_id is not specific
                     logger.info(f"私聊中使用session_id作为发送者ID: {sender_id}")
@@ -1362,20 +2223,15 @@ class GeminiImage(Plugin):
         if image_data and len(image_data) > 1000:  # 确保数据大小合理 (e.g. > 1KB)
             try:
                 # 验证是否为有效的图片数据
-                Image.open(BytesIO(image_data))
+                image = Image.open(BytesIO(image_data))
+                self.traffic_capture.note_image(image_data, image.size, image.format)
                 
                 # 保存图片到缓存 - 使用多个键增加找到图片的机会
-                self.image_cache[session_id] = {
-                    "content": image_data,
-                    "timestamp": time.time()
-                }
+                self._put_image_cache(session_id, image_data)
                 
                 # 如果sender_id存在且与session_id不同，也用sender_id缓存
                 if sender_id and sender_id != session_id:
-                    self.image_cache[sender_id] = {
-                        "content": image_data,
-                        "timestamp": time.time()
-                    }
+                    self._put_image_cache(sender_id, image_data)
                 
                 # 修复日志记录格式    
                 log_message = f"成功缓存图片数据，大小: {len(image_data)} 字节，缓存键: {session_id}"
@@ -1384,34 +2240,31 @@ class GeminiImage(Plugin):
                 logger.info(log_message)
                 
                 # 检查是否有用户在等待上传参考图片
-                if sender_id and sender_id in self.waiting_for_reference_image:
-                    prompt = self.waiting_for_reference_image[sender_id]
+                # 原子地认领等待状态（取出并清除），多进程部署时只有一个进程能拿到提示词
+                reference_prompt = self.waiting_for_reference_image.pop(sender_id, None) if sender_id else None
+                if reference_prompt is not None:
+                    prompt = reference_prompt
                     logger.info(f"检测到用户 {sender_id} 正在等待上传参考图片，提示词: {prompt}")
                     
-                    # 将图片转换为base64
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
-                    
                     # 清除等待状态
-                    del self.waiting_for_reference_image[sender_id]
-                    if sender_id in self.waiting_for_reference_image_time:
-                        del self.waiting_for_reference_image_time[sender_id]
+                    self.waiting_for_reference_image_time.pop(sender_id, None)
                     
                     # 直接发送成功获取图片的提示
                     processing_reply = Reply(ReplyType.TEXT, "成功获取图片，正在处理中...")
                     e_context["reply"] = processing_reply
                     e_context.action = EventAction.BREAK_PASS
-                    e_context["channel"].send(processing_reply, e_context["context"])
+                    self._send_reply(e_context["channel"], processing_reply, e_context["context"])
                     
-                    # 处理参考图片编辑
-                    self._handle_reference_image_edit(e_context, sender_id, prompt, image_base64)
+                    # 处理参考图片编辑，直接传入图片数据，避免base64编码后再解码
+                    self._handle_reference_image_edit(e_context, sender_id, prompt, None, image_data=image_data)
                     return
                 # 检查是否有用户在等待反推提示词
                 elif sender_id and sender_id in self.waiting_for_reverse_image:
-                    # 检查是否超时
-                    if time.time() - self.waiting_for_reverse_image_time[sender_id] > self.reverse_image_wait_timeout:
+                    # 检查是否超时；共享状态后端中时间戳可能已被其他进程取走或过期，缺失时按超时处理
+                    if time.time() - self.waiting_for_reverse_image_time.get(sender_id, 0) > self.reverse_image_wait_timeout:
                         # 清理状态
-                        del self.waiting_for_reverse_image[sender_id]
-                        del self.waiting_for_reverse_image_time[sender_id]
+                        self.waiting_for_reverse_image.pop(sender_id, None)
+                        self.waiting_for_reverse_image_time.pop(sender_id, None)
                         
                         reply = Reply(ReplyType.TEXT, "图片上传超时，请重新发送反推提示词命令")
                         e_context["reply"] = reply
@@ -1436,8 +2289,8 @@ class GeminiImage(Plugin):
                             reply = Reply(ReplyType.TEXT, "图片分析失败，请稍后重试")
                         
                         # 清理状态
-                        del self.waiting_for_reverse_image[sender_id]
-                        del self.waiting_for_reverse_image_time[sender_id]
+                        self.waiting_for_reverse_image.pop(sender_id, None)
+                        self.waiting_for_reverse_image_time.pop(sender_id, None)
                         
                         e_context["reply"] = reply
                         e_context.action = EventAction.BREAK_PASS
@@ -1447,8 +2300,8 @@ class GeminiImage(Plugin):
                         logger.exception(e)
                         
                         # 清理状态
-                        del self.waiting_for_reverse_image[sender_id]
-                        del self.waiting_for_reverse_image_time[sender_id]
+                        self.waiting_for_reverse_image.pop(sender_id, None)
+                        self.waiting_for_reverse_image_time.pop(sender_id, None)
                         
                         reply = Reply(ReplyType.TEXT, f"图片分析失败: {str(e)}")
                         e_context["reply"] = reply
@@ -1456,11 +2309,11 @@ class GeminiImage(Plugin):
                         return
                 # 检查是否有用户在等待识图
                 elif sender_id and sender_id in self.waiting_for_analysis_image:
-                    # 检查是否超时
-                    if time.time() - self.waiting_for_analysis_image_time[sender_id] > self.analysis_image_wait_timeout:
+                    # 检查是否超时；共享状态后端中时间戳可能已被其他进程取走或过期，缺失时按超时处理
+                    if time.time() - self.waiting_for_analysis_image_time.get(sender_id, 0) > self.analysis_image_wait_timeout:
                         # 清理状态
-                        del self.waiting_for_analysis_image[sender_id]
-                        del self.waiting_for_analysis_image_time[sender_id]
+                        self.waiting_for_analysis_image.pop(sender_id, None)
+                        self.waiting_for_analysis_image_time.pop(sender_id, None)
                         
                         reply = Reply(ReplyType.TEXT, "图片上传超时，请重新发送识图命令")
                         e_context["reply"] = reply
@@ -1481,8 +2334,7 @@ class GeminiImage(Plugin):
                             else:
                                 # 这是成功的API响应
                                 logger.info(f"识图成功，结果长度: {len(analysis_result)}")
-                                self.last_analysis_image[sender_id] = image_data
-                                self.last_analysis_time[sender_id] = time.time()
+                                self._start_analysis_session(sender_id, image_data, question, analysis_result)
                                 analysis_result += "\n💬3min内输入g追问+问题，可继续追问"
                                 reply = Reply(ReplyType.TEXT, analysis_result)
                         else:
@@ -1491,8 +2343,8 @@ class GeminiImage(Plugin):
                             reply = Reply(ReplyType.TEXT, "图片分析失败，请稍后重试。")
                         
                         # 清理状态
-                        del self.waiting_for_analysis_image[sender_id]
-                        del self.waiting_for_analysis_image_time[sender_id]
+                        self.waiting_for_analysis_image.pop(sender_id, None)
+                        self.waiting_for_analysis_image_time.pop(sender_id, None)
                         
                         e_context["reply"] = reply
                         e_context.action = EventAction.BREAK_PASS
@@ -1502,8 +2354,8 @@ class GeminiImage(Plugin):
                         logger.exception(e)
                         
                         # 清理状态
-                        del self.waiting_for_analysis_image[sender_id]
-                        del self.waiting_for_analysis_image_time[sender_id]
+                        self.waiting_for_analysis_image.pop(sender_id, None)
+                        self.waiting_for_analysis_image_time.pop(sender_id, None)
                         
                         reply = Reply(ReplyType.TEXT, f"图片分析失败: {str(e)}")
                         e_context["reply"] = reply
@@ -1511,51 +2363,54 @@ class GeminiImage(Plugin):
                         return
                 # 检查是否有用户在等待上传融图图片
                 elif sender_id and sender_id in self.waiting_for_merge_image:
-                    # 检查是否超时
-                    if time.time() - self.waiting_for_merge_image_time[sender_id] > self.merge_image_wait_timeout:
+                    # 检查是否超时；共享状态后端中时间戳可能已被其他进程取走或过期，缺失时按超时处理
+                    if time.time() - self.waiting_for_merge_image_time.get(sender_id, 0) > self.merge_image_wait_timeout:
                         # 清理状态
-                        del self.waiting_for_merge_image[sender_id]
-                        del self.waiting_for_merge_image_time[sender_id]
-                        if sender_id in self.merge_first_image:
-                            del self.merge_first_image[sender_id]
+                        self.waiting_for_merge_image.pop(sender_id, None)
+                        self.waiting_for_merge_image_time.pop(sender_id, None)
+                        self.merge_images.pop(sender_id, None)
+                        self._discard_merge_ingest(sender_id)
                         
                         reply = Reply(ReplyType.TEXT, "图片上传超时，请重新发送融图命令")
                         e_context["reply"] = reply
                         e_context.action = EventAction.BREAK_PASS
                         return
                     
-                    # 将图片转换为base64
-                    image_base64 = base64.b64encode(image_data).decode('utf-8')
+                    image_count, _ = self._parse_merge_count(self.waiting_for_merge_image.get(sender_id) or "")
                     
-                    # 检查是否是第一张图片
-                    if sender_id not in self.merge_first_image:
-                        # 保存第一张图片
-                        self.merge_first_image[sender_id] = image_base64
-                        logger.info(f"接收到融图第一张图片，用户ID: {sender_id}, 图片大小: {len(image_data)} 字节")
-                        
-                        # 发送成功获取第一张图片的提示
-                        success_reply = Reply(ReplyType.TEXT, "成功获取第一张图片，请发送第二张图片")
+                    # 立即在后台开始这张图片的校验/压缩/编码，最后一张图片到达时前面的图片已准备好
+                    images = self._add_merge_image(sender_id, image_data, image_count)
+                    if images is None:
+                        logger.info(f"用户 {sender_id} 的融图等待状态已被其他请求处理")
+                        e_context.action = EventAction.BREAK_PASS
+                        return
+                    logger.info(f"接收到融图第{len(images)}/{image_count}张图片，用户ID: {sender_id}, 图片大小: {len(image_data)} 字节")
+                    
+                    if len(images) < image_count:
+                        if image_count == 2:
+                            success_reply = Reply(ReplyType.TEXT, "成功获取第一张图片，请发送第二张图片")
+                        else:
+                            success_reply = Reply(ReplyType.TEXT, f"成功获取第{len(images)}张图片，请发送第{len(images) + 1}张图片（共{image_count}张）")
                         e_context["reply"] = success_reply
                         e_context.action = EventAction.BREAK_PASS
                         return
-                    else:
-                        # 已有第一张图片，这是第二张图片
-                        first_image_base64 = self.merge_first_image[sender_id]
-                        prompt = self.waiting_for_merge_image[sender_id]
-                        logger.info(f"接收到融图第二张图片，用户ID: {sender_id}, 图片大小: {len(image_data)} 字节，提示词: {prompt}")
-                        
-                        # 清除等待状态
-                        del self.waiting_for_merge_image[sender_id]
-                        del self.waiting_for_merge_image_time[sender_id]
-                        del self.merge_first_image[sender_id]
-                        
-                        # 删除成功获取图片的提示消息，直接进行处理
-                        # 设置事件状态，但不发送消息
+                    
+                    # 图片已齐，原子地认领图片列表、提示词和预处理结果，同时到达的图片只有一张会触发融图
+                    images, prompt, ingest = self._claim_merge_images(sender_id)
+                    if images is None or prompt is None:
+                        logger.info(f"用户 {sender_id} 的融图等待状态已被其他请求处理")
                         e_context.action = EventAction.BREAK_PASS
-                        
-                        # 处理融图
-                        self._handle_merge_images(e_context, sender_id, prompt, first_image_base64, image_base64)
                         return
+                    _, prompt = self._parse_merge_count(prompt)
+                    logger.info(f"融图图片已齐，用户ID: {sender_id}, 共 {len(images[:image_count])} 张，提示词: {prompt}")
+                    
+                    # 删除成功获取图片的提示消息，直接进行处理
+                    # 设置事件状态，但不发送消息
+                    e_context.action = EventAction.BREAK_PASS
+                    
+                    # 处理融图
+                    self._handle_merge_images(e_context, sender_id, prompt, images[:image_count], ingest)
+                    return
                 else:
                     logger.info(f"已缓存图片，但用户 {sender_id} 没有等待中的图片操作")
             except Exception as img_err:
@@ -1581,7 +2436,7 @@ class GeminiImage(Plugin):
         Returns:
             Optional[bytes]: 图片数据或None
         """
-        logger.info(f"尝试获取会话 {conversation_key} 的最近图片")
+        logger.debug(f"尝试获取会话 {conversation_key} 的最近图片")
         
         # 尝试直接从缓存获取
         if conversation_key in self.image_cache:
@@ -1590,18 +2445,12 @@ class GeminiImage(Plugin):
                 logger.info(f"成功从缓存直接获取图片数据，大小: {len(cache_data['content'])} 字节")
                 return cache_data["content"]
         
-        # 记录image_cache中的所有键以便于调试
-        if self.image_cache:
-            cache_keys = list(self.image_cache.keys())
-            logger.info(f"当前缓存中的所有键: {cache_keys}")
-        else:
-            logger.info("当前缓存为空")
+        # 记录image_cache和last_images中的所有键以便于调试（限流，键列表只在输出时生成）
+        self.event_log.debug("image_cache.keys", "当前缓存中的所有键: {}, last_images中的所有键: {}",
+                             lambda: list(self.image_cache.keys()), lambda: list(self.last_images.keys()),
+                             conversation_key=conversation_key)
         
-        # 记录last_images中的所有键和路径以便于调试
         if self.last_images:
-            last_image_keys = list(self.last_images.keys())
-            logger.info(f"last_images中的所有键: {last_image_keys}")
-            
             # 记录last_images中与当前会话键相关的图片路径
             if conversation_key in self.last_images:
                 last_image_path = self.last_images[conversation_key]
@@ -1618,16 +2467,11 @@ class GeminiImage(Plugin):
                             with open(last_image_path, "rb") as f:
                                 image_data = f.read()
                                 # 加入缓存
-                                self.image_cache[conversation_key] = {
-                                    "content": image_data,
-                                    "timestamp": time.time()
-                                }
+                                self._put_image_cache(conversation_key, image_data)
                                 logger.info(f"从最后图片路径读取并加入缓存: {last_image_path}")
                                 return image_data
                         except Exception as e:
                             logger.error(f"从文件读取图片失败: {e}")
-        else:
-            logger.info("last_images为空")
             
         # 尝试从conversation_key直接获取缓存
         cache_data = self.image_cache.get(conversation_key)
@@ -1687,17 +2531,32 @@ class GeminiImage(Plugin):
         return None
     
     def _cleanup_image_cache(self):
-        """清理过期的图片缓存"""
-        current_time = time.time()
-        expired_keys = []
+        """清理过期的图片缓存：只遍历索引，不读取图片内容；共享状态后端中的条目由后端按TTL过期"""
+        if self.state_backend:
+            return
+        if not self._image_cache_index_seeded:
+            # 从会话存储恢复的条目只读取键，按恢复时间开始计算过期
+            self._image_cache_index_seeded = True
+            now = time.time()
+            for key in list(self.image_cache):
+                self.image_cache_index.setdefault(key, (now, 0))
         
-        for key, cache_data in self.image_cache.items():
-            if current_time - cache_data["timestamp"] > self.image_cache_timeout:
-                expired_keys.append(key)
+        current_time = time.time()
+        # 遍历快照，处理线程可能同时写入缓存
+        expired_keys = [key for key, (timestamp, _) in list(self.image_cache_index.items())
+                        if current_time - timestamp > self.image_cache_timeout]
         
         for key in expired_keys:
-            del self.image_cache[key]
-            logger.debug(f"清理过期图片缓存: {key}")
+            with self.user_locks(key):
+                # 加锁后重新检查，期间可能有新图片写入
+                entry = self.image_cache_index.get(key)
+                if entry and time.time() - entry[0] > self.image_cache_timeout:
+                    self.image_cache_index.pop(key, None)
+                    try:
+                        del self.image_cache[key]  # 直接删除，不解码条目内容
+                    except KeyError:
+                        pass
+                    logger.debug(f"清理过期图片缓存: {key}")
     
     def _cleanup_expired_conversations(self):
         """清理过期会话"""
@@ -1709,22 +2568,34 @@ class GeminiImage(Plugin):
                 expired_keys.append(key)
                 
         for key in expired_keys:
-            if key in self.conversations:
-                del self.conversations[key]
-            if key in self.last_conversation_time:
-                del self.last_conversation_time[key]
+            with self.user_locks(key):
+                # 加锁后重新检查，会话可能刚刚被处理线程续期
+                if time.time() - self.last_conversation_time.get(key, 0) <= self.conversation_expire_seconds:
+                    continue
+                self.conversations.pop(key, None)
+                self.chat_sessions.pop(key, None)
+                self.last_conversation_time.pop(key, None)
+        
+        # 丢弃已不在等待融图的用户遗留的预处理结果（上传中途放弃或等待状态已被其他进程认领）
+        for user_id in list(self.merge_ingest):
+            with self.user_locks(user_id):
+                if user_id not in self.waiting_for_merge_image:
+                    self._discard_merge_ingest(user_id)
         
         # 检查并清理过长的会话，防止请求体过大
         for key in list(self.conversations.keys()):
-            if isinstance(self.conversations[key], dict) and "messages" in self.conversations[key]:
-                messages = self.conversations[key]["messages"]
-                if len(messages) > self.MAX_CONVERSATION_MESSAGES:
-                    # 保留最近的消息
-                    excess = len(messages) - self.MAX_CONVERSATION_MESSAGES
-                    self.conversations[key]["messages"] = messages[excess:]
-                    logger.info(f"会话 {key} 长度超过限制，已裁剪为最新的 {self.MAX_CONVERSATION_MESSAGES} 条消息")
-                
-        logger.info(f"已清理 {len(expired_keys)} 个过期会话")
+            with self.user_locks(key):
+                entry = self.conversations.get(key)
+                if isinstance(entry, dict) and "messages" in entry:
+                    messages = entry["messages"]
+                    if len(messages) > self.MAX_CONVERSATION_MESSAGES:
+                        # 保留最近的消息，原地裁剪，持有该列表引用的处理流程看到的是同一份数据
+                        excess = len(messages) - self.MAX_CONVERSATION_MESSAGES
+                        del messages[:excess]
+                        logger.info(f"会话 {key} 长度超过限制，已裁剪为最新的 {self.MAX_CONVERSATION_MESSAGES} 条消息")
+                
+        if expired_keys:
+            logger.info(f"已清理 {len(expired_keys)} 个过期会话")
     
     def _safe_api_response_for_logging(self, response_json):
         """
@@ -1737,47 +2608,7 @@ class GeminiImage(Plugin):
         Returns:
             安全版本的API响应，适合记录到日志
         """
-        if response_json is None:
-            return None
-            
-        if isinstance(response_json, dict):
-            safe_response = {}
-            for key, value in response_json.items():
-                # 特殊处理可能包含base64数据的字段
-                if key == "data" and isinstance(value, str) and len(value) > 100 and self._is_likely_base64(value):
-                    safe_response[key] = f"{value[:20]}... [长度: {len(value)}字符]"
-                else:
-                    safe_response[key] = self._safe_api_response_for_logging(value)
-            return safe_response
-        elif isinstance(response_json, list):
-            return [self._safe_api_response_for_logging(item) for item in response_json]
-        elif isinstance(response_json, str) and len(response_json) > 100 and self._is_likely_base64(response_json):
-            # 可能是base64编码的数据，只保留前20个字符
-            return f"{response_json[:20]}... [长度: {len(response_json)}字符]"
-        else:
-            return response_json
-    
-    def _is_likely_base64(self, s):
-        """
-        判断字符串是否可能是base64编码
-        
-        Args:
-            s: 要检查的字符串
-            
-        Returns:
-            bool: 是否可能是base64编码
-        """
-        # base64编码通常只包含A-Z, a-z, 0-9, +, /, =
-        if not s or len(s) < 50:  # 太短的字符串不太可能是需要截断的base64
-            return False
-            
-        # 检查字符是否符合base64编码
-        base64_chars = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
-        # 允许少量非base64字符(如换行符)
-        non_base64_count = sum(1 for c in s if c not in base64_chars)
-        
-        # 如果非base64字符比例很低，且字符串很长，则可能是base64编码
-        return non_base64_count < len(s) * 0.05 and len(s) > 100  # 允许最多5%的非base64字符
+        return redact_payload(response_json)
     
     def _chat_with_gemini(self, prompt: str, conversation_history: List[Dict] = None) -> Optional[str]:
         """调用Gemini API进行纯文本对话，返回文本响应"""
@@ -1821,9 +2652,9 @@ class GeminiImage(Plugin):
                     "http": self.proxy_url,
                     "https": self.proxy_url
                 }
-                response = requests.post(url, headers=headers, params=params, json=data, proxies=proxies)
+                response = self._upstream_post("chat", url, headers=headers, params=params, json=data, proxies=proxies)
             else:
-                response = requests.post(url, headers=headers, params=params, json=data)
+                response = self._upstream_post("chat", url, headers=headers, params=params, json=data)
             
             # 检查响应状态码
             if response.status_code == 200:
@@ -1880,19 +2711,40 @@ class GeminiImage(Plugin):
                 "key": self.api_key
             }
         
+        # 系统提示词不随用户输入变化时，作为上下文缓存只上传一次
+        cache_name = None
+        if "{prompt}" not in self.config.get("expand_prompt", ""):
+            cache_name = self._get_context_cache(
+                self._request_fingerprint("expand", expand_model, system_prompt),
+                expand_model,
+                system_instruction=system_prompt,
+                estimated_tokens=self._estimate_text_tokens(system_prompt)
+            )
+        
         # 构建请求数据
-        data = {
-            "contents": [
-                {                    
-                    "role": "model",
-                    "parts": [{"text": system_prompt}]
-                },
-                {
-                    "role": "user",
-                    "parts": [{"text": prompt}]
-                }
-            ]
-        }
+        if cache_name:
+            data = {
+                "cachedContent": cache_name,
+                "contents": [
+                    {
+                        "role": "user",
+                        "parts": [{"text": prompt}]
+                    }
+                ]
+            }
+        else:
+            data = {
+                "contents": [
+                    {                    
+                        "role": "model",
+                        "parts": [{"text": system_prompt}]
+                    },
+                    {
+                        "role": "user",
+                        "parts": [{"text": prompt}]
+                    }
+                ]
+            }
         
         try:
             # 发送请求
@@ -1903,9 +2755,9 @@ class GeminiImage(Plugin):
                     "http": self.proxy_url,
                     "https": self.proxy_url
                 }
-                response = requests.post(url, headers=headers, params=params, json=data, proxies=proxies)
+                response = self._upstream_post("expand", url, headers=headers, params=params, json=data, proxies=proxies)
             else:
-                response = requests.post(url, headers=headers, params=params, json=data)
+                response = self._upstream_post("expand", url, headers=headers, params=params, json=data)
             
             # 检查响应状态码
             if response.status_code == 200:
@@ -1926,8 +2778,18 @@ class GeminiImage(Plugin):
             logger.exception(e)
             return None
 
-    def _generate_image(self, prompt: str, conversation_history: List[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
-        """调用Gemini API生成图片，返回图片数据和文本响应"""
+    def _generate_image(self, prompt: str, conversation_history: List[Dict] = None, user_id: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API生成图片，返回图片数据和文本响应
+        
+        传入user_id时，同一用户并发发出的相同请求只会调用一次API
+        """
+        if not user_id:
+            return self._request_image_generation(prompt, conversation_history)
+        fingerprint = self._request_fingerprint("generate", self.image_model, user_id, prompt, len(conversation_history or []))
+        return self._dedup_gemini_request("生成图片", fingerprint, self._request_image_generation, prompt, conversation_history)
+
+    def _request_image_generation(self, prompt: str, conversation_history: List[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API生成图片（不经过请求合并）"""
 
         # 根据配置决定使用直接调用还是通过代理服务调用
         if self.use_proxy_service and self.proxy_service_url:
@@ -2024,7 +2886,8 @@ class GeminiImage(Plugin):
         try:
             # 发送请求
             logger.info(f"开始调用Gemini API生成图片")
-            response = requests.post(
+            response = self._upstream_post(
+                "generate",
                 url, 
                 headers=headers, 
                 params=params, 
@@ -2048,7 +2911,7 @@ class GeminiImage(Plugin):
                 try:
                     result = response.json()
                     # 记录解析后的JSON结构
-                    logger.debug(f"Gemini API响应JSON结构: {self._safe_api_response_for_logging(result)}")
+                    logger.opt(lazy=True).debug("Gemini API响应JSON结构: {}", lambda: self._safe_api_response_for_logging(result))
                 except json.JSONDecodeError as json_err:
                     logger.error(f"JSON解析错误: {str(json_err)}, 响应内容: {response_text[:200]}")
                     # 检查是否是代理服务问题
@@ -2123,11 +2986,29 @@ class GeminiImage(Plugin):
             logger.exception(e)
             return [], None, f"API调用异常: {str(e)}"
     
-    def _edit_image(self, prompt: str, image_data: bytes, conversation_history: List[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
-        """调用Gemini API编辑图片，返回图片数据和文本响应"""
-        # Add integrity check here
-        if not self._verify_image_integrity(image_data, "图片编辑"):
-            return None, "用于编辑的图片文件似乎已损坏或格式不受支持。"
+    def _edit_image(self, prompt: str, image_data: bytes, conversation_history: List[Dict] = None, prepared_image: Optional[Dict] = None, user_id: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API编辑图片，返回图片数据和文本响应
+        
+        prepared_image 为 _prepare_edit_image 的结果，传入时跳过重复的完整性校验和base64编码；
+        传入user_id时，同一用户并发发出的相同请求只会调用一次API
+        """
+        if not user_id:
+            return self._request_image_edit(prompt, image_data, conversation_history, prepared_image)
+        fingerprint = self._request_fingerprint("edit", self.image_model, user_id, prompt, image_data, len(conversation_history or []))
+        return self._dedup_gemini_request("编辑图片", fingerprint, self._request_image_edit, prompt, image_data, conversation_history, prepared_image)
+
+    def _request_image_edit(self, prompt: str, image_data: bytes, conversation_history: List[Dict] = None, prepared_image: Optional[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API编辑图片（不经过请求合并）"""
+        if prepared_image:
+            image_base64 = prepared_image["base64"]
+            image_mime_type = prepared_image["mime_type"]
+        else:
+            # Add integrity check here
+            if not self._verify_image_integrity(image_data, "图片编辑"):
+                return None, "用于编辑的图片文件似乎已损坏或格式不受支持。"
+            # 将图片数据转换为Base64编码
+            image_base64 = base64.b64encode(image_data).decode("utf-8")
+            image_mime_type = "image/png"
 
         # 根据配置决定使用直接调用还是通过代理服务调用
         if self.use_proxy_service and self.proxy_service_url:
@@ -2148,9 +3029,6 @@ class GeminiImage(Plugin):
                 "key": self.api_key
             }
         
-        # 将图片数据转换为Base64编码
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        
         # 构建请求数据
         if conversation_history and len(conversation_history) > 0:
             # 有会话历史，构建上下文
@@ -2212,7 +3090,7 @@ class GeminiImage(Plugin):
                             },
                             {
                                 "inlineData": {
-                                    "mimeType": "image/png",
+                                    "mimeType": image_mime_type,
                                     "data": image_base64
                                 }
                             }
@@ -2234,7 +3112,7 @@ class GeminiImage(Plugin):
                             },
                             {
                                 "inlineData": {
-                                    "mimeType": "image/png",
+                                    "mimeType": image_mime_type,
                                     "data": image_base64
                                 }
                             }
@@ -2322,7 +3200,8 @@ class GeminiImage(Plugin):
                                 request_size = len(request_data)
                                 logger.info(f"重建后的请求体大小: {request_size} 字节 ({request_size/1024/1024:.2f} MB)")
                     
-                    response = requests.post(
+                    response = self._upstream_post(
+                        "edit",
                         url, 
                         headers=headers, 
                         params=params, 
@@ -2341,7 +3220,7 @@ class GeminiImage(Plugin):
                     if response.status_code == 503 and retry_count < max_retries:
                         logger.warning(f"Gemini API服务过载 (状态码: 503)，将进行重试 ({retry_count+1}/{max_retries})")
                         retry_count += 1
-                        time.sleep(retry_delay)
+                        self._job_sleep(retry_delay)
                         retry_delay = min(retry_delay * 1.5, 10)  # 增加延迟，但最多10秒
                         continue
                     else:
@@ -2352,7 +3231,7 @@ class GeminiImage(Plugin):
                     if retry_count < max_retries:
                         logger.warning(f"请求异常，将进行重试 ({retry_count+1}/{max_retries})")
                         retry_count += 1
-                        time.sleep(retry_delay)
+                        self._job_sleep(retry_delay)
                         retry_delay = min(retry_delay * 1.5, 10)
                         continue
                     else:
@@ -2374,9 +3253,8 @@ class GeminiImage(Plugin):
                 
                 try:
                     result = response.json()
-                    # 记录解析后的JSON结构（安全版本）
-                    safe_result = self._safe_api_response_for_logging(result)
-                    logger.debug(f"Gemini API响应JSON结构: {safe_result}")
+                    # 记录解析后的JSON结构（安全版本，仅在输出DEBUG日志时生成）
+                    logger.opt(lazy=True).debug("Gemini API响应JSON结构: {}", lambda: self._safe_api_response_for_logging(result))
                 except json.JSONDecodeError as json_err:
                     logger.error(f"JSON解析错误: {str(json_err)}, 响应内容: {response_text[:200]}")
                     # 检查是否是代理服务问题
@@ -2498,7 +3376,47 @@ class GeminiImage(Plugin):
         if not self.translate_api_key:
             logger.warning("翻译API密钥未配置，将使用原始提示词")
             return prompt
+        
+        # 不包含中文的提示词无需翻译，直接返回
+        if not self._contains_chinese(prompt):
+            self.translate_cache_stats["skipped"] += 1
+            return prompt
+        
+        # 查询翻译缓存
+        cache_key = (self.translate_model, prompt.strip())
+        translated_text = self.translate_cache.get(cache_key)
+        if translated_text:
+            self.translate_cache_stats["hits"] += 1
+            logger.info(f"翻译缓存命中: {prompt} -> {translated_text}")
+            return translated_text
+        self.translate_cache_stats["misses"] += 1
+        
+        # 并发的相同提示词共享同一次翻译请求
+        translated_text = self._singleflight_call(self.translate_inflight, cache_key, self._request_translation, prompt)[0]
+        if not translated_text:
+            return prompt
+        
+        self.translate_cache.set(cache_key, translated_text)
+        self.translate_cache_dirty = True
+        self._save_translate_cache()
+        return translated_text
+    
+    def _contains_chinese(self, text: str) -> bool:
+        """判断文本中是否包含中文字符（纯ASCII文本直接跳过正则匹配）"""
+        if text.isascii():
+            return False
+        return re.search(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]", text) is not None
+    
+    def _request_translation(self, prompt: str) -> Optional[str]:
+        """
+        调用翻译API将中文提示词翻译成英文
+        
+        Args:
+            prompt: 原始提示词
             
+        Returns:
+            翻译后的提示词，翻译失败时返回None
+        """
         try:
             # 构建请求数据
             headers = {
@@ -2522,7 +3440,7 @@ class GeminiImage(Plugin):
             
             # 发送请求
             url = f"{self.translate_api_base}/chat/completions"
-            response = requests.post(url, headers=headers, json=data, timeout=10)
+            response = self._upstream_post("translate", url, headers=headers, json=data, timeout=10)
             
             # 解析响应
             if response.status_code == 200:
@@ -2537,11 +3455,42 @@ class GeminiImage(Plugin):
                     return translated_text
             
             logger.warning(f"翻译失败: {response.status_code} {response.text}")
-            return prompt
+            return None
             
         except Exception as e:
             logger.error(f"翻译出错: {str(e)}")
-            return prompt
+            return None
+    
+    def _load_translate_cache(self):
+        """从文件加载持久化的翻译缓存"""
+        if not os.path.exists(self.translate_cache_file):
+            return
+        try:
+            with open(self.translate_cache_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            loaded = self.translate_cache.load([(tuple(key), value, expire_at) for key, value, expire_at in entries])
+            logger.info(f"已加载 {loaded} 条翻译缓存")
+        except Exception as e:
+            logger.warning(f"加载翻译缓存失败: {e}")
+    
+    def _save_translate_cache(self, force: bool = False):
+        """将翻译缓存写入文件，非强制写入时按最小间隔合并多次更新"""
+        with self.translate_cache_save_lock:
+            if not self.translate_cache_dirty:
+                return
+            if not force and time.time() - self.translate_cache_last_save < self.translate_cache_save_interval:
+                return
+            try:
+                self.translate_cache_dirty = False
+                self.translate_cache_last_save = time.time()
+                entries = [(list(key), value, expire_at) for key, value, expire_at in self.translate_cache.dump()]
+                tmp_path = f"{self.translate_cache_file}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.translate_cache_file)
+            except Exception as e:
+                self.translate_cache_dirty = True
+                logger.warning(f"保存翻译缓存失败: {e}")
     
     def _load_config_template(self):
         """加载配置模板"""
@@ -2620,8 +3569,197 @@ class GeminiImage(Plugin):
                  logger.debug(f"Relevant msg_id from msg_obj: {msg_obj.msg_id}")
             return None
 
+    def _request_fingerprint(self, *parts) -> str:
+        """根据请求的关键组成部分生成规范化指纹，二进制数据按内容哈希参与计算"""
+        canonical = [self._image_content_hash(part) if isinstance(part, (bytes, bytearray)) else part for part in parts]
+        return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _dedup_gemini_request(self, operation: str, fingerprint: str, fn, *args):
+        """通过进行中请求登记表执行上游调用，重复请求直接等待并复用已有调用的结果"""
+        result, shared = self._singleflight_call(self.gemini_inflight, fingerprint, fn, *args)
+        if shared:
+            logger.info(f"{operation}请求与进行中的相同请求合并，已节省上游调用 {self.gemini_inflight.stats['shared']} 次")
+        return result
+
+    def _estimate_text_tokens(self, text: str) -> int:
+        """粗略估算文本的token数：中文约每字1个token，其他字符约每4个1个token"""
+        if not text:
+            return 0
+        cjk_count = len(re.findall(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]", text))
+        return cjk_count + (len(text) - cjk_count + 3) // 4
+
+    def _estimate_image_tokens(self, image_data: bytes) -> int:
+        """按Gemini的计费规则估算图片token数：小图258个，大图按768x768分块，每块258个"""
+        try:
+            width, height = Image.open(BytesIO(image_data)).size
+        except Exception:
+            return 258
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * ((width + 767) // 768) * ((height + 767) // 768)
+
+    def _gemini_api_target(self, path: str) -> Tuple[str, Dict, Dict]:
+        """根据配置返回Gemini API的URL、请求头和URL参数
+        
+        Args:
+            path: v1beta之后的路径，例如 "models/xxx:generateContent" 或 "cachedContents"
+        """
+        if self.use_proxy_service and self.proxy_service_url:
+            url = f"{self.proxy_service_url.rstrip('/')}/v1beta/{path}"
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}"  # 使用Bearer认证方式
+            }
+            params = {}
+        else:
+            url = f"https://generativelanguage.googleapis.com/v1beta/{path}"
+            headers = {"Content-Type": "application/json"}
+            params = {"key": self.api_key}
+        return url, headers, params
+
+    def _get_context_cache(self, cache_key: str, model: str, contents: Optional[List[Dict]] = None, system_instruction: Optional[str] = None, estimated_tokens: int = 0, ttl: Optional[int] = None) -> Optional[str]:
+        """获取或创建上下文缓存，返回可在generateContent中引用的cachedContent名称
+        
+        Args:
+            cache_key: 本地缓存键，相同键复用同一个上游缓存
+            model: 模型名称，上游缓存只能被同一模型引用
+            contents: 需要缓存的对话内容前缀
+            system_instruction: 需要缓存的系统提示词
+            estimated_tokens: 内容的估算token数，低于下限时不创建缓存
+            ttl: 缓存有效期(秒)，默认使用context_cache_ttl
+            
+        Returns:
+            cachedContent名称，未启用、内容过短或创建失败时返回None（调用方应回退为内联发送）
+        """
+        if not self.enable_context_cache:
+            return None
+        if estimated_tokens < self.context_cache_min_tokens:
+            self.context_cache_stats["skipped"] += 1
+            return None
+        
+        entry = self.context_caches.get(cache_key)
+        # 提前30秒视为过期，避免引用时上游缓存恰好失效
+        if entry and entry["expire_at"] - 30 > time.time():
+            if entry["name"]:
+                self.context_cache_stats["reused"] += 1
+            return entry["name"]
+        
+        ttl = ttl or self.context_cache_ttl
+        return self._singleflight_call(self.gemini_inflight, f"context_cache:{cache_key}", self._create_context_cache, cache_key, model, contents, system_instruction, ttl)[0]
+
+    def _create_context_cache(self, cache_key: str, model: str, contents: Optional[List[Dict]], system_instruction: Optional[str], ttl: int) -> Optional[str]:
+        """调用cachedContents接口创建上下文缓存，失败时在ttl内不再重试"""
+        url, headers, params = self._gemini_api_target("cachedContents")
+        data = {"model": f"models/{model}", "ttl": f"{ttl}s"}
+        if contents:
+            data["contents"] = contents
+        if system_instruction:
+            data["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        
+        proxies = None
+        if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
+            proxies = {"http": self.proxy_url, "https": self.proxy_url}
+        
+        name = None
+        try:
+            response = self._upstream_post("context_cache", url, headers=headers, params=params, json=data, proxies=proxies, timeout=30)
+            if response.status_code == 200:
+                name = response.json().get("name")
+            else:
+                logger.warning(f"创建上下文缓存失败 (状态码: {response.status_code}): {response.text[:300]}")
+        except Exception as e:
+            logger.warning(f"创建上下文缓存异常: {str(e)}")
+        
+        self.context_caches.set(cache_key, {"name": name, "expire_at": time.time() + ttl}, ttl=ttl)
+        if name:
+            self.context_cache_stats["created"] += 1
+            logger.info(f"已创建上下文缓存 {name}，模型: {model}，有效期: {ttl}秒")
+        else:
+            self.context_cache_stats["failed"] += 1
+        return name
+
+    def _image_content_hash(self, image_data: bytes) -> str:
+        """计算图片内容的SHA256哈希，用作缓存键"""
+        return hashlib.sha256(image_data).hexdigest()
+
+    def _image_perceptual_hash(self, image_data: bytes) -> Optional[int]:
+        """计算图片的差值感知哈希(dHash, 64位)，用于识别重新压缩/转发后的近似重复图片
+        
+        Returns:
+            64位整数哈希，图片无法解析时返回None
+        """
+        try:
+            img = Image.open(BytesIO(image_data))
+            img.draft("L", (64, 64))  # JPEG可直接按缩小尺寸解码，避免完整解码大图
+            pixels = list(img.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+        except Exception as e:
+            logger.debug(f"计算感知哈希失败: {e}")
+            return None
+        phash = 0
+        for row in range(8):
+            for col in range(8):
+                phash = (phash << 1) | (1 if pixels[row * 9 + col] > pixels[row * 9 + col + 1] else 0)
+        return phash
+
+    def _get_cached_analysis(self, image_data: bytes, prompt: str, model: str) -> Optional[str]:
+        """查询识图/反推结果缓存
+        
+        Args:
+            image_data: 图片二进制数据
+            prompt: 发送给模型的问题或提示词
+            model: 使用的模型名称
+            
+        Returns:
+            缓存的文本结果，未命中时返回None
+        """
+        if not self.enable_analysis_cache or not image_data:
+            return None
+        
+        content_hash = self._image_content_hash(image_data)
+        entry = self.analysis_cache.get((content_hash, prompt, model))
+        if entry is not None:
+            self.analysis_cache_stats["hits"] += 1
+            logger.info(f"识图缓存命中，图片哈希: {content_hash[:12]}，命中/未命中: {self.analysis_cache_stats['hits']}/{self.analysis_cache_stats['misses']}")
+            return entry["result"]
+        
+        if self.analysis_cache_phash:
+            phash = self._image_perceptual_hash(image_data)
+            if phash is not None:
+                threshold = self.analysis_cache_phash_threshold
+                found = self.analysis_cache.find(
+                    lambda key, value: key[1] == prompt and key[2] == model and value.get("phash") is not None
+                    and bin(value["phash"] ^ phash).count("1") <= threshold
+                )
+                if found:
+                    self.analysis_cache_stats["phash_hits"] += 1
+                    logger.info(f"识图缓存近似命中，图片哈希: {content_hash[:12]} ≈ {found[0][0][:12]}")
+                    return found[1]["result"]
+        
+        self.analysis_cache_stats["misses"] += 1
+        return None
+
+    def _store_cached_analysis(self, image_data: bytes, prompt: str, model: str, result: str) -> None:
+        """写入识图/反推结果缓存，只缓存成功的模型回复"""
+        if not self.enable_analysis_cache or not image_data or not result:
+            return
+        
+        entry = {"result": result}
+        if self.analysis_cache_phash:
+            entry["phash"] = self._image_perceptual_hash(image_data)
+        self.analysis_cache.set((self._image_content_hash(image_data), prompt, model), entry)
+
     def _reverse_image(self, image_data: bytes) -> Optional[str]:
         """调用Gemini API分析图片内容"""
+        # 优先查询缓存，命中时无需再做完整性校验和base64编码
+        cached_result = self._get_cached_analysis(image_data, self.reverse_prompt, self.analysis_model)
+        if cached_result is not None:
+            return cached_result
+
+        fingerprint = self._request_fingerprint("reverse", self.analysis_model, self.reverse_prompt, image_data)
+        return self._dedup_gemini_request("反推", fingerprint, self._request_image_reverse, image_data)
+
+    def _request_image_reverse(self, image_data: bytes) -> Optional[str]:
+        """调用Gemini API反推图片提示词（不经过缓存）"""
         # Add integrity check here
         if not self._verify_image_integrity(image_data, "反推提示词"):
             return "图片文件似乎已损坏或格式不受支持，无法进行反推。"
@@ -2630,24 +3768,50 @@ class GeminiImage(Plugin):
             # 将图片转换为Base64格式
             image_base64 = base64.b64encode(image_data).decode("utf-8")
             
+            # 反推提示词固定不变，作为上下文缓存的系统提示词只上传一次
+            cache_name = self._get_context_cache(
+                self._request_fingerprint("reverse", self.analysis_model, self.reverse_prompt),
+                self.analysis_model,
+                system_instruction=self.reverse_prompt,
+                estimated_tokens=self._estimate_text_tokens(self.reverse_prompt)
+            )
+            
             # 构建请求数据
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "inlineData": {
-                                    "mimeType": "image/png",
-                                    "data": image_base64
+            if cache_name:
+                data = {
+                    "cachedContent": cache_name,
+                    "contents": [
+                        {
+                            "role": "user",
+                            "parts": [
+                                {
+                                    "inlineData": {
+                                        "mimeType": "image/png",
+                                        "data": image_base64
+                                    }
                                 }
-                            },
-                            {
-                                "text": self.reverse_prompt
-                            }
-                        ]
-                    }
-                ]
-            }
+                            ]
+                        }
+                    ]
+                }
+            else:
+                data = {
+                    "contents": [
+                        {
+                            "parts": [
+                                {
+                                    "inlineData": {
+                                        "mimeType": "image/png",
+                                        "data": image_base64
+                                    }
+                                },
+                                {
+                                    "text": self.reverse_prompt
+                                }
+                            ]
+                        }
+                    ]
+                }
             
             # 根据配置决定使用直接调用还是通过代理服务调用
             if self.use_proxy_service and self.proxy_service_url:
@@ -2675,7 +3839,8 @@ class GeminiImage(Plugin):
                 }
             
             # 发送请求
-            response = requests.post(
+            response = self._upstream_post(
+                "reverse",
                 url,
                 headers=headers,
                 params=params,
@@ -2694,6 +3859,7 @@ class GeminiImage(Plugin):
                     # 提取文本响应
                     for part in parts:
                         if "text" in part:
+                            self._store_cached_analysis(image_data, self.reverse_prompt, self.analysis_model, part["text"])
                             return part["text"]
                 
                 return None
@@ -2705,16 +3871,61 @@ class GeminiImage(Plugin):
             logger.exception(e)
             return None
 
-    def _analyze_image(self, image_data: bytes, question: Optional[str] = None) -> Optional[str]:
+    def _analyze_image(self, image_data: bytes, question: Optional[str] = None, use_context_cache: bool = False, history: Optional[List[Dict]] = None) -> Optional[str]:
         """分析图片内容或回答关于图片的问题
         
         Args:
             image_data: 图片二进制数据
             question: 可选，用户关于图片的具体问题
+            use_context_cache: 是否将图片放入上下文缓存，用于同一张图片的连续追问
+            history: 可选，识图会话中此前的问答轮次（纯文本），图片只随第一轮发送一次
             
         Returns:
             str: 分析结果或问题的回答
         """
+        # 如果没有具体问题，使用默认的分析提示词
+        if not question:
+            question = self.DEFAULT_ANALYSIS_QUESTION
+
+        # 带历史的追问结果依赖上下文，不走结果缓存
+        if not history:
+            # 优先查询缓存，命中时无需再做完整性校验和base64编码
+            cached_result = self._get_cached_analysis(image_data, question, self.analysis_model)
+            if cached_result is not None:
+                return cached_result
+
+        history_texts = [(turn["role"], turn["text"]) for turn in history or []]
+        fingerprint = self._request_fingerprint("analysis", self.analysis_model, question, image_data, history_texts)
+        return self._dedup_gemini_request("识图", fingerprint, self._request_image_analysis, image_data, question, use_context_cache, history)
+
+    def _start_analysis_session(self, user_id: str, image_data: bytes, question: Optional[str], answer: str):
+        """识图成功后开启追问会话，记录图片和第一轮问答"""
+        with self.user_locks(user_id):
+            self.last_analysis_image[user_id] = image_data
+            self.last_analysis_time[user_id] = time.time()
+            self.analysis_sessions[user_id] = {"turns": [], "tokens": 0}
+            self._append_analysis_turns(user_id, question or self.DEFAULT_ANALYSIS_QUESTION, answer)
+
+    def _append_analysis_turns(self, user_id: str, question: str, answer: str):
+        """向识图会话追加一轮问答，超出token预算时从最早的问答开始淘汰
+        
+        每条消息的token估算只在加入时计算一次，会话维护累计值，裁剪时无需重新遍历历史
+        """
+        with self.user_locks(user_id):
+            session = self.analysis_sessions.setdefault(user_id, {"turns": [], "tokens": 0})
+            for role, text in (("user", question), ("model", answer)):
+                tokens = self._estimate_text_tokens(text)
+                session["turns"].append({"role": role, "text": text, "tokens": tokens})
+                session["tokens"] += tokens
+        
+            # 按问答对淘汰，至少保留最近一轮
+            while session["tokens"] > self.follow_up_history_tokens and len(session["turns"]) > 2:
+                for turn in session["turns"][:2]:
+                    session["tokens"] -= turn["tokens"]
+                del session["turns"][:2]
+
+    def _request_image_analysis(self, image_data: bytes, question: str, use_context_cache: bool = False, history: Optional[List[Dict]] = None) -> Optional[str]:
+        """调用Gemini API分析图片（不经过缓存）"""
         # Add integrity check here
         if not self._verify_image_integrity(image_data, "识图"):
             return "图片文件似乎已损坏或格式不受支持，无法进行分析。"
@@ -2722,30 +3933,43 @@ class GeminiImage(Plugin):
         try:
             # 将图片数据转换为base64格式
             image_base64 = base64.b64encode(image_data).decode('utf-8')
-            
-            # 构建请求数据
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "inlineData": {
-                                    "mimeType": "image/jpeg",
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    }
-                ]
+            image_part = {
+                "inlineData": {
+                    "mimeType": "image/jpeg",
+                    "data": image_base64
+                }
             }
             
-            # 如果有具体问题，添加到请求中
-            if question:
-                data["contents"][0]["parts"].append({"text": question})
+            # 追问时图片以上下文缓存的形式引用，不再每次重新上传
+            cache_name = None
+            if use_context_cache:
+                cache_name = self._get_context_cache(
+                    self._request_fingerprint("analysis_image", self.analysis_model, image_data),
+                    self.analysis_model,
+                    contents=[{"role": "user", "parts": [image_part]}],
+                    estimated_tokens=self._estimate_image_tokens(image_data),
+                    ttl=self.follow_up_timeout
+                )
+            
+            # 历史问答只发送文本，图片仅出现在第一轮用户消息中
+            contents = [
+                {"role": turn["role"], "parts": [{"text": turn["text"]}]}
+                for turn in history or []
+            ]
+            contents.append({"role": "user", "parts": [{"text": question}]})
+            
+            # 构建请求数据
+            if cache_name:
+                logger.info(f"追问使用上下文缓存 {cache_name}，节省上传约 {len(image_base64)} 字节")
+                data = {
+                    "cachedContent": cache_name,
+                    "contents": contents
+                }
             else:
-                # 使用默认的分析提示词
-                default_prompt = "请仔细观察这张图片的内容，然后用简洁清晰的中文回答用户的问题。如用户没有提出额外问题，则简单描述图片中的主体、场景、风格、颜色等关键要素。如果图片包含文字，也请提取出来。"
-                data["contents"][0]["parts"].append({"text": default_prompt})
+                contents[0]["parts"].insert(0, image_part)
+                data = {
+                    "contents": contents
+                }
             
             # 根据配置决定使用直接调用还是通过代理服务调用
             if self.use_proxy_service and self.proxy_service_url:
@@ -2773,7 +3997,8 @@ class GeminiImage(Plugin):
                 }
             
             # 发送请求
-            response = requests.post(
+            response = self._upstream_post(
+                "analysis",
                 url,
                 headers=headers,
                 params=params,
@@ -2792,6 +4017,8 @@ class GeminiImage(Plugin):
                     # 提取文本响应
                     for part in parts:
                         if "text" in part:
+                            if not history:
+                                self._store_cached_analysis(image_data, question, self.analysis_model, part["text"])
                             return part["text"]
                 
                 return None
@@ -2803,7 +4030,7 @@ class GeminiImage(Plugin):
             logger.exception(e)
             return None
 
-    def _handle_reference_image_edit(self, e_context, user_id, prompt, image_base64):
+    def _handle_reference_image_edit(self, e_context, user_id, prompt, image_base64, image_data: Optional[bytes] = None):
         """
         处理参考图片编辑
         
@@ -2812,6 +4039,7 @@ class GeminiImage(Plugin):
             user_id: 用户ID
             prompt: 编辑提示词
             image_base64: 图片的base64编码
+            image_data: 可选，图片二进制数据，传入时无需再解码image_base64
         """
         try:
             # 获取会话标识
@@ -2820,29 +4048,35 @@ class GeminiImage(Plugin):
             
             # 注意：提示消息已在调用此方法前发送，此处不再重复发送
             
-            # 检查图片数据是否有效
-            if not image_base64 or len(image_base64) < 100:
-                logger.error(f"无效的图片数据: {image_base64[:20] if image_base64 else 'None'}")
-                reply = Reply(ReplyType.TEXT, "无法处理图片，请确保上传的是有效的图片文件。")
-                e_context["reply"] = reply
-                e_context.action = EventAction.BREAK_PASS
-                return
-            
-            logger.info(f"收到有效的图片数据，长度: {len(image_base64)}")
-            
-            try:
-                # 将base64转换为二进制数据
-                image_data = base64.b64decode(image_base64)
-                logger.info(f"成功解码参考图Base64数据，大小: {len(image_data)} 字节")
-            except Exception as decode_err:
-                logger.error(f"参考图Base64解码失败: {str(decode_err)}")
-                reply = Reply(ReplyType.TEXT, "参考图片数据解码失败，请重新上传图片。")
-                e_context["reply"] = reply
-                e_context.action = EventAction.BREAK_PASS
-                return
+            if image_data is None:
+                # 检查图片数据是否有效
+                if not image_base64 or len(image_base64) < 100:
+                    logger.error(f"无效的图片数据: {image_base64[:20] if image_base64 else 'None'}")
+                    reply = Reply(ReplyType.TEXT, "无法处理图片，请确保上传的是有效的图片文件。")
+                    e_context["reply"] = reply
+                    e_context.action = EventAction.BREAK_PASS
+                    return
+                
+                logger.info(f"收到有效的图片数据，长度: {len(image_base64)}")
+                
+                try:
+                    # 将base64转换为二进制数据
+                    image_data = base64.b64decode(image_base64)
+                    logger.info(f"成功解码参考图Base64数据，大小: {len(image_data)} 字节")
+                except Exception as decode_err:
+                    logger.error(f"参考图Base64解码失败: {str(decode_err)}")
+                    reply = Reply(ReplyType.TEXT, "参考图片数据解码失败，请重新上传图片。")
+                    e_context["reply"] = reply
+                    e_context.action = EventAction.BREAK_PASS
+                    return
 
-            # Verify image integrity
-            if not self._verify_image_integrity(image_data, "参考图编辑", "uploaded_reference_image"):
+            # 图片数据有效后再翻译提示词（网络请求），与下面的图片校验/压缩/编码（CPU）并行执行
+            translate_future = self._submit_prep(self._prepare_prompt, prompt, user_id)
+
+            # Verify image integrity, compress if needed and encode
+            prepared_image = self._prepare_edit_image(image_data, "参考图编辑", "uploaded_reference_image")
+            if not prepared_image:
+                translate_future.cancel()
                 reply = Reply(ReplyType.TEXT, "上传的参考图片文件似乎已损坏或格式不受支持。")
                 e_context["reply"] = reply
                 e_context.action = EventAction.BREAK_PASS
@@ -2855,13 +4089,13 @@ class GeminiImage(Plugin):
             # 获取会话历史
             conversation_history = self.conversations.get(conversation_key, {}).get("messages", [])
             
-            # 翻译提示词
-            translated_prompt = self._translate_prompt(prompt, user_id)
+            # 等待翻译完成
+            translated_prompt = translate_future.result()
             logger.info(f"翻译后的提示词: {translated_prompt}")
             
             # 编辑图片
             logger.info("开始调用_edit_image方法")
-            result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history)
+            result_image, text_response = self._edit_image(translated_prompt, image_data, conversation_history, prepared_image, user_id=conversation_key)
             
             if result_image:
                 logger.info(f"图片编辑成功，结果大小: {len(result_image)} 字节")
@@ -2885,8 +4119,8 @@ class GeminiImage(Plugin):
                 self._add_message_to_conversation(conversation_key, "user", [
                     {"text": prompt},
                     {"inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": image_base64
+                        "mime_type": prepared_image["mime_type"],
+                        "data": prepared_image["base64"]
                     }}
                 ])
                 
@@ -2917,7 +4151,7 @@ class GeminiImage(Plugin):
                     reply_text += f"（已开始图像对话，可以继续发送命令修改图片。需要结束时请发送\"{self.exit_commands[0]}\"）"
                 
                 # 先发送文本消息
-                e_context["channel"].send(Reply(ReplyType.TEXT, reply_text), e_context["context"])
+                self._send_reply(e_context["channel"], Reply(ReplyType.TEXT, reply_text), e_context["context"])
                 
                 # 创建文件对象，由框架负责关闭
                 image_file = open(image_path, "rb")
@@ -2947,10 +4181,10 @@ class GeminiImage(Plugin):
         help_text = "基于Google Gemini的图像生成插件\n"
         help_text += "可以生成和编辑图片，支持连续对话\n\n"
         help_text += "使用方法：\n"
-        help_text += f"1. 生成图片：发送 {self.commands[0]} + 描述，例如：{self.commands[0]} 一只可爱的猫咪\n"
+        help_text += f"1. 生成图片：发送 {self.commands[0]} + 描述，例如：{self.commands[0]} 一只可爱的猫咪，描述前加 -n 3 可一次生成3张\n"
         help_text += f"2. 编辑图片：发送 {self.edit_commands[0]} + 描述，例如：{self.edit_commands[0]} 给猫咪戴上帽子\n"
         help_text += f"3. 参考图编辑：发送 {self.reference_edit_commands[0]} + 描述，然后上传图片\n"
-        help_text += f"4. 融图：发送 {self.merge_commands[0]} + 描述，然后按顺序上传两张图片\n"
+        help_text += f"4. 融图：发送 {self.merge_commands[0]} + 描述，然后按顺序上传两张图片；{self.merge_commands[0]} -n 3 + 描述 可融合最多{self.merge_max_images}张图片\n"
         help_text += f"5. 识图：发送 {self.image_analysis_commands[0]} 然后上传图片，或发送问题后上传图片\n"
         help_text += f"6. 反推提示：发送 {self.image_reverse_commands[0]} 然后上传图片，可分析图片内容并反推提示词\n"
         help_text += f"7. 追问：发送 {self.follow_up_commands[0]} + 问题，对已识别的图片进行追加提问\n"
@@ -2982,7 +4216,80 @@ class GeminiImage(Plugin):
             help_text += "* 追问功能仅在最近一次识图后的3分钟内有效\n"
         
         return help_text
-    def _handle_merge_images(self, e_context: EventContext, user_id: str, prompt: str, first_image_base64: str, second_image_base64: str) -> None:
+    def _merge_image_size_limit(self, image_count: int) -> int:
+        """单张融图图片的压缩阈值：不超过单图上限，且所有图片合计不超过总大小上限"""
+        return min(self.edit_image_compress_threshold, self.merge_max_total_size // max(image_count, 1))
+
+    def _add_merge_image(self, user_id: str, image_data: bytes, image_count: int) -> Optional[List[Dict]]:
+        """登记一张融图图片并立即提交后台预处理，返回登记后的图片列表；等待状态已被认领时返回None"""
+        image_hash = self._image_content_hash(image_data)
+        # 保存原始二进制：会话存储把它作为按哈希去重的blob写入，每次追加只重写很小的列表JSON
+        entry = {"sha256": image_hash, "data": image_data}
+        with self.user_locks(user_id):
+            if user_id not in self.waiting_for_merge_image:
+                return None
+            ingest = self.merge_ingest.setdefault(user_id, {})
+            if image_hash not in ingest:
+                # 不携带当前消息的上下文：预处理不随这条图片消息处理结束或被取消而中断
+                ingest[image_hash] = self.prep_executor.submit(
+                    self._prepare_edit_image, image_data, "融图", f"merge_image_{len(ingest) + 1}", self._merge_image_size_limit(image_count)
+                )
+            while True:
+                images = self.merge_images.get(user_id) or []
+                updated = images + [entry]
+                if not isinstance(self.merge_images, BackendDict):
+                    self.merge_images[user_id] = updated
+                    return updated
+                # 共享状态后端中其他进程可能同时追加图片
+                if self.merge_images.compare_and_set(user_id, images or None, updated):
+                    return updated
+
+    def _discard_merge_ingest(self, user_id: str) -> None:
+        """丢弃用户未使用的融图预处理结果"""
+        for future in (self.merge_ingest.pop(user_id, None) or {}).values():
+            future.cancel()
+
+    def _claim_merge_images(self, user_id: str) -> Tuple[Optional[List[Dict]], Optional[str], Dict[str, Future]]:
+        """在用户锁内一次性取出图片列表、提示词和预处理结果，避免清理任务在认领之后、使用之前丢弃预处理结果"""
+        with self.user_locks(user_id):
+            images = self.merge_images.pop(user_id, None)
+            prompt = self.waiting_for_merge_image.pop(user_id, None)
+            self.waiting_for_merge_image_time.pop(user_id, None)
+            ingest = self.merge_ingest.pop(user_id, None) or {}
+        return images, prompt, ingest
+
+    def _collect_merge_images(self, images: List[Dict], ingest: Dict[str, Future]) -> List[Optional[Dict]]:
+        """等待融图图片的预处理结果，按上传顺序返回，无效图片对应None
+        
+        本进程收到的图片在到达时已开始预处理；其他进程收到或插件重载前收到的图片在这里补做，同样并行执行。
+        """
+        size_limit = self._merge_image_size_limit(len(images))
+        futures = []
+        for index, entry in enumerate(images, 1):
+            future = ingest.pop(entry["sha256"], None)
+            if future is None or future.cancelled():
+                try:
+                    image_data = entry["data"] if isinstance(entry["data"], (bytes, bytearray)) else base64.b64decode(entry["data"])
+                except Exception as decode_err:
+                    logger.error(f"融图第{index}张图片Base64解码失败: {str(decode_err)}")
+                    futures.append(None)
+                    continue
+                future = self._submit_prep(self._prepare_edit_image, image_data, "融图", f"merge_image_{index}", size_limit)
+            futures.append(future)
+        for future in ingest.values():
+            future.cancel()
+        
+        prepared = []
+        with self.tracer.span("merge_ingest_wait", **{"image.count": len(images)}):
+            for index, future in enumerate(futures, 1):
+                try:
+                    prepared.append(future.result() if future is not None else None)
+                except Exception as e:
+                    logger.error(f"融图第{index}张图片预处理失败: {str(e)}")
+                    prepared.append(None)
+        return prepared
+
+    def _handle_merge_images(self, e_context: EventContext, user_id: str, prompt: str, images: List[Dict], ingest: Optional[Dict[str, Future]] = None) -> None:
         """
         处理融图请求
         
@@ -2990,108 +4297,33 @@ class GeminiImage(Plugin):
             e_context: 事件上下文
             user_id: 用户ID
             prompt: 提示词
-            first_image_base64: 第一张图片的base64数据
-            second_image_base64: 第二张图片的base64数据
+            images: 按上传顺序排列的图片 [{"sha256": 内容哈希, "data": 原图二进制}]
+            ingest: 认领时取出的预处理结果 {图片哈希: Future}
         """
         channel = e_context["channel"]
         context = e_context["context"]
         
         try:
             # 发送唯一的处理中消息
-            processing_reply = Reply(ReplyType.TEXT, "成功获取第二张图片，正在融合中...")
-            channel.send(processing_reply, context)
+            processing_reply = Reply(ReplyType.TEXT, f"成功获取第{'二' if len(images) == 2 else len(images)}张图片，正在融合中...")
+            self._send_reply(channel, processing_reply, context)
             
             # 确保会话存在并设置为融图模式
             conversation_key = user_id
             self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_MERGE, False)
 
-            try:
-                first_image_data = base64.b64decode(first_image_base64)
-                logger.info(f"成功解码融图第一张图片Base64数据，大小: {len(first_image_data)} 字节")
-            except Exception as decode_err:
-                logger.error(f"融图第一张图片Base64解码失败: {str(decode_err)}")
-                error_reply = Reply(ReplyType.TEXT, "融图第一张图片数据解码失败，请重新操作。")
-                channel.send(error_reply, context)
-                return
-
-            if not self._verify_image_integrity(first_image_data, "融图-第一张图片", "first_image"):
-                error_reply = Reply(ReplyType.TEXT, "融图的第一张图片文件似乎已损坏或格式不受支持。")
-                channel.send(error_reply, context)
-                return
-
-            try:
-                second_image_data = base64.b64decode(second_image_base64)
-                logger.info(f"成功解码融图第二张图片Base64数据，大小: {len(second_image_data)} 字节")
-            except Exception as decode_err:
-                logger.error(f"融图第二张图片Base64解码失败: {str(decode_err)}")
-                error_reply = Reply(ReplyType.TEXT, "融图第二张图片数据解码失败，请重新操作。")
-                channel.send(error_reply, context)
-                return
-
-            if not self._verify_image_integrity(second_image_data, "融图-第二张图片", "second_image"):
-                error_reply = Reply(ReplyType.TEXT, "融图的第二张图片文件似乎已损坏或格式不受支持。")
-                channel.send(error_reply, context)
-                return
+            # 各图片的校验/压缩/编码在上传时已在后台进行，这里只等待结果
+            prepared_images = self._collect_merge_images(images, ingest or {})
+            for index, prepared in enumerate(prepared_images, 1):
+                if prepared is None:
+                    error_reply = Reply(ReplyType.TEXT, f"融图的第{index}张图片文件似乎已损坏或格式不受支持。")
+                    self._send_reply(channel, error_reply, context)
+                    return
+            logger.info(f"融图图片已就绪，共 {len(prepared_images)} 张，base64大小: {[len(prepared['base64']) for prepared in prepared_images]}")
             
             # 增强提示词，明确要求生成图片
-            enhanced_prompt = f"{prompt}。请生成一张融合两张输入图片的新图片，确保在回复中包含图片。"
-            
-            # 压缩图片以减小请求体大小
-            try:
-                # 获取原始大小用于日志
-                first_size = len(first_image_data)
-                second_size = len(second_image_data)
-                total_size = first_size + second_size
-                
-                # 只在图片太大时进行轻度压缩，保留高质量
-                max_single_image = 2 * 1024 * 1024  # 单图最大2MB
-                max_total_size = 3.5 * 1024 * 1024  # 总大小最大3.5MB (留出空间给其他请求数据)
-                
-                need_compression = False
-                if first_size > max_single_image or second_size > max_single_image or total_size > max_total_size:
-                    need_compression = True
-                    logger.info(f"图片需要压缩: 第一张{first_size/1024:.1f}KB, 第二张{second_size/1024:.1f}KB, 总计{total_size/1024:.1f}KB")
-                
-                if need_compression:
-                    # 使用高质量设置压缩
-                    first_image_data = self._compress_image(first_image_data, max_size=1200, quality=95, conversation_key=conversation_key)
-                    second_image_data = self._compress_image(second_image_data, max_size=1200, quality=95, conversation_key=conversation_key)
-                
-                # 重新转换为base64
-                first_image_base64_compressed = base64.b64encode(first_image_data).decode("utf-8")
-                second_image_base64_compressed = base64.b64encode(second_image_data).decode("utf-8")
-                
-                if need_compression:
-                    logger.info(f"图片压缩：第一张 {len(first_image_base64)} -> {len(first_image_base64_compressed)}，第二张 {len(second_image_base64)} -> {len(second_image_base64_compressed)}")
-                else:
-                    logger.info(f"使用原始图片质量，无需压缩: 第一张 {len(first_image_base64_compressed)} 字节, 第二张 {len(second_image_base64_compressed)} 字节")
-            except Exception as e:
-                logger.error(f"处理图片失败: {str(e)}")
-                # 如果处理失败，使用原始图片数据
-                first_image_base64_compressed = first_image_base64
-                second_image_base64_compressed = second_image_base64
-            
-            # 创建新的零历史请求，而不使用现有会话历史
-            zero_history = [
-                {
-                    "role": "user",
-                    "parts": [
-                        {"text": enhanced_prompt},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/png",
-                                "data": first_image_base64_compressed
-                            }
-                        },
-                        {
-                            "inline_data": {
-                                "mime_type": "image/png",
-                                "data": second_image_base64_compressed
-                            }
-                        }
-                    ]
-                }
-            ]
+            count_text = "两" if len(prepared_images) == 2 else str(len(prepared_images))
+            enhanced_prompt = f"{prompt}。请生成一张融合{count_text}张输入图片的新图片，确保在回复中包含图片。"
             
             # 根据配置决定使用直接调用还是通过代理服务调用
             if self.use_proxy_service and self.proxy_service_url:
@@ -3122,16 +4354,12 @@ class GeminiImage(Plugin):
             request_data = {
                 "contents": [{
                     "role": "user",
-                    "parts": [
-                        {"text": enhanced_prompt},
-                        {"inline_data": {
-                            "mime_type": "image/png",
-                            "data": first_image_base64_compressed
-                        }},
+                    "parts": [{"text": enhanced_prompt}] + [
                         {"inline_data": {
-                            "mime_type": "image/png",
-                            "data": second_image_base64_compressed
+                            "mime_type": prepared["mime_type"],
+                            "data": prepared["base64"]
                         }}
+                        for prepared in prepared_images
                     ]
                 }],
                 "generationConfig": {"responseModalities": ["Text", "Image"]}
@@ -3147,6 +4375,7 @@ class GeminiImage(Plugin):
             logger.info(f"融图请求结构: 1个用户角色对象，包含1个文本部分和{len(request_data['contents'][0]['parts'])-1}个图片部分")
             
             # 发送请求并处理响应
+            reply_kind = None
             try:
                 max_retries = 10
                 retry_count = 0
@@ -3163,7 +4392,8 @@ class GeminiImage(Plugin):
                             else:
                                 logger.info(f"直接调用Gemini API进行融图: {enhanced_prompt[:100]}...")
                         
-                        response = requests.post(
+                        response = self._upstream_post(
+                            "merge",
                             api_url, 
                             headers=headers, 
                             params=params, 
@@ -3181,7 +4411,7 @@ class GeminiImage(Plugin):
                         if response.status_code in [403, 429, 500, 502, 503, 504] and retry_count < max_retries:
                             logger.warning(f"融图API返回状态码 {response.status_code}，将进行重试 ({retry_count+1}/{max_retries})")
                             retry_count += 1
-                            time.sleep(retry_delay)
+                            self._job_sleep(retry_delay)
                             retry_delay = min(retry_delay * 1.5, 10)  # 指数退避策略
                             continue
                         elif response.status_code == 400:
@@ -3205,7 +4435,7 @@ class GeminiImage(Plugin):
                         if retry_count < max_retries:
                             logger.warning(f"请求异常，将进行重试 ({retry_count+1}/{max_retries})")
                             retry_count += 1
-                            time.sleep(retry_delay)
+                            self._job_sleep(retry_delay)
                             retry_delay = min(retry_delay * 1.5, 10)
                             continue
                         else:
@@ -3218,89 +4448,14 @@ class GeminiImage(Plugin):
                 if response and response.status_code == 200:
                     result = response.json()
                     # 处理响应结果
-                    image_text_pairs, final_text, error = self._process_multi_image_response(result)
+                    image_text_pairs, final_text, error, reply_kind = self._process_multi_image_response(result)
                     
-                    # 如果没有生成图像，尝试使用英文提示词重试
-                    if not image_text_pairs:
-                        logger.info("未获取到图像，尝试使用英文提示词重试...")
-                        english_prompt = f"Please merge these two images. {prompt}. Make sure to include the generated image in your response."
-                        request_data["contents"][0]["parts"][0]["text"] = english_prompt
-                        
-                        # 记录更新后的请求结构
-                        logger.info(f"使用英文提示词重试: '{english_prompt[:100]}...'")
-                        safe_request = copy.deepcopy(request_data)
-                        for content in safe_request["contents"]:
-                            for part in content["parts"]:
-                                if "inline_data" in part and "data" in part["inline_data"]:
-                                    part["inline_data"]["data"] = f"[BASE64_DATA_LENGTH: {len(part['inline_data']['data'])}]"
-                        logger.debug(f"英文提示词融图API请求数据: {safe_request}")
-                        
-                        # 重新进行请求，使用同样的重试机制
-                        retry_count = 0
-                        retry_delay = 1
-                        
-                        while retry_count <= max_retries:
-                            try:
-                                if retry_count > 0:
-                                    logger.info(f"英文提示词第{retry_count}次重试融图API请求...")
-                                else:
-                                    logger.info("使用英文提示词重试融图请求...")
-                                
-                                response = requests.post(
-                                    api_url, 
-                                    headers=headers, 
-                                    params=params, 
-                                    json=request_data,
-                                    proxies=proxies,
-                                    timeout=60
-                                )
-                                
-                                logger.info(f"英文提示词融图API响应状态码: {response.status_code}")
-                                
-                                if response.status_code == 200:
-                                    result = response.json()
-                                    image_text_pairs, final_text, error = self._process_multi_image_response(result)
-                                    break
-                                
-                                # 对特定错误进行重试
-                                if response.status_code in [403, 429, 500, 502, 503, 504] and retry_count < max_retries:
-                                    logger.warning(f"英文提示词融图API返回状态码 {response.status_code}，将进行重试 ({retry_count+1}/{max_retries})")
-                                    retry_count += 1
-                                    time.sleep(retry_delay)
-                                    retry_delay = min(retry_delay * 1.5, 10)
-                                    continue
-                                elif response.status_code == 400:
-                                    # 对400错误进行详细记录，这通常表示请求格式有问题
-                                    try:
-                                        error_detail = response.json()
-                                        logger.error(f"英文提示词融图API返回400错误，详细信息: {error_detail}")
-                                    except Exception as json_err:
-                                        logger.error(f"英文提示词融图API返回400错误，但无法解析响应体: {response.text[:500]}")
-                                    break
-                                else:
-                                    break
-                                    
-                            except requests.exceptions.RequestException as e:
-                                error_msg = str(e)
-                                if self.api_key and self.api_key in error_msg:
-                                    error_msg = error_msg.replace(self.api_key, "[API_KEY]")
-                                logger.error(f"英文提示词融图API请求异常: {error_msg}")
-                                
-                                if retry_count < max_retries:
-                                    logger.warning(f"英文提示词请求异常，将进行重试 ({retry_count+1}/{max_retries})")
-                                    retry_count += 1
-                                    time.sleep(retry_delay)
-                                    retry_delay = min(retry_delay * 1.5, 10)
-                                    continue
-                                else:
-                                    logger.error("英文提示词已达到最大重试次数，放弃请求")
-                                    break
-                        
-                        # 如果英文提示词重试后仍未获取到图像
-                        if not image_text_pairs:
-                            logger.error("使用英文提示词重试失败，未获取到图像")
-                            error = "融图失败，请稍后再试"
-                            image_text_pairs, final_text = [], None
+                    # 没有生成图像时追加纠正提示重试，复用已编码的图片部分
+                    if not error and not image_text_pairs:
+                        image_text_pairs, final_text, error, reply_kind = self._reprompt_for_image(
+                            "merge", self.image_model, api_url, headers, params, proxies, request_data, final_text, reply_kind,
+                            self.merge_reprompt_attempts, self.merge_reprompt_max_retries
+                        )
                 elif response:
                     # 请求失败
                     logger.error(f"融图API请求失败: 状态码 {response.status_code}")
@@ -3343,71 +4498,20 @@ class GeminiImage(Plugin):
             if error:
                 logger.error(f"融图失败: {error}")
                 error_reply = Reply(ReplyType.TEXT, f"融图失败: {error}")
-                channel.send(error_reply, context)
+                self._send_reply(channel, error_reply, context)
                 return
             
-            if not image_text_pairs or len(image_text_pairs) == 0:
-                logger.warning("API没有返回图片数据，尝试再次调用")
-                # 尝试使用英文提示词重试一次
-                english_prompt = f"Please merge these two images. {prompt}. Make sure to include the generated image in your response."
-                
-                # 更新请求数据使用英文提示词
-                request_data["contents"][0]["parts"][0]["text"] = english_prompt
-                
-                # 记录更新后的请求结构
-                logger.info(f"第二次尝试使用英文提示词: '{english_prompt[:100]}...'")
-                safe_request = copy.deepcopy(request_data)
-                for content in safe_request["contents"]:
-                    for part in content["parts"]:
-                        if "inline_data" in part and "data" in part["inline_data"]:
-                            part["inline_data"]["data"] = f"[BASE64_DATA_LENGTH: {len(part['inline_data']['data'])}]"
-                logger.debug(f"第二次融图API请求数据: {safe_request}")
-                
-                try:
-                    logger.info(f"使用英文提示词重试融图API调用: {english_prompt[:100]}...")
-                    response = requests.post(
-                        api_url, 
-                        headers=headers, 
-                        params=params, 
-                        json=request_data,
-                        proxies=proxies,
-                        timeout=60
-                    )
-                    
-                    logger.info(f"重试融图API响应状态码: {response.status_code}")
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        # 处理响应结果
-                        image_text_pairs, final_text, error = self._process_multi_image_response(result)
-                    else:
-                        logger.error(f"重试融图API请求失败: {response.status_code}, {response.text}")
-                        # 特殊处理400错误码
-                        if response.status_code == 400:
-                            try:
-                                error_detail = response.json()
-                                if 'error' in error_detail and 'message' in error_detail['error']:
-                                    error = f"融图失败: {error_detail['error']['message']}"
-                                    logger.error(f"融图API详细错误: {error_detail['error']['message']}")
-                                else:
-                                    error = f"融图失败，API返回: {response.status_code}"
-                            except Exception as e:
-                                error = f"融图失败，API返回: {response.status_code}"
-                        else:
-                            error = f"融图失败，API返回: {response.status_code}"
-                except Exception as e:
-                    logger.error(f"重试融图API请求异常: {str(e)}")
-                    error = f"融图请求异常: {str(e)}"
-                
-                # 重试失败后的处理
-                if error or not image_text_pairs or len(image_text_pairs) == 0:
-                    logger.error("第二次尝试仍未返回图片数据")
+            if not image_text_pairs:
+                logger.error("融图重试后仍未返回图片数据")
+                if reply_kind == REFUSAL:
+                    error_msg = "模型拒绝了这次融图请求，请修改提示词后再试。"
+                else:
                     error_msg = "API未能生成图片，请稍后再试或修改提示词。"
-                    if final_text:
-                        error_msg += f"\n\nAPI回复: {final_text}"
-                    error_reply = Reply(ReplyType.TEXT, error_msg)
-                    channel.send(error_reply, context)
-                    return
+                if final_text:
+                    error_msg += f"\n\nAPI回复: {final_text}"
+                error_reply = Reply(ReplyType.TEXT, error_msg)
+                self._send_reply(channel, error_reply, context)
+                return
             
             # 发送结果
             logger.info(f"成功获取融图结果，共 {len(image_text_pairs)} 张图片，是否有最终文本: {bool(final_text)}")
@@ -3466,15 +4570,83 @@ class GeminiImage(Plugin):
             logger.error(traceback.format_exc())
             # 对用户显示友好的错误消息
             error_reply = Reply(ReplyType.TEXT, "融图失败，请稍后再试或联系管理员")
-            channel.send(error_reply, context)
+            self._send_reply(channel, error_reply, context)
 
-    def _process_multi_image_response(self, result: Dict) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str]]:
-        """处理多图片响应，返回图片数据、最终文本和错误信息"""
+    def _reprompt_for_image(self, op: str, model: str, api_url: str, headers: Dict, params: Dict, proxies: Optional[Dict],
+                            request_data: Dict, final_text: Optional[str], kind: str, attempts: int, max_retries: int) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str], Optional[str]]:
+        """模型只回复了文字时，按回复类型追加一轮纠正提示再请求，返回与 _process_multi_image_response 相同的结果
+        
+        kind 为上一次响应的回复类型（classify_text_response 的结果，已考虑 finishReason）。
+        
+        新请求直接引用原请求中已编码的内容（不重新解码/压缩/编码图片），末尾追加模型的文字回复和纠正提示；
+        开启上下文缓存且可能重试多次时，原请求内容只上传一次，之后按缓存名称引用。
+        拒绝和安全拦截不重试。每次重试只对429/5xx和连接错误做少量传输层重试。
+        """
+        image_text_pairs, error = [], None
+        cache_name = None
+        for attempt in range(1, attempts + 1):
+            if kind not in RETRYABLE_KINDS:
+                logger.info(f"{op}回复类型为 {kind}，不再重试")
+                self.reprompt_counter.inc(op=op, kind=kind, outcome="skipped")
+                break
+            self.traffic_capture.note(reprompt=kind)
+            
+            turns = []
+            if final_text:
+                turns.append({"role": "model", "parts": [{"text": final_text}]})
+            turns.append({"role": "user", "parts": [{"text": reprompt_instruction(kind)}]})
+            if attempt == 1 and attempts > 1 and self.enable_context_cache:
+                image_parts = [part["inline_data"] for content in request_data["contents"] for part in content["parts"] if "inline_data" in part]
+                cache_name = self._get_context_cache(
+                    self._request_fingerprint(op, model, *(part["data"] for part in image_parts)),
+                    model,
+                    contents=request_data["contents"],
+                    estimated_tokens=sum(self._estimate_image_tokens(base64.b64decode(part["data"])) for part in image_parts)
+                )
+            if cache_name:
+                reprompt_data = {"cachedContent": cache_name, "contents": turns}
+            else:
+                reprompt_data = {"contents": request_data["contents"] + turns}
+            reprompt_data["generationConfig"] = request_data["generationConfig"]
+            logger.info(f"{op}未返回图片（回复类型: {kind}），追加提示重试 ({attempt}/{attempts}){'，引用上下文缓存' if cache_name else ''}")
+            
+            response = None
+            retry_delay = 1
+            for retry_count in range(max_retries + 1):
+                try:
+                    response = self._upstream_post(op, api_url, headers=headers, params=params, json=reprompt_data, proxies=proxies, timeout=60)
+                except requests.exceptions.RequestException as e:
+                    error_msg = str(e)
+                    if self.api_key and self.api_key in error_msg:
+                        error_msg = error_msg.replace(self.api_key, "[API_KEY]")
+                    logger.error(f"{op}重试请求异常: {error_msg}")
+                    response = None
+                else:
+                    if response.status_code not in [429, 500, 502, 503, 504]:
+                        break
+                    logger.warning(f"{op}重试请求返回状态码 {response.status_code}")
+                if retry_count < max_retries:
+                    self._job_sleep(retry_delay)
+                    retry_delay = min(retry_delay * 1.5, 10)
+            
+            if response is None or response.status_code != 200:
+                logger.error(f"{op}重试请求失败: {response.status_code if response is not None else '无响应'}")
+                self.reprompt_counter.inc(op=op, kind=kind, outcome="error")
+                break
+            previous_kind = kind
+            image_text_pairs, final_text, error, kind = self._process_multi_image_response(response.json())
+            self.reprompt_counter.inc(op=op, kind=previous_kind, outcome="image" if image_text_pairs else "no_image")
+            if error or image_text_pairs:
+                break
+        return image_text_pairs, final_text, error, kind
+
+    def _process_multi_image_response(self, result: Dict) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str], Optional[str]]:
+        """处理多图片响应，返回图片数据、最终文本、错误信息，以及没有图片时的回复类型（见 response_classifier）"""
         try:
             candidates = result.get("candidates", [])
             if not candidates or len(candidates) == 0:
                 logger.error("未找到生成的图片数据")
-                return [], None, "API响应中没有找到有效的数据"
+                return [], None, "API响应中没有找到有效的数据", None
                 
             # 检查是否有内容安全问题
             finish_reason = candidates[0].get("finishReason", "")
@@ -3483,18 +4655,24 @@ class GeminiImage(Plugin):
                 safety_message = "内容被安全系统拦截，请修改您的提示词"
                 if "text" in candidates[0].get("content", {}).get("parts", [{}])[0]:
                     safety_message += f": {candidates[0]['content']['parts'][0]['text']}"
-                return [], None, safety_message
+                return [], None, safety_message, None
             
             if finish_reason == "RECITATION":
                 logger.warning("Gemini API因背诵问题完成响应")
-                return [], None, "请更改提示词，避免要求生成复制或违规内容"
+                return [], None, "请更改提示词，避免要求生成复制或违规内容", None
                 
             content = candidates[0].get("content", {})
             parts = content.get("parts", [])
             
+            # 其他拦截原因（IMAGE_SAFETY/PROHIBITED_CONTENT等）通常没有文本，按拒绝处理，不能当作空回复重试
+            if is_blocked(finish_reason):
+                logger.warning(f"Gemini API因 {finish_reason} 拦截了响应")
+                block_text = next((part["text"].strip() for part in parts if part.get("text")), None)
+                return [], block_text, None, REFUSAL
+            
             if not parts:
                 logger.error("API响应中没有parts数据")
-                return [], None, "API响应中没有parts数据"
+                return [], None, "API响应中没有parts数据", None
             
             # 收集所有图片和文本对
             image_text_pairs = []
@@ -3502,25 +4680,18 @@ class GeminiImage(Plugin):
             final_text = None
             
             # 调试: 显示所有部分的类型
-            part_types = []
-            for i, part in enumerate(parts):
-                if "text" in part:
-                    part_types.append(f"{i+1}:text")
-                elif "inlineData" in part:
-                    part_types.append(f"{i+1}:image")
-                else:
-                    part_types.append(f"{i+1}:unknown:{list(part.keys())}")
-            logger.debug(f"API响应中的部分类型: {', '.join(part_types)}")
+            logger.opt(lazy=True).debug("API响应中的部分类型: {}", lambda: ", ".join(
+                f"{i+1}:text" if "text" in part else f"{i+1}:image" if "inlineData" in part else f"{i+1}:unknown:{list(part.keys())}"
+                for i, part in enumerate(parts)
+            ))
             
             # 处理所有部分
             has_image = False
             for i, part in enumerate(parts):
-                logger.debug(f"处理第 {i+1}/{len(parts)} 个part")
-                
                 # 处理文本部分
                 if "text" in part and part["text"]:
                     current_text = part["text"].strip()
-                    logger.debug(f"找到文本: {current_text[:50]}...")
+                    self.event_log.debug("response.part", "第 {}/{} 个part为文本: {}...", lambda: i + 1, lambda: len(parts), lambda: current_text[:50])
                 
                 # 处理图片部分
                 elif "inlineData" in part:
@@ -3529,11 +4700,11 @@ class GeminiImage(Plugin):
                         try:
                             # 解码图片数据
                             image_data = base64.b64decode(inlineData["data"])
-                            logger.debug(f"成功解码图片数据，大小: {len(image_data)} 字节")
                             
                             # 将当前文本和图片数据配对
                             image_text_pairs.append((image_data, current_text))
-                            logger.debug(f"添加图片-文本对 #{len(image_text_pairs)}, 文本长度: {len(current_text)}")
+                            self.event_log.debug("response.part", "第 {}/{} 个part为图片，大小: {} 字节，配对文本长度: {}",
+                                                 lambda: i + 1, lambda: len(parts), lambda: len(image_data), lambda: len(current_text))
                             
                             # 清空当前文本，准备下一对
                             current_text = ""
@@ -3547,12 +4718,11 @@ class GeminiImage(Plugin):
                 logger.debug(f"找到最后一段文本（没有对应图片）: {current_text[:50]}...")
                 final_text = current_text
             
-            # 如果没有图片但有最终文本，尝试检查文本中是否包含"请稍等"等提示词
-            if not has_image and final_text:
-                waiting_keywords = ["请稍等", "正在生成", "请等待", "正在处理", "processing", "generating", "please wait", "working on it"]
-                if any(keyword in final_text.lower() for keyword in waiting_keywords):
-                    logger.warning("API仅返回了等待提示，需要重试")
-                    return [], final_text, None
+            # 没有图片时对文本回复分类（等待/反问/拒绝/描述），由调用方决定是否追加提示重试
+            if not has_image:
+                kind = classify_text_response(final_text, finish_reason)
+                logger.warning(f"API没有返回图片，文本回复类型: {kind}")
+                return [], final_text, None, kind
             
             # 记录处理结果
             result_summary = []
@@ -3562,12 +4732,12 @@ class GeminiImage(Plugin):
                 result_summary.append("最后一段文本")
             
             logger.info(f"成功处理: {', '.join(result_summary)}")
-            return image_text_pairs, final_text, None
+            return image_text_pairs, final_text, None, None
             
         except Exception as e:
             logger.error(f"处理API响应时发生错误: {e}")
             logger.error(traceback.format_exc())
-            return [], None, f"处理API响应时发生错误: {e}"
+            return [], None, f"处理API响应时发生错误: {e}", None
 
     def _send_alternating_content(self, e_context: EventContext, image_text_pairs: List[Tuple[bytes, str]], final_text: Optional[str]) -> None:
         """
@@ -3589,8 +4759,8 @@ class GeminiImage(Plugin):
             if text and text.strip():
                 logger.info(f"发送第 {i+1}/{len(image_text_pairs)} 对的文本部分，长度: {len(text)}")
                 text_reply = Reply(ReplyType.TEXT, text)
-                channel.send(text_reply, context)
-                time.sleep(0.5)  # 添加小延时确保消息顺序
+                self._send_reply(channel, text_reply, context)
+                self._job_sleep(0.5, "发送结果")  # 添加小延时确保消息顺序
             
             # 保存并发送图片
             try:
@@ -3612,18 +4782,18 @@ class GeminiImage(Plugin):
                 logger.info(f"发送第 {i+1}/{len(image_text_pairs)} 对的图片部分，文件: {file_path}")
                 with open(file_path, "rb") as f:
                     img_reply = Reply(ReplyType.IMAGE, f)
-                    channel.send(img_reply, context)
-                time.sleep(1.0)  # 添加延时确保图片发送完成
+                    self._send_reply(channel, img_reply, context)
+                self._job_sleep(1.0, "发送结果")  # 添加延时确保图片发送完成
             except Exception as e:
                 logger.error(f"发送图片失败: {e}")
                 error_reply = Reply(ReplyType.TEXT, f"图片发送失败: {str(e)}")
-                channel.send(error_reply, context)
+                self._send_reply(channel, error_reply, context)
         
         # 发送最后的文本(如果有)
         if final_text and final_text.strip():
             logger.info(f"发送最终文本，长度: {len(final_text)}")
             final_reply = Reply(ReplyType.TEXT, final_text)
-            channel.send(final_reply, context)
+            self._send_reply(channel, final_reply, context)
         
         # 设置回复为None，表示已手动处理
         e_context["reply"] = None
@@ -3725,26 +4895,189 @@ class GeminiImage(Plugin):
         Returns:
             更新后的消息列表
         """
-        if conversation_key not in self.conversations:
-            self.conversations[conversation_key] = {"messages": [], "conversation_id": ""}
+        with self.user_locks(conversation_key):
+            if conversation_key not in self.conversations:
+                self.conversations[conversation_key] = {"messages": [], "conversation_id": ""}
+        
+            # 添加新消息
+            self.conversations[conversation_key]["messages"].append({
+                "role": role,
+                "parts": parts
+            })
+        
+            # 更新最后交互时间
+            self.last_conversation_time[conversation_key] = time.time()
+        
+            # 控制会话长度，保留最近的消息
+            if len(self.conversations[conversation_key]["messages"]) > self.MAX_CONVERSATION_MESSAGES:
+                # 移除最旧的消息，保留最新的MAX_CONVERSATION_MESSAGES条
+                excess = len(self.conversations[conversation_key]["messages"]) - self.MAX_CONVERSATION_MESSAGES
+                del self.conversations[conversation_key]["messages"][:excess]
+                logger.info(f"会话 {conversation_key} 长度超过限制，已裁剪为最新的 {self.MAX_CONVERSATION_MESSAGES} 条消息")
+        
+            # 模型回复意味着一轮对话结束，检查是否需要后台摘要
+            if role == "model":
+                self._maybe_schedule_summary(conversation_key)
+        
+            return self.conversations[conversation_key]["messages"]
+
+    def _get_conversation_messages(self, conversation_key: str) -> Optional[List[Dict]]:
+        """返回会话的消息列表，兼容直接存储列表和 {"messages": [...]} 两种结构"""
+        entry = self.conversations.get(conversation_key)
+        if isinstance(entry, dict):
+            return entry.get("messages")
+        if isinstance(entry, list):
+            return entry
+        return None
+
+    def _maybe_schedule_summary(self, conversation_key: str) -> bool:
+        """会话估算大小超过阈值时，提交后台摘要任务
+        
+        Returns:
+            是否提交了摘要任务
+        """
+        if not self.enable_session_summary:
+            return False
+        messages = self._get_conversation_messages(conversation_key)
+        if not messages or len(messages) <= self.session_summary_keep_messages + 2:
+            return False
         
-        # 添加新消息
-        self.conversations[conversation_key]["messages"].append({
-            "role": role,
-            "parts": parts
-        })
+        total_tokens = sum(self._estimate_message_tokens(msg) for msg in messages if isinstance(msg, dict))
+        if total_tokens < self.session_summary_threshold:
+            return False
         
-        # 更新最后交互时间
-        self.last_conversation_time[conversation_key] = time.time()
+        with self.summary_lock:
+            if conversation_key in self.summary_pending:
+                return False
+            self.summary_pending.add(conversation_key)
         
-        # 控制会话长度，保留最近的消息
-        if len(self.conversations[conversation_key]["messages"]) > self.MAX_CONVERSATION_MESSAGES:
-            # 移除最旧的消息，保留最新的MAX_CONVERSATION_MESSAGES条
-            excess = len(self.conversations[conversation_key]["messages"]) - self.MAX_CONVERSATION_MESSAGES
-            self.conversations[conversation_key]["messages"] = self.conversations[conversation_key]["messages"][excess:]
-            logger.info(f"会话 {conversation_key} 长度超过限制，已裁剪为最新的 {self.MAX_CONVERSATION_MESSAGES} 条消息")
+        # 在当前线程取快照，后台线程只读快照，不直接遍历可能被修改的会话列表
+        snapshot = list(messages[:len(messages) - self.session_summary_keep_messages])
+        logger.info(f"会话 {conversation_key} 估算 {total_tokens} tokens，超过阈值，后台摘要最早的 {len(snapshot)} 条消息")
+        self.summary_executor.submit(self._summarize_conversation, conversation_key, snapshot)
+        return True
+
+    def _summarize_conversation(self, conversation_key: str, snapshot: List[Dict]):
+        """后台任务：将会话中较早的消息压缩为文字摘要，并替换会话中的这些消息"""
+        try:
+            # 只把文本交给摘要模型，图片以占位符表示
+            transcript_lines = []
+            for msg in snapshot:
+                if not isinstance(msg, dict):
+                    continue
+                speaker = "用户" if msg.get("role") == "user" else "助手"
+                texts = []
+                for part in msg.get("parts", []):
+                    if isinstance(part, dict) and "text" in part:
+                        texts.append(part["text"])
+                    elif isinstance(part, dict):
+                        texts.append("[图片]")
+                transcript_lines.append(f"{speaker}: {' '.join(texts)}")
+            
+            summary = self._request_session_summary("\n".join(transcript_lines))
+            if not summary:
+                return
+            
+            summary_messages = [
+                {"role": "user", "parts": [{"text": f"[此前编辑过程摘要] {summary}"}], "summary": True},
+                {"role": "model", "parts": [{"text": "好的，我会在以上内容的基础上继续处理图片。"}], "summary": True}
+            ]
+            
+            with self.user_locks(conversation_key):
+                messages = self._get_conversation_messages(conversation_key)
+                # 会话在摘要期间被重置或裁剪时放弃本次结果，避免覆盖新的消息
+                if messages is None or len(messages) < len(snapshot) or any(a is not b for a, b in zip(messages, snapshot)):
+                    logger.info(f"会话 {conversation_key} 在摘要期间已变化，放弃本次摘要")
+                    return
+                # 原地替换，持有该列表引用的处理流程也能看到压缩后的历史
+                messages[:len(snapshot)] = summary_messages
+            logger.info(f"会话 {conversation_key} 已将 {len(snapshot)} 条消息压缩为摘要（{len(summary)} 字）")
+        except Exception as e:
+            logger.error(f"会话摘要失败: {str(e)}")
+            logger.exception(e)
+        finally:
+            with self.summary_lock:
+                self.summary_pending.discard(conversation_key)
+
+    def _request_session_summary(self, transcript: str) -> Optional[str]:
+        """调用文本模型生成会话摘要"""
+        url, headers, params = self._gemini_api_target(f"models/{self.session_summary_model}:generateContent")
+        prompt = (
+            "以下是用户与图像编辑助手的多轮对话记录。请将其压缩为一段简短的中文摘要，"
+            "保留用户的编辑意图、当前图片的状态、已完成和被否定的修改，省略寒暄，不超过200字。\n\n"
+            f"{transcript}"
+        )
+        data = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
         
-        return self.conversations[conversation_key]["messages"]
+        proxies = None
+        if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
+            proxies = {"http": self.proxy_url, "https": self.proxy_url}
+        
+        try:
+            response = self._upstream_post("summary", url, headers=headers, params=params, json=data, proxies=proxies, timeout=60)
+            if response.status_code != 200:
+                logger.warning(f"会话摘要API调用失败 (状态码: {response.status_code}): {response.text[:300]}")
+                return None
+            for candidate in response.json().get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    if "text" in part:
+                        return part["text"].strip()
+        except Exception as e:
+            logger.warning(f"会话摘要API调用异常: {str(e)}")
+        return None
+
+    def _estimate_message_tokens(self, message: Dict) -> int:
+        """估算单条会话消息的token数（文本按字符估算，图片按固定值估算）"""
+        tokens = 4  # 角色等结构开销
+        for part in message.get("parts", []):
+            if "text" in part:
+                tokens += self._estimate_text_tokens(part["text"])
+            elif "inlineData" in part or "inline_data" in part or "image_url" in part:
+                tokens += 258
+        return tokens
+
+    def _get_chat_session(self, conversation_key: str) -> Dict:
+        """获取纯文本对话会话，不存在时创建"""
+        session = self.chat_sessions.get(conversation_key)
+        if session is None:
+            session = {"messages": [], "tokens": [], "total_tokens": 0}
+            self.chat_sessions[conversation_key] = session
+        return session
+
+    def _append_chat_message(self, conversation_key: str, role: str, parts: List[Dict]) -> None:
+        """向对话会话追加消息，同时记录该消息的估算token数并累加到会话总数"""
+        with self.user_locks(conversation_key):
+            session = self._get_chat_session(conversation_key)
+            message = {"role": role, "parts": parts}
+            tokens = self._estimate_message_tokens(message)
+            session["messages"].append(message)
+            session["tokens"].append(tokens)
+            session["total_tokens"] += tokens
+
+    def _trim_chat_session(self, conversation_key: str) -> int:
+        """按token预算裁剪对话会话，从最早的一轮问答开始淘汰，至少保留最近一轮
+        
+        Returns:
+            被淘汰的消息数量
+        """
+        with self.user_locks(conversation_key):
+            session = self.chat_sessions.get(conversation_key)
+            if not session:
+                return 0
+        
+            evict_count = 0
+            total_tokens = session["total_tokens"]
+            # 按用户/模型成对淘汰，保证历史始终以用户消息开头
+            while total_tokens > self.chat_history_tokens and len(session["messages"]) - evict_count > 2:
+                total_tokens -= session["tokens"][evict_count] + session["tokens"][evict_count + 1]
+                evict_count += 2
+        
+            if evict_count:
+                del session["messages"][:evict_count]
+                del session["tokens"][:evict_count]
+                session["total_tokens"] = total_tokens
+                logger.info(f"对话会话 {conversation_key} 超出token预算，已淘汰最早的 {evict_count} 条消息，当前约 {total_tokens} tokens")
+            return evict_count
 
     def _create_or_reset_conversation(self, conversation_key: str, session_type: str, preserve_id: bool = False) -> None:
         """创建新会话或重置现有会话
@@ -3754,19 +5087,20 @@ class GeminiImage(Plugin):
             session_type: 会话类型（使用会话类型常量）
             preserve_id: 是否保留现有会话ID
         """
-        # 检查是否需要保留会话ID
-        conversation_id = ""
-        if preserve_id and conversation_key in self.conversations:
-            conversation_id = self.conversations[conversation_key].get("conversation_id", "")
-            
-        # 创建新的空会话
-        self.conversations[conversation_key] = {
-            "messages": [],
-            "conversation_id": conversation_id
-        }
-        
-        # 更新会话类型和时间戳
-        self.conversation_session_types[conversation_key] = session_type
-        self.last_conversation_time[conversation_key] = time.time()
-        
-        logger.info(f"已创建/重置会话 {conversation_key}，类型: {session_type}")
+        with self.user_locks(conversation_key):
+            # 检查是否需要保留会话ID
+            conversation_id = ""
+            if preserve_id and conversation_key in self.conversations:
+                conversation_id = self.conversations[conversation_key].get("conversation_id", "")
+            
+            # 创建新的空会话
+            self.conversations[conversation_key] = {
+                "messages": [],
+                "conversation_id": conversation_id
+            }
+        
+            # 更新会话类型和时间戳
+            self.conversation_session_types[conversation_key] = session_type
+            self.last_conversation_time[conversation_key] = time.time()
+        
+            logger.info(f"已创建/重置会话 {conversation_key}，类型: {session_type}")
@@ -0,0 +1,120 @@
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Tuple
+
+
+class LatencyWindow:
+    """最近若干次成功请求的耗时，用于计算对冲的触发时间"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgeBudget:
+    """对冲预算（令牌桶）：每个主请求存入 ratio 个令牌，每次对冲消耗1个，额外请求不超过主请求的 ratio 比例"""
+
+    def __init__(self, ratio: float = 0.05, burst: float = 5):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class HedgePolicy:
+    """对冲策略：请求超过近期耗时的 percentile 分位数仍未返回时，再发一个相同的请求，先成功的为准
+
+    每种请求类型单独统计耗时，样本少于 min_samples 时不对冲；触发时间不低于 min_delay 秒。
+    """
+
+    def __init__(self, percentile: float = 0.95, budget_ratio: float = 0.05, budget_burst: float = 5,
+                 min_samples: int = 20, min_delay: float = 1.0, window: int = 200):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = HedgeBudget(budget_ratio, budget_burst)
+        self._window_size = window
+        self._windows: Dict[str, LatencyWindow] = {}
+        self._lock = threading.Lock()
+
+    def _window(self, op: str) -> LatencyWindow:
+        with self._lock:
+            window = self._windows.get(op)
+            if window is None:
+                window = self._windows[op] = LatencyWindow(self._window_size)
+            return window
+
+    def observe(self, op: str, latency: float) -> None:
+        self._window(op).add(latency)
+
+    def delay(self, op: str) -> Optional[float]:
+        """返回对冲触发时间（秒），样本不足时返回None"""
+        window = self._window(op)
+        if len(window) < self.min_samples:
+            return None
+        return max(self.min_delay, window.quantile(self.percentile))
+
+
+def race(start_primary: Callable[[], concurrent.futures.Future], start_hedge: Callable[[], Optional[concurrent.futures.Future]],
+         delay: Optional[float], is_success: Callable[[object], bool], abort_check: Optional[Callable[[], None]] = None,
+         poll_interval: float = 0.2) -> Tuple[object, int, bool]:
+    """先发主请求，delay 秒内未完成时调用 start_hedge 发出对冲请求，返回 (结果, 获胜请求序号, 是否发出了对冲)
+
+    先成功的请求获胜，其余请求被取消；都失败时返回最后完成的结果（或抛出其异常）。主请求在触发时间前
+    失败时直接返回，由调用方按原来的方式重试。start_hedge 返回None表示放弃对冲（例如预算不足）。
+    abort_check 抛出异常时取消所有请求。
+    """
+    started = [start_primary()]
+    pending = set(started)
+    hedge_at = time.monotonic() + delay if delay is not None else None
+    last_failure = None
+    try:
+        while pending:
+            timeout = poll_interval if abort_check else None
+            if hedge_at is not None:
+                until_hedge = max(0.0, hedge_at - time.monotonic())
+                timeout = until_hedge if timeout is None else min(timeout, until_hedge)
+            done, pending = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and is_success(future.result()):
+                    return future.result(), started.index(future), len(started) > 1
+                last_failure = future
+            if hedge_at is not None and pending and time.monotonic() >= hedge_at:
+                hedge_at = None
+                hedge = start_hedge()
+                if hedge is not None:
+                    started.append(hedge)
+                    pending.add(hedge)
+            if abort_check and pending:
+                abort_check()
+        return last_failure.result(), started.index(last_failure), len(started) > 1
+    finally:
+        for future in pending:
+            future.cancel()
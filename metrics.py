@@ -0,0 +1,246 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+# 上游请求耗时的默认分桶（秒），图像生成通常在10~60秒之间
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """返回 (指标名后缀, 标签串, 值) 列表"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Iterable[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [("", _format_labels(self.label_names, key), value) for key, value in sorted(items)]
+
+
+class Histogram(_Metric):
+    """累积分桶的耗时分布"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # 标签 -> [各桶计数..., 溢出计数, 总和]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            entry[index] += 1
+            entry[-1] += value
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+        result = []
+        for key, entry in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+                cumulative += count
+                result.append(("_bucket", _format_labels(self.label_names, key, f'le="{_format_value(bound)}"'), cumulative))
+            labels = _format_labels(self.label_names, key)
+            result.append(("_sum", labels, entry[-1]))
+            result.append(("_count", labels, cumulative))
+        return result
+
+
+class Gauge(_Metric):
+    """采集时通过回调取值的瞬时指标
+
+    回调返回数值，或在有标签时返回 {标签值元组: 数值}。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], object], label_names: Iterable[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self.callback = callback
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.debug(f"采集指标 {self.name} 失败: {e}")
+            return []
+        if isinstance(value, dict):
+            return [("", _format_labels(self.label_names, key if isinstance(key, tuple) else (key,)), v) for key, v in sorted(value.items())]
+        return [("", "", value)]
+
+
+class MetricsRegistry:
+    """进程内的指标注册表，输出Prometheus文本格式"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def _full_name(self, name: str) -> str:
+        return f"{self.prefix}_{name}" if self.prefix else name
+
+    def counter(self, name: str, help_text: str, label_names: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(self._full_name(name), help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self._full_name(name), help_text, label_names, buckets))
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], object], label_names: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(self._full_name(name), help_text, callback, label_names))
+
+    def render(self) -> str:
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def render_summary(self) -> str:
+        """适合在聊天中查看的精简格式：省略说明行和分桶，耗时分布只显示次数和平均值"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            short_name = metric.name[len(self.prefix) + 1:] if self.prefix else metric.name
+            if isinstance(metric, Histogram):
+                sums = {labels: value for suffix, labels, value in samples if suffix == "_sum"}
+                for suffix, labels, count in samples:
+                    if suffix == "_count" and count:
+                        lines.append(f"{short_name}{labels} n={_format_value(count)} avg={sums[labels] / count:.2f}s")
+            else:
+                for _, labels, value in samples:
+                    lines.append(f"{short_name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _CachedValue:
+    """缓存计算代价较高的指标值（例如遍历目录统计大小），避免每次采集都重新计算"""
+
+    def __init__(self, fn: Callable[[], float], ttl: float = 60):
+        self.fn = fn
+        self.ttl = ttl
+        self._value = 0
+        self._expire_at = 0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> float:
+        with self._lock:
+            if time.time() >= self._expire_at:
+                self._value = self.fn()
+                self._expire_at = time.time() + self.ttl
+            return self._value
+
+
+def cached(fn: Callable[[], float], ttl: float = 60) -> Callable[[], float]:
+    return _CachedValue(fn, ttl)
+
+
+# (host, port) -> 正在运行的指标服务。插件重载时模块被重新执行，用 globals().get 保留已启动的服务，
+# 新实例只替换服务引用的注册表，不会因为端口已被旧实例占用而继续暴露旧实例的指标
+_servers: Dict[Tuple[str, int], ThreadingHTTPServer] = globals().get("_servers", {})
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9464) -> Optional[ThreadingHTTPServer]:
+    """在后台线程中启动 /metrics 端点；同一地址已有服务时改为输出该注册表，端口被其他程序占用时返回None"""
+    server = _servers.get((host, port))
+    if server is not None:
+        server.registry = registry
+        logger.info(f"指标端点 http://{host}:{port}/metrics 已切换到新的注册表")
+        return server
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"指标端点启动失败 {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    server.registry = registry
+    _servers[(host, port)] = server
+    threading.Thread(target=server.serve_forever, name="gemini-metrics", daemon=True).start()
+    logger.info(f"指标端点已启动: http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,72 @@
+import re
+from typing import Optional
+
+# 没有返回图片时，模型文本回复的类型
+WAITING = "waiting"              # "请稍等/正在生成"：模型以为自己还会继续输出
+CLARIFICATION = "clarification"  # 反问或要求确认细节
+REFUSAL = "refusal"              # 明确拒绝生成
+DESCRIPTION = "description"      # 只用文字描述了要生成的图片
+EMPTY = "empty"                  # 没有任何文本
+
+# 值得追加一轮提示再请求一次的类型；拒绝重试通常得到同样的结果，直接把回复交给用户
+RETRYABLE_KINDS = frozenset({WAITING, CLARIFICATION, DESCRIPTION, EMPTY})
+
+# 这些 finishReason 表示内容被拦截，不应重试
+_BLOCKED_FINISH_REASONS = frozenset({"SAFETY", "RECITATION", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII", "IMAGE_SAFETY"})
+
+_REFUSAL_PATTERN = re.compile(
+    r"(无法|不能|不可以|没办法|不便)(为你|为您|帮你|帮您)?(生成|创建|绘制|制作|合成|处理|提供)"
+    r"|违反|不符合.{0,6}(政策|规定|准则)"
+    r"|\bI (can't|cannot|can not|am unable to|'m unable to|won't|am not able to)\b"
+    r"|\b(unable|not able) to (generate|create|produce|make|fulfill|help)\b"
+    r"|\b(against|violates?) (my|the) (policy|policies|guidelines)\b",
+    re.IGNORECASE
+)
+_WAITING_PATTERN = re.compile(
+    r"请稍等|稍等|请等待|正在生成|正在处理|正在合成|正在绘制|马上(为你|为您)?(生成|开始)|这就(为你|为您)?(生成|开始)"
+    r"|\bprocessing\b|\bgenerating\b|please wait|working on it|one moment|give me a (moment|second)"
+    r"|\b(I'll|I will|let me) (now )?(generate|create|make|merge|combine)\b",
+    re.IGNORECASE
+)
+_CLARIFICATION_PATTERN = re.compile(
+    r"[?？]\s*$"
+    r"|你(希望|想要|想让|是否|需要)|您(希望|想要|想让|是否|需要)|请(确认|告诉我|说明|提供更多)"
+    r"|\b(would you like|do you want|could you (clarify|specify|tell me)|can you (clarify|specify|confirm)|please (clarify|specify|confirm))\b",
+    re.IGNORECASE
+)
+
+_REPROMPTS = {
+    WAITING: "不需要等待，请现在就在这次回复中直接输出生成的图片。Do not wait - output the generated image in this response now.",
+    CLARIFICATION: "不需要确认，请按你的理解直接生成图片并在这次回复中输出。Do not ask questions - make reasonable choices and output the image now.",
+    DESCRIPTION: "你只描述了图片，请把它实际生成出来并在这次回复中输出图片。You only described the image - actually generate it and include the image in this response.",
+    EMPTY: "请在这次回复中输出生成的图片。Please include the generated image in your response.",
+}
+
+
+def is_blocked(finish_reason: Optional[str]) -> bool:
+    """finishReason 是否表示内容被安全策略拦截"""
+    return bool(finish_reason) and finish_reason in _BLOCKED_FINISH_REASONS
+
+
+def classify_text_response(text: Optional[str], finish_reason: Optional[str] = None) -> str:
+    """对没有返回图片的响应进行分类，返回上面定义的类型之一
+
+    判断顺序：拦截/拒绝优先于等待，等待优先于反问；都不匹配的非空文本视为只描述了图片。
+    """
+    if is_blocked(finish_reason):
+        return REFUSAL
+    text = (text or "").strip()
+    if not text:
+        return EMPTY
+    if _REFUSAL_PATTERN.search(text):
+        return REFUSAL
+    if _WAITING_PATTERN.search(text):
+        return WAITING
+    if _CLARIFICATION_PATTERN.search(text):
+        return CLARIFICATION
+    return DESCRIPTION
+
+
+def reprompt_instruction(kind: str) -> str:
+    """返回追加在对话末尾的纠正提示，要求模型直接输出图片"""
+    return _REPROMPTS.get(kind, _REPROMPTS[EMPTY])
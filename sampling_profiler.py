@@ -0,0 +1,167 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+from loguru import logger
+
+# 阻塞等待中的栈顶帧（文件名, 函数名）：线程在等锁、等队列或等网络数据，不占用CPU，默认不计入结果
+IDLE_FRAMES = frozenset({
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "readinto"),
+    ("socket.py", "accept"),
+    ("ssl.py", "read"),
+    ("ssl.py", "recv_into"),
+})
+
+
+class ProfileResult:
+    """一次采样的结果：调用栈（从外到内）-> 采样次数"""
+
+    def __init__(self, stacks: Counter, samples: int, started_at: float, ended_at: float, requests: int):
+        self.stacks = stacks
+        self.samples = samples
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.requests = requests
+
+    def collapsed(self) -> str:
+        """折叠栈格式（每行 "帧1;帧2;...;帧N 次数"），可直接交给 flamegraph.pl / speedscope 绘制火焰图"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def function_stats(self) -> List[Tuple[str, int, int]]:
+        """按函数统计 (函数, 自身采样数, 包含子调用的采样数)，按自身采样数降序"""
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for frame in set(stack):
+                total_counts[frame] += count
+        return sorted(((frame, self_counts[frame], total) for frame, total in total_counts.items()),
+                      key=lambda item: (item[1], item[2]), reverse=True)
+
+    def summary(self, top: int = 30) -> str:
+        duration = self.ended_at - self.started_at
+        # 每次采样会记录多个线程的调用栈，百分比按调用栈样本总数计算
+        stack_samples = sum(self.stacks.values())
+        lines = [f"采样 {self.samples} 次（{stack_samples} 个调用栈样本），耗时 {duration:.1f} 秒，期间处理 {self.requests} 条命令"]
+        if not stack_samples:
+            return lines[0]
+        lines.append(f"{'自身%':>7} {'累计%':>7}  函数")
+        for frame, self_count, total in self.function_stats()[:top]:
+            lines.append(f"{self_count * 100 / stack_samples:6.1f}% {total * 100 / stack_samples:6.1f}%  {frame}")
+        return "\n".join(lines)
+
+    def write(self, directory: str, prefix: str = "profile") -> Tuple[str, str]:
+        """写入折叠栈文件和函数统计，返回两个文件路径"""
+        name = f"{prefix}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started_at))}"
+        collapsed_path = os.path.join(directory, f"{name}.collapsed")
+        summary_path = os.path.join(directory, f"{name}.txt")
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write(self.summary(top=200) + "\n")
+        return collapsed_path, summary_path
+
+
+class SamplingProfiler:
+    """采样式性能分析器
+
+    后台线程按固定间隔读取所有线程的调用栈（sys._current_frames），不插桩、不影响被分析的代码，
+    开销只与采样频率有关。path_filter 不为空时只保留经过该目录下代码的调用栈，
+    机器人框架自身的线程不会计入结果；include_idle 为False时跳过阻塞等待中的线程，结果反映CPU热点。
+    每次采样最长持续 max_duration 秒，未指定时长或按命令数停止时同样受此限制。
+    """
+
+    def __init__(self, interval: float = 0.01, path_filter: Optional[str] = None, max_depth: int = 64, include_idle: bool = False,
+                 max_duration: float = 600):
+        self.interval = max(0.001, float(interval))
+        self.max_duration = max_duration
+        self.path_filter = path_filter
+        self.max_depth = max_depth
+        self.include_idle = include_idle
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._requests = 0
+        self._max_requests: Optional[int] = None
+        self._labels = {}  # code对象 -> 帧标签，避免每次采样重复格式化
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: Optional[float] = None, max_requests: Optional[int] = None,
+              on_finish: Optional[Callable[[ProfileResult], None]] = None) -> bool:
+        """开始采样，达到时长（不超过 max_duration）或处理完指定数量的命令后停止；已在运行时返回False"""
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._requests = 0
+            self._max_requests = max_requests
+            self._thread = threading.Thread(target=self._run, args=(duration, on_finish), name="gemini-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> bool:
+        """提前停止采样，结果仍通过 on_finish 回调返回"""
+        if not self.running:
+            return False
+        self._stop.set()
+        return True
+
+    def record_request(self) -> None:
+        """处理完一条命令时调用，用于按命令数量停止采样"""
+        if self._max_requests is None or not self.running:
+            return
+        with self._lock:
+            self._requests += 1
+            if self._requests >= self._max_requests:
+                self._stop.set()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _sample(self, stacks: Counter, own_ident: int) -> None:
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            if not self.include_idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            codes = []
+            matched = self.path_filter is None
+            while frame is not None and len(codes) < self.max_depth:
+                code = frame.f_code
+                codes.append(code)
+                if not matched and code.co_filename.startswith(self.path_filter):
+                    matched = True
+                frame = frame.f_back
+            if matched:
+                stacks[tuple(self._label(code) for code in reversed(codes))] += 1
+
+    def _run(self, duration: Optional[float], on_finish: Optional[Callable[[ProfileResult], None]]) -> None:
+        stacks = Counter()
+        samples = 0
+        own_ident = threading.get_ident()
+        started_at = time.time()
+        deadline = started_at + min(duration if duration is not None else self.max_duration, self.max_duration)
+        while not self._stop.is_set() and time.time() < deadline:
+            self._sample(stacks, own_ident)
+            samples += 1
+            self._stop.wait(self.interval)
+        result = ProfileResult(stacks, samples, started_at, time.time(), self._requests)
+        logger.info(f"性能采样结束: {result.samples} 次采样, {len(stacks)} 个不同调用栈")
+        if on_finish is not None:
+            try:
+                on_finish(result)
+            except Exception as e:
+                logger.error(f"处理性能采样结果失败: {e}")
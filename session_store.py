@@ -0,0 +1,383 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from loguru import logger
+
+
+class SessionStore:
+    """会话状态存储的抽象接口
+
+    状态按 namespace（插件上的属性名）+ key（会话ID/用户ID）存储为JSON文本，
+    图片等二进制数据按内容哈希单独存放，同一张图片只保存一份。
+    """
+
+    def load_namespace(self, namespace: str) -> Dict[str, Tuple[str, List[str]]]:
+        """返回 namespace 下所有条目：key -> (JSON文本, 引用的blob哈希列表)"""
+        raise NotImplementedError
+
+    def write_batch(self, upserts: List[Tuple[str, str, str, List[str]]], deletes: List[Tuple[str, str]], blobs: Dict[str, bytes]) -> None:
+        """在一个事务中写入 (namespace, key, JSON文本, blob哈希列表)、删除 (namespace, key) 并保存新blob"""
+        raise NotImplementedError
+
+    def get_blob(self, blob_hash: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def has_blob(self, blob_hash: str) -> bool:
+        raise NotImplementedError
+
+    def prune_blobs(self) -> int:
+        """删除不再被任何条目引用的blob，返回删除数量"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """基于SQLite的会话存储（标准库自带，无需额外依赖）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " blobs TEXT NOT NULL DEFAULT '', updated_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self._conn.commit()
+
+    def load_namespace(self, namespace: str) -> Dict[str, Tuple[str, List[str]]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value, blobs FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: (value, [h for h in blob_hashes.split(",") if h]) for key, value, blob_hashes in rows}
+
+    def write_batch(self, upserts, deletes, blobs) -> None:
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                if blobs:
+                    self._conn.executemany("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)", list(blobs.items()))
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO kv (namespace, key, value, blobs, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        [(ns, key, value, ",".join(hashes), now) for ns, key, value, hashes in upserts]
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", deletes)
+
+    def get_blob(self, blob_hash: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def has_blob(self, blob_hash: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)).fetchone() is not None
+
+    def prune_blobs(self) -> int:
+        with self._lock:
+            referenced = set()
+            for (blob_hashes,) in self._conn.execute("SELECT blobs FROM kv WHERE blobs != ''"):
+                referenced.update(blob_hashes.split(","))
+            stale = [(h,) for (h,) in self._conn.execute("SELECT hash FROM blobs") if h not in referenced]
+            if stale:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM blobs WHERE hash = ?", stale)
+        return len(stale)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStateManager:
+    """管理绑定到存储的状态字典：负责编码/解码和后台批量写入（write-behind）"""
+
+    def __init__(self, store: SessionStore, flush_interval: float = 2.0, watch_seconds: float = 300):
+        self.store = store
+        self.flush_interval = flush_interval
+        # 被读取过的条目在该时间内每次刷新都会检查是否有变化（调用方可能持有引用并原地修改）
+        self.watch_seconds = watch_seconds
+        self._dicts: List["PersistentDict"] = []
+        self._flush_lock = threading.Lock()
+        self._blob_memo: Dict[int, Tuple[Any, str]] = {}  # id(数据) -> (数据, 哈希)，同一对象反复落盘时不重复计算哈希
+        self._known_blobs: Set[str] = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"flushes": 0, "rows_written": 0, "rows_deleted": 0, "blobs_written": 0, "errors": 0}
+
+    def bind(self, namespace: str, default_factory: Optional[Callable[[], Any]] = None) -> "PersistentDict":
+        state = PersistentDict(self, namespace, default_factory)
+        self._dicts.append(state)
+        return state
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="gemini_session_flush", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> int:
+        """将所有已变化的条目批量写入存储，返回写入+删除的条目数"""
+        with self._flush_lock:
+            upserts, deletes, blobs, commits = [], [], {}, []
+            for state in self._dicts:
+                state_upserts, state_deletes = state._collect_changes(blobs)
+                upserts.extend((state.namespace, key, value, hashes) for key, value, hashes in state_upserts)
+                deletes.extend((state.namespace, key) for key in state_deletes)
+                commits.append((state, state_upserts, state_deletes))
+            if not upserts and not deletes:
+                return 0
+            try:
+                self.store.write_batch(upserts, deletes, blobs)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"会话状态写入失败: {str(e)}")
+                return 0
+            for state, state_upserts, state_deletes in commits:
+                state._mark_committed(state_upserts, state_deletes)
+            self._known_blobs.update(blobs)
+            if len(self._blob_memo) > 4096:
+                self._blob_memo.clear()
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(upserts)
+            self.stats["rows_deleted"] += len(deletes)
+            self.stats["blobs_written"] += len(blobs)
+            return len(upserts) + len(deletes)
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+        self.store.close()
+
+    def _blob_ref(self, obj, blobs: Dict[str, bytes]) -> str:
+        """返回二进制数据（或base64字符串）的内容哈希，新blob放入 blobs 等待写入"""
+        memo = self._blob_memo.get(id(obj))
+        if memo is not None and memo[0] is obj and memo[1] in self._known_blobs:
+            return memo[1]
+        data = base64.b64decode(obj) if isinstance(obj, str) else bytes(obj)
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if blob_hash not in self._known_blobs:
+            blobs[blob_hash] = data
+        self._blob_memo[id(obj)] = (obj, blob_hash)
+        return blob_hash
+
+    def encode(self, value: Any, blobs: Dict[str, bytes]) -> Tuple[str, List[str]]:
+        """编码为JSON文本，二进制数据和base64图片替换为blob引用"""
+        hashes = []
+
+        def walk(obj):
+            if isinstance(obj, (bytes, bytearray)):
+                blob_hash = self._blob_ref(obj, blobs)
+                hashes.append(blob_hash)
+                return {"__blob__": blob_hash}
+            if isinstance(obj, dict):
+                result = {}
+                is_inline_image = "mime_type" in obj or "mimeType" in obj
+                for k, v in obj.items():
+                    if is_inline_image and k == "data" and isinstance(v, str) and len(v) > 256:
+                        blob_hash = self._blob_ref(v, blobs)
+                        hashes.append(blob_hash)
+                        result[k] = {"__blob_b64__": blob_hash}
+                    else:
+                        result[str(k)] = walk(v)
+                return result
+            if isinstance(obj, (list, tuple)):
+                return [walk(v) for v in obj]
+            return obj
+
+        return json.dumps(walk(value), ensure_ascii=False, sort_keys=True), hashes
+
+    def decode(self, text: str) -> Any:
+        def walk(obj):
+            if isinstance(obj, dict):
+                if len(obj) == 1 and "__blob__" in obj:
+                    return self.store.get_blob(obj["__blob__"]) or b""
+                if len(obj) == 1 and "__blob_b64__" in obj:
+                    data = self.store.get_blob(obj["__blob_b64__"]) or b""
+                    return base64.b64encode(data).decode("utf-8")
+                return {k: walk(v) for k, v in obj.items()}
+            if isinstance(obj, list):
+                return [walk(v) for v in obj]
+            return obj
+
+        return walk(json.loads(text))
+
+
+class PersistentDict(MutableMapping):
+    """绑定到会话存储的字典
+
+    - 首次访问时才从存储读取该namespace的条目，条目的值在首次读取时才解码（含blob）
+    - 写入先进入内存，由 SessionStateManager 在后台批量落盘
+    - default_factory 行为与 defaultdict 相同
+    """
+
+    def __init__(self, manager: SessionStateManager, namespace: str, default_factory: Optional[Callable[[], Any]] = None):
+        self.manager = manager
+        self.namespace = namespace
+        self.default_factory = default_factory
+        self._lock = threading.RLock()
+        self._data: Dict[Any, Any] = {}
+        self._raw: Optional[Dict[str, str]] = None  # 已从存储读取、尚未解码的条目
+        self._persisted: Dict[str, str] = {}  # key -> 最近一次落盘的JSON文本
+        self._touched: Dict[Any, float] = {}  # key -> 最近一次读写时间
+        self._deleted: Set[str] = set()
+
+    def _ensure_loaded(self) -> None:
+        if self._raw is not None:
+            return
+        with self._lock:
+            if self._raw is None:
+                try:
+                    rows = self.manager.store.load_namespace(self.namespace)
+                except Exception as e:
+                    logger.error(f"读取会话状态 {self.namespace} 失败: {str(e)}")
+                    rows = {}
+                self._raw = {key: value for key, (value, _) in rows.items()}
+                self._persisted = dict(self._raw)
+                self.manager._known_blobs.update(h for _, hashes in rows.values() for h in hashes)
+
+    def _materialize(self, key) -> None:
+        raw = self._raw.pop(key, None) if isinstance(key, str) else None
+        if raw is not None:
+            try:
+                self._data[key] = self.manager.decode(raw)
+            except Exception as e:
+                logger.warning(f"解码会话状态 {self.namespace}/{key} 失败，已丢弃: {str(e)}")
+                self._deleted.add(key)
+
+    def __getitem__(self, key):
+        self._ensure_loaded()
+        with self._lock:
+            self._materialize(key)
+            if key not in self._data:
+                if self.default_factory is None:
+                    raise KeyError(key)
+                self._data[key] = self.default_factory()
+                self._deleted.discard(str(key))
+            self._touched[key] = time.time()
+            return self._data[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._ensure_loaded()
+        with self._lock:
+            if isinstance(key, str):
+                self._raw.pop(key, None)
+            self._data[key] = value
+            self._touched[key] = time.time()
+            self._deleted.discard(str(key))
+
+    def __delitem__(self, key) -> None:
+        self._ensure_loaded()
+        with self._lock:
+            if isinstance(key, str) and self._raw.pop(key, None) is not None:
+                self._deleted.add(key)
+                return
+            if key not in self._data:
+                raise KeyError(key)
+            del self._data[key]
+            self._touched.pop(key, None)
+            self._deleted.add(str(key))
+
+    def __contains__(self, key) -> bool:
+        self._ensure_loaded()
+        with self._lock:
+            return key in self._data or (isinstance(key, str) and key in self._raw)
+
+    def get(self, key, default=None):
+        self._ensure_loaded()
+        with self._lock:
+            if key in self:
+                return self[key]
+            return default
+
+    def pop(self, key, *default):
+        """取出并删除，整个过程持有锁，并发调用时只有一个能拿到值"""
+        with self._lock:
+            if key in self:
+                value = self[key]
+                del self[key]
+                return value
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key in self:
+                return self[key]
+            self[key] = default
+            return default
+
+    def __iter__(self) -> Iterator:
+        self._ensure_loaded()
+        with self._lock:
+            return iter(list(self._data) + list(self._raw))
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        with self._lock:
+            return len(self._data) + len(self._raw)
+
+    def __repr__(self) -> str:
+        return f"PersistentDict({self.namespace!r}, {len(self)} entries)"
+
+    def _collect_changes(self, blobs: Dict[str, bytes]) -> Tuple[List[Tuple[str, str, List[str]]], List[str]]:
+        """收集自上次落盘以来变化的条目"""
+        if self._raw is None:
+            return [], []
+        now = time.time()
+        upserts = []
+        with self._lock:
+            for key, touched_at in list(self._touched.items()):
+                if now - touched_at > self.manager.watch_seconds:
+                    self._touched.pop(key, None)
+                if key not in self._data:
+                    continue
+                try:
+                    text, hashes = self.manager.encode(self._data[key], blobs)
+                except Exception as e:
+                    # 其他线程正在修改该值，或值无法序列化，下次刷新时重试
+                    logger.debug(f"编码会话状态 {self.namespace}/{key} 失败: {str(e)}")
+                    continue
+                if self._persisted.get(str(key)) != text:
+                    upserts.append((str(key), text, hashes))
+            deletes = [key for key in self._deleted if key in self._persisted]
+            self._deleted.difference_update(set(self._deleted) - set(deletes))
+        return upserts, deletes
+
+    def _mark_committed(self, upserts: List[Tuple[str, str, List[str]]], deletes: List[str]) -> None:
+        with self._lock:
+            for key, text, _ in upserts:
+                self._persisted[key] = text
+            for key in deletes:
+                self._persisted.pop(key, None)
+                self._deleted.discard(key)
+
+
+def create_session_store(kind: str, path: str) -> Optional[SessionStore]:
+    """根据配置创建会话存储，kind 为 "memory"/"none" 时不持久化，返回None"""
+    kind = (kind or "memory").lower()
+    if kind in ("memory", "none", ""):
+        return None
+    if kind == "sqlite":
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SQLiteSessionStore(path)
+    raise ValueError(f"不支持的会话存储类型: {kind}")
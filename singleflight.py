@@ -0,0 +1,49 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """合并并发的相同请求
+
+    同一个key在同一时刻只会真正执行一次 fn，期间到达的其他调用方等待并共享
+    同一个结果（或同一个异常）。执行结束后key立即释放，不做结果缓存。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.stats = defaultdict(int)  # executed: 实际执行次数, shared: 共享结果而省下的调用次数
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return self.do_with_status(key, fn, *args, **kwargs)[0]
+
+    def do_with_status(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Tuple[Any, bool]:
+        """与 do 相同，额外返回本次调用是否共享了其他调用方的结果"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats["shared"] += 1
+                leader = False
+            else:
+                future = Future()
+                self._calls[key] = future
+                self.stats["executed"] += 1
+                leader = True
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        return future.result(), False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
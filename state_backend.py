@@ -0,0 +1,239 @@
+import base64
+import json
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Iterator, List, Optional
+
+from loguru import logger
+
+
+class StateBackend:
+    """跨进程共享的键值状态后端
+
+    值需为可JSON序列化的数据（bytes会自动转为base64），None 表示键不存在。
+    ttl 单位为秒，由后端负责过期清理。
+    """
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def compare_and_set(self, key: str, expected: Any, new: Any, ttl: Optional[float] = None) -> bool:
+        """当前值等于 expected 时原子地替换为 new（expected 为None表示键必须不存在，new 为None表示删除）"""
+        raise NotImplementedError
+
+    def keys(self, prefix: str) -> List[str]:
+        raise NotImplementedError
+
+
+class MemoryStateBackend(StateBackend):
+    """进程内状态后端，用于单进程部署和测试"""
+
+    def __init__(self):
+        self._data = {}  # key -> (expire_at或None, value)
+        self._lock = threading.Lock()
+
+    def _get_locked(self, key: str) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at is not None and expire_at < time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def _set_locked(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            return self._get_locked(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._set_locked(key, value, ttl)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            existed = self._get_locked(key) is not None
+            self._data.pop(key, None)
+            return existed
+
+    def compare_and_set(self, key: str, expected: Any, new: Any, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._get_locked(key) != expected:
+                return False
+            self._set_locked(key, new, ttl)
+            return True
+
+    def keys(self, prefix: str) -> List[str]:
+        with self._lock:
+            return [key for key in list(self._data) if key.startswith(prefix) and self._get_locked(key) is not None]
+
+
+class RedisStateBackend(StateBackend):
+    """基于Redis的共享状态后端，多个机器人进程指向同一个Redis即可共享用户状态
+
+    依赖可选的 redis 包；也可以通过 client 参数传入兼容 redis-py 接口的客户端（例如测试用的本地替身）。
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", client: Any = None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("使用 redis 状态后端需要安装 redis 包：pip install redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    @staticmethod
+    def _encode(value: Any) -> str:
+        def default(obj):
+            if isinstance(obj, (bytes, bytearray)):
+                return {"__bytes__": base64.b64encode(bytes(obj)).decode("utf-8")}
+            raise TypeError(f"无法序列化的类型: {type(obj).__name__}")
+        return json.dumps(value, ensure_ascii=False, default=default)
+
+    @staticmethod
+    def _decode(raw: Any) -> Any:
+        if raw is None:
+            return None
+        def object_hook(obj):
+            if len(obj) == 1 and "__bytes__" in obj:
+                return base64.b64decode(obj["__bytes__"])
+            return obj
+        return json.loads(raw, object_hook=object_hook)
+
+    def get(self, key: str) -> Any:
+        return self._decode(self.client.get(key))
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        if value is None:
+            self.client.delete(key)
+        else:
+            self.client.set(key, self._encode(value), px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str) -> bool:
+        return bool(self.client.delete(key))
+
+    def compare_and_set(self, key: str, expected: Any, new: Any, ttl: Optional[float] = None) -> bool:
+        from redis.exceptions import WatchError
+
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if self._decode(pipe.get(key)) != expected:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    if new is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, self._encode(new), px=int(ttl * 1000) if ttl else None)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    # 其他进程在此期间修改了该键，重新比较
+                    continue
+
+    def keys(self, prefix: str) -> List[str]:
+        return [key.decode("utf-8") if isinstance(key, bytes) else key for key in self.client.scan_iter(match=f"{prefix}*")]
+
+
+class BackendDict(MutableMapping):
+    """将状态后端的一个命名空间包装为字典
+
+    读写直接落到后端，每次写入都带上命名空间的TTL。pop 和 setdefault 基于
+    compare_and_set 实现，可用于跨进程的原子状态转换（例如只允许一个进程认领等待中的图片操作）。
+    注意：读取到的值是副本，原地修改不会写回后端，需要重新赋值。
+    """
+
+    def __init__(self, backend: StateBackend, namespace: str, ttl: Optional[float] = None, prefix: str = "gemini_image"):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self._prefix = f"{prefix}:{namespace}:"
+
+    def _key(self, key: str) -> str:
+        return f"{self._prefix}{key}"
+
+    def __getitem__(self, key):
+        value = self.backend.get(self._key(key))
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        self.backend.set(self._key(key), value, self.ttl)
+
+    def __delitem__(self, key) -> None:
+        if not self.backend.delete(self._key(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self.backend.get(self._key(key)) is not None
+
+    def get(self, key, default=None):
+        value = self.backend.get(self._key(key))
+        return default if value is None else value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([key[len(self._prefix):] for key in self.backend.keys(self._prefix)])
+
+    def __len__(self) -> int:
+        return len(self.backend.keys(self._prefix))
+
+    def __repr__(self) -> str:
+        return f"BackendDict({self.namespace!r})"
+
+    def compare_and_set(self, key, expected: Any, new: Any) -> bool:
+        return self.backend.compare_and_set(self._key(key), expected, new, self.ttl)
+
+    def pop(self, key, *default):
+        """原子地取出并删除，多个进程同时pop同一个键时只有一个能拿到值"""
+        while True:
+            value = self.backend.get(self._key(key))
+            if value is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            if self.compare_and_set(key, value, None):
+                return value
+
+    def setdefault(self, key, default=None):
+        """键不存在时原子地写入 default 并返回 default 本身，否则返回已有的值"""
+        while True:
+            if self.compare_and_set(key, None, default):
+                return default
+            value = self.backend.get(self._key(key))
+            if value is not None:
+                return value
+
+
+def create_state_backend(kind: str, url: str = "") -> Optional[StateBackend]:
+    """根据配置创建共享状态后端
+
+    kind: "memory" 返回None（继续使用进程内字典）；"local" 进程内后端；"redis" 共享Redis
+    """
+    kind = (kind or "memory").lower()
+    if kind in ("memory", "none", ""):
+        return None
+    if kind == "local":
+        # 进程内的后端实现，行为与共享后端一致，用于本地验证多进程相关逻辑
+        return MemoryStateBackend()
+    if kind == "redis":
+        backend = RedisStateBackend(url or "redis://localhost:6379/0")
+        logger.info(f"已连接共享状态后端: {url}")
+        return backend
+    raise ValueError(f"不支持的状态后端类型: {kind}")
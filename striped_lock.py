@@ -0,0 +1,30 @@
+import threading
+from contextlib import contextmanager
+from typing import Hashable, Iterable, Iterator
+
+
+class StripedLock:
+    """按key分片的可重入锁
+
+    固定数量的锁按 hash(key) 分配给各个用户，同一用户的状态修改互斥，
+    不同用户大概率落在不同分片上互不阻塞，也不需要为每个用户创建和回收锁对象。
+    持锁期间只应做内存状态的读写，不要发起网络请求。
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(max(1, int(stripes)))]
+
+    def __call__(self, key: Hashable) -> threading.RLock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    @contextmanager
+    def acquire_many(self, keys: Iterable[Hashable]) -> Iterator[None]:
+        """同时锁定多个key，按分片序号加锁，避免死锁"""
+        indexes = sorted({hash(key) % len(self._locks) for key in keys})
+        for index in indexes:
+            self._locks[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self._locks[index].release()
@@ -0,0 +1,109 @@
+"""异步上游客户端：响应转换、异常映射、abort_check 取消和 in_flight 计数
+
+针对进程内的模拟Gemini服务（tools/mock_gemini_server.py）分别测试 aiohttp 和 httpx，未安装的库跳过。
+"""
+import os
+import socket
+import sys
+import time
+
+import pytest
+import requests
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PLUGIN_DIR)
+sys.path.insert(0, os.path.join(PLUGIN_DIR, "tools"))
+
+from async_upstream import AsyncUpstreamClient, resolve_backend  # noqa: E402
+from mock_gemini_server import MockOptions, start_in_thread  # noqa: E402
+
+SLOW = 1.0  # 模拟服务中图像模型的响应耗时
+
+
+class _Cancelled(BaseException):
+    """与插件的 JobCancelled 一样继承 BaseException"""
+
+
+@pytest.fixture(scope="module")
+def mock_url():
+    server, url = start_in_thread(MockOptions(image_latency=f"fixed:{SLOW}", image_size="16x16", noise=False, image_variants=1))
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["aiohttp", "httpx"])
+def client(request):
+    pytest.importorskip(request.param)
+    client = AsyncUpstreamClient(request.param, max_connections=10, poll_interval=0.02)
+    yield client
+    client.close()
+
+
+def _wait_idle(client, timeout=2.0):
+    deadline = time.time() + timeout
+    while client.in_flight and time.time() < deadline:
+        time.sleep(0.01)
+    return client.in_flight
+
+
+def test_resolve_backend():
+    assert resolve_backend("requests") is None
+    with pytest.raises(ValueError):
+        resolve_backend("urllib3")
+
+
+def test_post_returns_requests_response(client, mock_url):
+    response = client.post(f"{mock_url}/v1beta/models/gemini-text:generateContent", headers={"Authorization": "Bearer k"},
+                           params={"alt": "json"}, json={"contents": [{"parts": [{"text": "你好"}]}]}, timeout=5)
+    assert isinstance(response, requests.Response)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert "你好" in response.json()["candidates"][0]["content"]["parts"][0]["text"]
+    assert "alt=json" in response.url
+    assert client.in_flight == 0
+
+
+def test_error_status_is_returned_not_raised(client, mock_url):
+    response = client.post(f"{mock_url}/v1beta/unknown", json={}, timeout=5)
+    assert response.status_code == 404
+    assert client.in_flight == 0
+
+
+def test_read_timeout_maps_to_requests_timeout(client, mock_url):
+    started = time.time()
+    with pytest.raises(requests.exceptions.Timeout):
+        client.post(f"{mock_url}/v1beta/models/gemini-image:generateContent", json={}, timeout=0.2)
+    assert time.time() - started < SLOW
+    assert _wait_idle(client) == 0
+
+
+def test_connection_error_maps_to_requests_connection_error(client):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(f"http://127.0.0.1:{port}/v1beta/models/m:generateContent", json={}, timeout=2)
+    assert _wait_idle(client) == 0
+
+
+def test_abort_check_cancels_request(client, mock_url):
+    started = time.time()
+
+    def abort_check():
+        if time.time() - started > 0.1:
+            raise _Cancelled()
+
+    with pytest.raises(_Cancelled):
+        client.post(f"{mock_url}/v1beta/models/gemini-image:generateContent", abort_check=abort_check, json={}, timeout=5)
+    assert time.time() - started < SLOW
+    # 取消后事件循环中的请求被中止，不会等到模拟服务返回
+    assert _wait_idle(client, timeout=SLOW / 2) == 0
+
+
+def test_submit_runs_requests_concurrently(client, mock_url):
+    started = time.time()
+    futures = [client.submit("POST", f"{mock_url}/v1beta/models/gemini-image:generateContent", json={}, timeout=5) for _ in range(4)]
+    assert [future.result(timeout=5).status_code for future in futures] == [200] * 4
+    assert time.time() - started < SLOW * 2
+    assert client.in_flight == 0
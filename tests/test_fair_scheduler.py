@@ -0,0 +1,76 @@
+"""同一批次的请求共享一个用户并发名额（-n 多变体生成），但不能占满其他用户的名额"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fair_scheduler import FairScheduler  # noqa: E402
+
+
+def _run_concurrently(scheduler, requests, hold=0.2):
+    """按顺序依次发起 (用户, 批次) 请求并发执行，返回 (同时运行的最大请求数, 各请求的排队等待秒数)"""
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+    waits = [None] * len(requests)
+
+    def worker(index, user_id, batch):
+        queued_at = time.time()
+        with scheduler.slot(user_id, kind="image", batch=batch, timeout=5):
+            waits[index] = time.time() - queued_at
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(hold)
+            with lock:
+                state["running"] -= 1
+
+    threads = [threading.Thread(target=worker, args=(index, *request)) for index, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)  # 保证按列表顺序排队
+    for thread in threads:
+        thread.join()
+    return state["peak"], waits
+
+
+def test_batch_runs_beyond_per_user_limit_but_below_kind_limit():
+    scheduler = FairScheduler(max_concurrent=8, per_user_limit=2, kind_limits={"image": 4})
+    batch = object()
+    # 批次只占一个用户名额，但同时最多执行 图像上限-1 个请求
+    peak, _ = _run_concurrently(scheduler, [("alice", batch)] * 4)
+    assert peak == 3
+    snapshot = scheduler.snapshot()
+    assert snapshot["running"] == 0 and snapshot["running_by_user"] == {} and snapshot["running_batches"] == 0
+
+
+def test_other_user_starts_while_batch_is_running():
+    scheduler = FairScheduler(max_concurrent=8, per_user_limit=2, kind_limits={"image": 4})
+    batch = object()
+    peak, waits = _run_concurrently(scheduler, [("alice", batch)] * 4 + [("bob", None)])
+    assert peak == 4
+    # bob 不需要等待 alice 的变体完成
+    assert waits[-1] < 0.1
+    assert waits[3] >= 0.1
+
+
+def test_batch_and_normal_requests_share_the_user_limit():
+    scheduler = FairScheduler(max_concurrent=8, per_user_limit=2, kind_limits={"image": 8})
+    batch = object()
+    # 批次占一个名额，另外两个普通请求只能再执行一个
+    peak, _ = _run_concurrently(scheduler, [("alice", batch)] * 3 + [("alice", None)] * 2)
+    assert peak == 4
+
+
+def test_parallel_batches_are_capped_together():
+    scheduler = FairScheduler(max_concurrent=8, per_user_limit=2, kind_limits={"image": 6})
+    first, second = object(), object()
+    peak, _ = _run_concurrently(scheduler, [("alice", first)] * 4 + [("alice", second)] * 4)
+    assert peak == 5
+
+
+def test_per_user_batch_limit_overrides_default():
+    scheduler = FairScheduler(max_concurrent=8, per_user_limit=1, kind_limits={"image": 4}, per_user_batch_limit=2)
+    peak, _ = _run_concurrently(scheduler, [("alice", object())] * 4)
+    assert peak == 2
@@ -0,0 +1,133 @@
+"""对冲请求：race 的获胜/取消逻辑、对冲预算和耗时分位数"""
+import os
+import sys
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hedging import HedgeBudget, HedgePolicy, LatencyWindow, race  # noqa: E402
+
+
+def _later(seconds, result=None, error=None):
+    """返回一个 seconds 秒后完成的 Future"""
+    future = Future()
+
+    def finish():
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    threading.Timer(seconds, finish).start()
+    return future
+
+
+def _ok(result):
+    return result == "ok"
+
+
+def test_primary_wins_before_hedge_fires():
+    hedges = []
+    result, winner, hedged = race(lambda: _later(0.02, "ok"), lambda: hedges.append(1) or _later(0, "ok"), 0.5, _ok)
+    assert (result, winner, hedged) == ("ok", 0, False)
+    assert not hedges
+
+
+def test_hedge_wins_and_primary_is_cancelled():
+    primary = Future()  # 一直不返回
+    result, winner, hedged = race(lambda: primary, lambda: _later(0.02, "ok"), 0.05, _ok)
+    assert (result, winner, hedged) == ("ok", 1, True)
+    assert primary.cancelled()
+
+
+def test_hedge_loses_and_is_cancelled():
+    hedge = Future()
+    result, winner, hedged = race(lambda: _later(0.1, "ok"), lambda: hedge, 0.02, _ok)
+    assert (result, winner, hedged) == ("ok", 0, True)
+    assert hedge.cancelled()
+
+
+def test_primary_failure_before_delay_returns_without_hedge():
+    hedges = []
+    result, winner, hedged = race(lambda: _later(0.02, "503"), lambda: hedges.append(1) or Future(), 0.5, _ok)
+    assert (result, winner, hedged) == ("503", 0, False)
+    assert not hedges
+
+    with pytest.raises(ConnectionError):
+        race(lambda: _later(0.02, error=ConnectionError("reset")), lambda: hedges.append(1) or Future(), 0.5, _ok)
+    assert not hedges
+
+
+def test_both_fail_returns_last_failure():
+    result, winner, hedged = race(lambda: _later(0.1, "503"), lambda: _later(0.02, "429"), 0.02, _ok)
+    assert (result, winner, hedged) == ("503", 0, True)
+
+
+def test_empty_budget_skips_hedge():
+    budget = HedgeBudget(ratio=0.5, burst=1)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+
+    result, winner, hedged = race(lambda: _later(0.1, "ok"),
+                                  lambda: _later(0, "ok") if budget.try_spend() else None, 0.02, _ok)
+    assert (result, winner, hedged) == ("ok", 0, False)
+
+    # 每个主请求存入 ratio 个令牌，攒够1个后可以再对冲
+    budget.deposit()
+    assert not budget.try_spend()
+    budget.deposit()
+    assert budget.try_spend()
+
+
+def test_budget_is_capped_at_burst():
+    budget = HedgeBudget(ratio=1, burst=2)
+    for _ in range(10):
+        budget.deposit()
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+
+
+def test_abort_check_cancels_all_requests():
+    primary, hedge = Future(), Future()
+    calls = []
+
+    def abort_check():
+        calls.append(1)
+        if len(calls) >= 3:
+            raise RuntimeError("cancelled")
+
+    with pytest.raises(RuntimeError):
+        race(lambda: primary, lambda: hedge, 0.01, _ok, abort_check=abort_check, poll_interval=0.01)
+    assert primary.cancelled() and hedge.cancelled()
+
+
+def test_latency_window_quantile():
+    window = LatencyWindow(size=100)
+    assert window.quantile(0.95) is None
+    for latency in range(1, 101):
+        window.add(latency)
+    assert len(window) == 100
+    assert window.quantile(0.5) == 51
+    assert window.quantile(0.95) == 96
+    assert window.quantile(1.0) == 100
+    # 只保留最近 size 个样本
+    window.add(1000)
+    assert len(window) == 100 and window.quantile(1.0) == 1000
+
+
+def test_policy_delay_needs_samples_and_respects_min_delay():
+    policy = HedgePolicy(percentile=0.5, min_samples=3, min_delay=1.0)
+    policy.observe("generate", 5)
+    policy.observe("generate", 6)
+    assert policy.delay("generate") is None
+    policy.observe("generate", 7)
+    assert policy.delay("generate") == 6
+    assert policy.delay("edit") is None
+    for _ in range(3):
+        policy.observe("edit", 0.1)
+    assert policy.delay("edit") == 1.0
@@ -0,0 +1,97 @@
+"""指标注册表的Prometheus文本输出，以及 /metrics 端点在重载后复用同一地址"""
+import os
+import socket
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from metrics import MetricsRegistry, cached, start_metrics_server  # noqa: E402
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _fetch(port, path="/metrics"):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=2) as response:
+        return response.read().decode("utf-8")
+
+
+def test_render():
+    registry = MetricsRegistry(prefix="gemini")
+    requests_total = registry.counter("requests_total", "请求数", ["mode"])
+    requests_total.inc(mode="generate")
+    requests_total.inc(2, mode='带"引号"')
+    latency = registry.histogram("latency_seconds", "耗时", ["mode"], buckets=(1, 5))
+    latency.observe(0.5, mode="edit")
+    latency.observe(3, mode="edit")
+    latency.observe(10, mode="edit")
+    registry.gauge("queue", "排队数", lambda: 3)
+    registry.gauge("broken", "采集失败", lambda: 1 / 0)
+    # 同名指标重复注册时返回已有的实例
+    assert registry.counter("requests_total", "请求数", ["mode"]) is requests_total
+
+    lines = registry.render().splitlines()
+    assert "# TYPE gemini_requests_total counter" in lines
+    assert 'gemini_requests_total{mode="generate"} 1' in lines
+    assert 'gemini_requests_total{mode="带\\"引号\\""} 2' in lines
+    assert 'gemini_latency_seconds_bucket{mode="edit",le="1"} 1' in lines
+    assert 'gemini_latency_seconds_bucket{mode="edit",le="5"} 2' in lines
+    assert 'gemini_latency_seconds_bucket{mode="edit",le="+Inf"} 3' in lines
+    assert 'gemini_latency_seconds_sum{mode="edit"} 13.5' in lines
+    assert 'gemini_latency_seconds_count{mode="edit"} 3' in lines
+    assert "gemini_queue 3" in lines
+    assert "# TYPE gemini_broken gauge" in lines and not any(line.startswith("gemini_broken ") for line in lines)
+
+
+def test_render_summary():
+    registry = MetricsRegistry(prefix="gemini")
+    registry.counter("requests_total", "请求数").inc()
+    registry.histogram("latency_seconds", "耗时", ["mode"]).observe(3, mode="edit")
+    registry.counter("unused_total", "未使用")
+    assert registry.render_summary().splitlines() == [
+        "requests_total 1",
+        'latency_seconds{mode="edit"} n=1 avg=3.00s',
+    ]
+
+
+def test_cached_value():
+    calls = []
+    value = cached(lambda: calls.append(1) or len(calls), ttl=60)
+    assert value() == 1 and value() == 1
+    assert len(calls) == 1
+
+
+def test_server_is_reused_for_the_same_address():
+    port = _free_port()
+    old, new = MetricsRegistry(prefix="old"), MetricsRegistry(prefix="new")
+    old.counter("requests_total", "请求数").inc()
+    new.counter("requests_total", "请求数").inc(5)
+
+    server = start_metrics_server(old, port=port)
+    try:
+        assert "old_requests_total 1" in _fetch(port)
+        # 插件重载后在同一地址启动时复用已有服务，改为输出新的注册表
+        assert start_metrics_server(new, port=port) is server
+        body = _fetch(port, "/")
+        assert "new_requests_total 5" in body and "old_requests_total" not in body
+        with pytest.raises(urllib.error.HTTPError):
+            _fetch(port, "/other")
+    finally:
+        metrics._servers.pop(("127.0.0.1", port), None)
+        server.shutdown()
+        server.server_close()
+
+
+def test_port_in_use_returns_none():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        assert start_metrics_server(MetricsRegistry(), port=sock.getsockname()[1]) is None
@@ -0,0 +1,173 @@
+"""融图没有返回图片时的重试、上下文缓存复用和安全拦截处理
+
+插件依赖 dify-on-wechat 的插件框架，需通过环境变量 DOW_ROOT 指定其目录，未设置时跳过：
+    DOW_ROOT=../dify-on-wechat python -m pytest tests
+上游请求全部发往进程内的模拟Gemini服务（tools/mock_gemini_server.py）。
+"""
+import argparse
+import base64
+import os
+import sys
+
+import pytest
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools")
+sys.path.insert(0, TOOLS_DIR)
+
+from load_test import LoadGenerator, build_plugin_config, load_plugin  # noqa: E402
+from mock_gemini_server import MockOptions, make_png, start_in_thread  # noqa: E402
+
+DOW_ROOT = os.environ.get("DOW_ROOT")
+pytestmark = pytest.mark.skipif(not DOW_ROOT, reason="需要设置 DOW_ROOT 为 dify-on-wechat 目录")
+
+WAITING_REPLY = {"parts": [{"text": "好的，正在生成，请稍等。"}]}
+SAFETY_BLOCK = {"parts": [], "finishReason": "IMAGE_SAFETY"}
+
+
+@pytest.fixture(scope="module")
+def mock():
+    options = MockOptions(image_size="64x64", noise=False, image_variants=1, record_bodies=True)
+    server, url = start_in_thread(options)
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def plugin(mock, tmp_path_factory):
+    work_dir = str(tmp_path_factory.mktemp("gemini"))
+    config = build_plugin_config(mock[1], work_dir, argparse.Namespace(translate=False, set=None))
+    config.update({"enable_context_cache": True, "context_cache_min_tokens": 0, "merge_reprompt_attempts": 3})
+    return load_plugin(DOW_ROOT, config)
+
+
+@pytest.fixture
+def upstream(mock, plugin):
+    """清空模拟服务的记录和插件的上下文缓存，返回 (预设响应列表, 已收到的请求体列表)"""
+    server = mock[0]
+    options, state = server.RequestHandlerClass.options, server.RequestHandlerClass.state
+    options.responses.clear()
+    state.bodies.clear()
+    plugin.context_caches.clear()
+    plugin.context_cache_stats.clear()
+    return options.responses, state.bodies
+
+
+def _merge_request(plugin, seed: int):
+    """构造与融图相同格式的请求，返回 _reprompt_for_image 的前7个参数"""
+    images = [base64.b64encode(make_png(48 + seed, 48)).decode("utf-8") for _ in range(2)]
+    request_data = {
+        "contents": [{
+            "role": "user",
+            "parts": [{"text": "把两张图片融合在一起"}] + [{"inline_data": {"mime_type": "image/png", "data": data}} for data in images],
+        }],
+        "generationConfig": {"responseModalities": ["Text", "Image"]},
+    }
+    api_url, headers, params = plugin._gemini_api_target(f"models/{plugin.image_model}:generateContent")
+    return "merge", plugin.image_model, api_url, headers, params, None, request_data
+
+
+def _generate_bodies(bodies):
+    return [body for path, body in bodies if path.endswith(":generateContent")]
+
+
+def _cache_bodies(bodies):
+    return [body for path, body in bodies if path.rstrip("/").endswith("/cachedContents")]
+
+
+def test_reprompt_returns_image_after_waiting_reply(plugin, upstream):
+    responses, bodies = upstream
+    # 只重试一次时不创建上下文缓存
+    image_text_pairs, final_text, error, kind = plugin._reprompt_for_image(
+        *_merge_request(plugin, 0), "好的，正在生成，请稍等。", "waiting", 1, 0
+    )
+
+    assert error is None and kind is None
+    assert len(image_text_pairs) == 1
+    requests = _generate_bodies(bodies)
+    assert len(requests) == 1
+    # 原请求内容原样内联发送，末尾追加模型的回复和纠正提示
+    contents = requests[0]["contents"]
+    assert contents[-2] == {"role": "model", "parts": [{"text": "好的，正在生成，请稍等。"}]}
+    assert "不需要等待" in contents[-1]["parts"][0]["text"]
+    assert sum("inline_data" in part for part in contents[0]["parts"]) == 2
+    assert not _cache_bodies(bodies)
+
+
+def test_reprompt_creates_context_cache_once_and_reuses_it(plugin, upstream):
+    responses, bodies = upstream
+    responses.extend([WAITING_REPLY, WAITING_REPLY])
+    args = _merge_request(plugin, 1)
+
+    image_text_pairs, _, error, _ = plugin._reprompt_for_image(*args, "正在生成，请稍等", "waiting", 3, 0)
+
+    assert error is None and len(image_text_pairs) == 1
+    assert len(_cache_bodies(bodies)) == 1
+    requests = _generate_bodies(bodies)
+    assert len(requests) == 3
+    # 三次重试都引用同一个缓存，图片不再随请求上传
+    names = {body.get("cachedContent") for body in requests}
+    assert len(names) == 1 and None not in names
+    assert not any("inline_data" in part for body in requests for content in body["contents"] for part in content["parts"])
+    assert plugin.context_cache_stats["created"] == 1
+
+    # 相同图片再次需要重试时复用已有缓存，不再创建
+    bodies.clear()
+    image_text_pairs, _, error, _ = plugin._reprompt_for_image(*args, "正在生成，请稍等", "waiting", 2, 0)
+    assert error is None and len(image_text_pairs) == 1
+    assert not _cache_bodies(bodies)
+    assert _generate_bodies(bodies)[0]["cachedContent"] in names
+    assert plugin.context_cache_stats["reused"] == 1
+
+
+def test_expired_context_cache_entry_is_evicted(plugin, upstream):
+    responses, bodies = upstream
+    args = _merge_request(plugin, 3)
+    plugin._reprompt_for_image(*args, "正在生成，请稍等", "waiting", 2, 0)
+    (cache_key, entry), = plugin.context_caches.items()
+
+    # 本地记录随上游缓存一起过期，不会一直保留在内存中
+    plugin.context_caches.set(cache_key, entry, ttl=-1)
+    assert plugin.context_caches.items() == []
+    assert plugin.context_caches.get(cache_key) is None
+
+    plugin._reprompt_for_image(*args, "正在生成，请稍等", "waiting", 2, 0)
+    assert len(_cache_bodies(bodies)) == 2
+    assert plugin.context_cache_stats["created"] == 2
+
+
+def test_safety_block_is_not_reprompted(plugin, upstream):
+    responses, bodies = upstream
+    responses.append(SAFETY_BLOCK)
+
+    image_text_pairs, final_text, error, kind = plugin._reprompt_for_image(*_merge_request(plugin, 2), None, "empty", 3, 0)
+
+    assert image_text_pairs == [] and error is None
+    assert kind == "refusal"
+    assert len(_generate_bodies(bodies)) == 1
+
+    # 已被拦截的回复直接交给用户，不发出任何重试请求
+    bodies.clear()
+    result = plugin._reprompt_for_image(*_merge_request(plugin, 2), None, kind, 3, 0)
+    assert result == ([], None, None, "refusal")
+    assert not bodies
+
+
+def test_merge_reports_safety_block_without_retrying(plugin, upstream, tmp_path):
+    responses, bodies = upstream
+    responses.append(SAFETY_BLOCK)
+    image_paths = []
+    for index in range(2):
+        path = tmp_path / f"merge_{index}.png"
+        path.write_bytes(make_png(64, 64 + index))
+        image_paths.append(str(path))
+    generator = LoadGenerator(plugin, image_paths, users=1, groups=1)
+    group_id, user_id = generator.free_users[0]
+
+    replies = generator._send(group_id, user_id, "TEXT", f"{plugin.merge_commands[0]} 把两张图片融合在一起")
+    for path in image_paths:
+        replies += generator._send(group_id, user_id, "IMAGE", path)
+
+    assert len(_generate_bodies(bodies)) == 1
+    texts = [reply.content for reply in replies if getattr(reply.type, "name", None) == "TEXT"]
+    assert any("模型拒绝了这次融图请求" in text for text in texts)
@@ -0,0 +1,48 @@
+"""没有返回图片时的文本回复分类和重试提示"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_classifier import (  # noqa: E402
+    CLARIFICATION, DESCRIPTION, EMPTY, REFUSAL, RETRYABLE_KINDS, WAITING,
+    classify_text_response, is_blocked, reprompt_instruction,
+)
+
+
+@pytest.mark.parametrize("text, kind", [
+    (None, EMPTY),
+    ("   ", EMPTY),
+    ("抱歉，我无法为你生成这张图片。", REFUSAL),
+    ("该请求不符合内容政策", REFUSAL),
+    ("I can't help with that request.", REFUSAL),
+    ("请稍等，正在生成图片", WAITING),
+    ("Sure! Let me generate that for you.", WAITING),
+    ("你希望背景是白天还是夜晚？", CLARIFICATION),
+    ("Would you like a photo or a painting", CLARIFICATION),
+    ("一只橘猫坐在窗台上，阳光洒在它的毛上。", DESCRIPTION),
+    # 拒绝优先于等待
+    ("请稍等……抱歉，我不能生成这类图片", REFUSAL),
+    # 等待优先于反问
+    ("正在生成，你希望用什么风格？", WAITING),
+])
+def test_classify_text_response(text, kind):
+    assert classify_text_response(text) == kind
+
+
+def test_blocked_finish_reason_is_refusal():
+    assert is_blocked("SAFETY") and is_blocked("IMAGE_SAFETY")
+    assert not is_blocked("STOP") and not is_blocked(None) and not is_blocked("")
+    assert classify_text_response("", "SAFETY") == REFUSAL
+    assert classify_text_response("请稍等", "PROHIBITED_CONTENT") == REFUSAL
+    assert classify_text_response("", "STOP") == EMPTY
+
+
+def test_reprompt_instruction():
+    assert REFUSAL not in RETRYABLE_KINDS
+    for kind in RETRYABLE_KINDS:
+        assert reprompt_instruction(kind)
+    assert reprompt_instruction(WAITING) != reprompt_instruction(CLARIFICATION)
+    assert reprompt_instruction("unknown") == reprompt_instruction(EMPTY)
@@ -0,0 +1,151 @@
+"""会话状态持久化：后台批量写入、重新打开后读回、blob去重和延迟解码"""
+import base64
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import SessionStateManager, SQLiteSessionStore, create_session_store  # noqa: E402
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 8
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def _open(db_path, **kwargs):
+    manager = SessionStateManager(SQLiteSessionStore(db_path), **kwargs)
+    return manager, manager.bind("conversations", list), manager.bind("waiting")
+
+
+def _rows(db_path, table):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_create_session_store(db_path):
+    assert create_session_store("memory", db_path) is None
+    store = create_session_store("sqlite", db_path)
+    assert isinstance(store, SQLiteSessionStore)
+    store.close()
+    with pytest.raises(ValueError):
+        create_session_store("mysql", db_path)
+
+
+def test_write_flush_reopen_and_read_back(db_path):
+    manager, conversations, waiting = _open(db_path)
+    conversations["alice"].append({"role": "user", "parts": [{"text": "猫"}, {"image": IMAGE}]})
+    conversations["bob"] = [{"inline_data": {"mime_type": "image/png", "data": base64.b64encode(IMAGE).decode("utf-8")}}]
+    waiting["alice"] = {"prompt": "融合", "count": 2}
+    waiting[42] = "非字符串键按字符串保存"
+
+    # 写入先留在内存，刷新后才落盘
+    assert _rows(db_path, "kv") == 0
+    assert manager.flush() == 4
+    assert manager.flush() == 0
+    manager.close()
+
+    manager, conversations, waiting = _open(db_path)
+    assert len(conversations) == 2 and sorted(waiting) == ["42", "alice"]
+    assert conversations["alice"] == [{"role": "user", "parts": [{"text": "猫"}, {"image": IMAGE}]}]
+    assert conversations["bob"][0]["inline_data"]["data"] == base64.b64encode(IMAGE).decode("utf-8")
+    assert waiting["alice"] == {"prompt": "融合", "count": 2}
+    assert conversations["carol"] == []  # default_factory
+    manager.close()
+
+
+def test_blobs_are_deduplicated_by_content(db_path):
+    manager, conversations, _ = _open(db_path)
+    conversations["alice"] = [{"image": IMAGE}, {"image": bytes(IMAGE)}]
+    conversations["bob"] = [{"inline_data": {"mimeType": "image/png", "data": base64.b64encode(IMAGE).decode("utf-8")}}]
+    manager.flush()
+    assert _rows(db_path, "blobs") == 1
+    assert manager.stats["blobs_written"] == 1
+
+    # 已保存过的图片再次出现时不重复写入
+    conversations["carol"] = [{"image": IMAGE}]
+    manager.flush()
+    assert manager.stats["blobs_written"] == 1
+    with sqlite3.connect(db_path) as conn:
+        assert IMAGE.hex() not in conn.execute("SELECT value FROM kv WHERE key = 'alice'").fetchone()[0]
+    manager.close()
+
+
+def test_in_place_changes_of_read_values_are_flushed(db_path):
+    manager, conversations, _ = _open(db_path)
+    history = conversations["alice"]
+    manager.flush()
+    history.append({"role": "user", "parts": [{"text": "第一轮"}]})
+    assert manager.flush() == 1
+    manager.close()
+
+    manager, conversations, _ = _open(db_path)
+    assert conversations["alice"] == [{"role": "user", "parts": [{"text": "第一轮"}]}]
+    manager.close()
+
+
+def test_entries_are_decoded_lazily(db_path):
+    manager, conversations, _ = _open(db_path)
+    for key in ("alice", "bob"):
+        conversations[key] = [{"image": IMAGE + key.encode("utf-8")}]
+    manager.flush()
+    manager.close()
+
+    manager, conversations, _ = _open(db_path)
+    fetched = []
+    get_blob = manager.store.get_blob
+    manager.store.get_blob = lambda blob_hash: fetched.append(blob_hash) or get_blob(blob_hash)
+    assert len(conversations) == 2 and "alice" in conversations
+    assert not fetched
+    assert conversations["alice"][0]["image"] == IMAGE + b"alice"
+    assert len(fetched) == 1
+    manager.close()
+
+
+def test_deletes_and_blob_pruning(db_path):
+    manager, conversations, waiting = _open(db_path)
+    conversations["alice"] = [{"image": IMAGE}]
+    waiting["alice"] = 1
+    manager.flush()
+    manager.close()
+
+    manager, conversations, waiting = _open(db_path)
+    # 删除未解码的条目和 pop 都会在下次刷新时删除对应的行
+    del conversations["alice"]
+    assert waiting.pop("alice") == 1
+    assert waiting.pop("alice", None) is None
+    assert manager.flush() == 2
+    assert _rows(db_path, "kv") == 0
+    assert manager.store.prune_blobs() == 1
+    assert _rows(db_path, "blobs") == 0
+    manager.close()
+
+
+def test_undecodable_entries_are_dropped(db_path):
+    store = SQLiteSessionStore(db_path)
+    store.write_batch([("waiting", "alice", "{not json", [])], [], {})
+    manager = SessionStateManager(store)
+    waiting = manager.bind("waiting")
+    assert "alice" in waiting
+    with pytest.raises(KeyError):
+        waiting["alice"]
+    assert manager.flush() == 1
+    assert _rows(db_path, "kv") == 0
+    manager.close()
+
+
+def test_background_flush(db_path):
+    manager, _, waiting = _open(db_path, flush_interval=0.05)
+    manager.start()
+    waiting["alice"] = "等待图片"
+    deadline = time.time() + 2
+    while _rows(db_path, "kv") == 0 and time.time() < deadline:
+        time.sleep(0.02)
+    assert _rows(db_path, "kv") == 1
+    manager.close()
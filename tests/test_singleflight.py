@@ -0,0 +1,71 @@
+"""SingleFlight：并发的相同请求只执行一次并共享结果或异常"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singleflight import SingleFlight  # noqa: E402
+
+
+def _call_concurrently(flight, count, key, fn):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def worker(index):
+        barrier.wait()
+        try:
+            results[index] = flight.do_with_status(key, fn)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    def translate():
+        calls.append(1)
+        time.sleep(0.1)
+        return "a cat"
+
+    results = _call_concurrently(flight, 5, "猫", translate)
+    assert len(calls) == 1
+    assert sorted(results) == [("a cat", False)] + [("a cat", True)] * 4
+    assert flight.stats == {"executed": 1, "shared": 4}
+    assert flight.in_flight() == 0
+
+
+def test_exception_is_shared_and_key_released():
+    flight = SingleFlight()
+
+    def fail():
+        time.sleep(0.1)
+        raise ValueError("上游错误")
+
+    results = _call_concurrently(flight, 3, "key", fail)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats["executed"] == 1
+    # 失败后不缓存，下次调用重新执行
+    assert flight.do("key", lambda: "ok") == "ok"
+    assert flight.stats["executed"] == 2
+
+
+def test_different_keys_run_independently():
+    flight = SingleFlight()
+    assert flight.do("a", lambda value: value * 2, 2) == 4
+    assert flight.do("b", lambda value=0: value, value=3) == 3
+    assert flight.stats["executed"] == 2 and flight.stats["shared"] == 0
+    with pytest.raises(KeyError):
+        flight.do("c", {}.__getitem__, "missing")
+    assert flight.in_flight() == 0
@@ -0,0 +1,135 @@
+"""共享状态后端：BackendDict 的原子操作和 Redis 后端的过期时间
+
+Redis 后端使用 fakeredis（未安装时跳过对应用例）。
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_backend import BackendDict, MemoryStateBackend, RedisStateBackend, create_state_backend  # noqa: E402
+
+
+def _redis_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisStateBackend(client=fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=["local", "redis"])
+def backend(request):
+    return MemoryStateBackend() if request.param == "local" else _redis_backend()
+
+
+def test_create_state_backend():
+    assert create_state_backend("memory") is None
+    assert isinstance(create_state_backend("local"), MemoryStateBackend)
+    with pytest.raises(ValueError):
+        create_state_backend("etcd")
+
+
+def test_dict_roundtrip_and_namespaces(backend):
+    waiting = BackendDict(backend, "waiting")
+    other = BackendDict(backend, "other")
+    waiting["alice"] = {"prompt": "猫", "images": [b"\x89PNG\x00"]}
+    other["alice"] = 1
+
+    assert waiting["alice"] == {"prompt": "猫", "images": [b"\x89PNG\x00"]}
+    assert "alice" in waiting and "bob" not in waiting
+    assert waiting.get("bob", 0) == 0
+    assert list(waiting) == ["alice"] and len(waiting) == 1
+    del waiting["alice"]
+    assert "alice" not in waiting and other["alice"] == 1
+    with pytest.raises(KeyError):
+        del waiting["alice"]
+    with pytest.raises(KeyError):
+        waiting["alice"]
+
+
+def test_pop(backend):
+    state = BackendDict(backend, "pop")
+    state["alice"] = [1, 2]
+    assert state.pop("alice") == [1, 2]
+    assert "alice" not in state
+    assert state.pop("alice", None) is None
+    with pytest.raises(KeyError):
+        state.pop("alice")
+
+
+def test_concurrent_pop_is_claimed_once(backend):
+    state = BackendDict(backend, "claim")
+    state["alice"] = "job"
+    results = []
+    barrier = threading.Barrier(8)
+
+    def claim():
+        barrier.wait()
+        results.append(state.pop("alice", None))
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count("job") == 1
+    assert results.count(None) == 7
+
+
+def test_setdefault(backend):
+    state = BackendDict(backend, "setdefault")
+    assert state.setdefault("alice", {"n": 1}) == {"n": 1}
+    assert state.setdefault("alice", {"n": 2}) == {"n": 1}
+    assert state["alice"] == {"n": 1}
+
+
+def test_compare_and_set(backend):
+    state = BackendDict(backend, "cas")
+    assert state.compare_and_set("alice", None, 1)
+    assert not state.compare_and_set("alice", None, 2)
+    assert not state.compare_and_set("alice", 5, 2)
+    assert state.compare_and_set("alice", 1, 2)
+    assert state["alice"] == 2
+    # new 为 None 表示删除
+    assert state.compare_and_set("alice", 2, None)
+    assert "alice" not in state
+
+
+def test_namespace_ttl_expires_entries(backend):
+    state = BackendDict(backend, "ttl", ttl=0.2)
+    state["alice"] = 1
+    assert state.setdefault("bob", 2) == 2
+    assert "alice" in state and "bob" in state
+    time.sleep(0.35)
+    assert "alice" not in state and "bob" not in state
+    assert len(state) == 0
+
+
+def test_redis_writes_ttl_with_every_write():
+    backend = _redis_backend()
+    client = backend.client
+    with_ttl = BackendDict(backend, "ttl", ttl=60)
+    without_ttl = BackendDict(backend, "persistent")
+
+    with_ttl["alice"] = 1
+    without_ttl["alice"] = 1
+    assert 0 < client.pttl("gemini_image:ttl:alice") <= 60000
+    assert client.pttl("gemini_image:persistent:alice") == -1
+
+    # compare_and_set 替换值时同样刷新过期时间，而不是变成永久键
+    client.pexpire("gemini_image:ttl:alice", 1000)
+    assert with_ttl.compare_and_set("alice", 1, 2)
+    assert client.pttl("gemini_image:ttl:alice") > 1000
+    assert with_ttl.setdefault("bob", 3) == 3
+    assert 0 < client.pttl("gemini_image:ttl:bob") <= 60000
+
+
+def test_redis_bytes_are_stored_as_json():
+    backend = _redis_backend()
+    backend.set("key", {"data": b"\x00\xff"})
+    raw = backend.client.get("key")
+    assert b"__bytes__" in raw
+    assert backend.get("key") == {"data": b"\x00\xff"}
+    assert backend.get("missing") is None
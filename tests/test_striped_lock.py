@@ -0,0 +1,73 @@
+"""StripedLock：同一key互斥且可重入，acquire_many 按分片顺序加锁不会死锁"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from striped_lock import StripedLock  # noqa: E402
+
+
+def test_same_key_same_lock_and_reentrant():
+    locks = StripedLock(stripes=8)
+    assert locks("alice") is locks("alice")
+    with locks("alice"):
+        with locks("alice"):
+            pass
+    # 分片数至少为1
+    single = StripedLock(stripes=0)
+    assert single("alice") is single("bob")
+
+
+def test_same_key_is_mutually_exclusive():
+    locks = StripedLock(stripes=4)
+    counter = {"value": 0}
+
+    def worker():
+        for _ in range(1000):
+            with locks("alice"):
+                value = counter["value"]
+                counter["value"] = value + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter["value"] == 8000
+
+
+def test_acquire_many_does_not_deadlock():
+    locks = StripedLock(stripes=16)
+    keys = [f"user{index}" for index in range(6)]
+    done = []
+
+    def worker(order):
+        for _ in range(200):
+            with locks.acquire_many(order):
+                pass
+        done.append(1)
+
+    # 两组线程以相反顺序传入相同的key
+    threads = [threading.Thread(target=worker, args=(keys,)) for _ in range(3)]
+    threads += [threading.Thread(target=worker, args=(list(reversed(keys)),)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert len(done) == 6
+
+
+def test_acquire_many_holds_all_stripes():
+    locks = StripedLock(stripes=16)
+    acquired = []
+    with locks.acquire_many(["alice", "bob", "alice"]):
+        thread = threading.Thread(target=lambda: acquired.append(locks("bob").acquire(timeout=0.05)))
+        thread.start()
+        thread.join()
+    assert acquired == [False]
+    # 退出后全部释放
+    thread = threading.Thread(target=lambda: acquired.append(locks("bob").acquire(timeout=0.05) and locks("bob").release() is None))
+    thread.start()
+    thread.join()
+    assert acquired == [False, True]
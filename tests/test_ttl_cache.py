@@ -0,0 +1,66 @@
+"""TTLCache：LRU淘汰、过期清理和持久化导出导入"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ttl_cache import TTLCache  # noqa: E402
+
+
+def test_get_set_pop():
+    cache = TTLCache(max_entries=4, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b", "默认") == "默认"
+    assert cache.pop("a") == 1
+    assert cache.pop("a", None) is None
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # a 变为最近使用
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_entries_expire():
+    cache = TTLCache(max_entries=4, ttl=0.05)
+    cache.set("short", 1)
+    cache.set("long", 2, ttl=60)
+    time.sleep(0.1)
+    assert cache.get("short") is None
+    assert cache.items() == [("long", 2)]
+    assert len(cache) == 1
+
+
+def test_find_skips_and_removes_expired_entries():
+    cache = TTLCache(max_entries=4, ttl=60)
+    cache.set("old", {"prompt": "猫"}, ttl=0.01)
+    cache.set("new", {"prompt": "猫"})
+    cache.set("other", {"prompt": "狗"})
+    time.sleep(0.05)
+    assert cache.find(lambda key, value: value["prompt"] == "猫") == ("new", {"prompt": "猫"})
+    assert cache.find(lambda key, value: value["prompt"] == "鸟") is None
+    assert len(cache) == 2
+    # 命中的条目被标记为最近使用
+    assert [key for key, _ in cache.items()] == ["other", "new"]
+
+
+def test_dump_and_load():
+    cache = TTLCache(max_entries=4, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    entries = cache.dump() + [("expired", 3, time.time() - 1)]
+
+    restored = TTLCache(max_entries=1, ttl=60)
+    assert restored.load(entries) == 2
+    # 导入后同样受 max_entries 限制
+    assert restored.items() == [("b", 2)]
+    restored.clear()
+    assert len(restored) == 0
@@ -0,0 +1,274 @@
+"""插件CPU密集路径的微基准测试，支持保存基线和回归阈值
+
+覆盖：图片压缩（多种尺寸）、图片完整性校验、带历史的生成/编辑请求构建、大响应解析、
+日志脱敏，以及普通聊天消息经过 on_handle_context 的命令匹配路径。上游请求被替换为固定的
+本地响应，不发起网络请求。
+
+用法：
+    python tools/benchmark.py --dow-root ../dify-on-wechat                         # 运行并与基线比较
+    python tools/benchmark.py --dow-root ../dify-on-wechat --save-baseline         # 运行并保存为基线
+    python tools/benchmark.py --dow-root ../dify-on-wechat --filter compress --threshold 0.15
+
+与基线相比最小耗时变慢超过阈值（默认20%）时返回非0退出码，可用于CI。最小值受系统调度干扰最小，
+比中位数更适合做回归判断。基线与机器相关，应在同一台机器上生成和比较，因此默认基线文件不纳入版本库。
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+
+from load_test import build_plugin_config, load_plugin  # noqa: E402
+from mock_gemini_server import make_png  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(TOOLS_DIR, "benchmark_baseline.json")
+
+BENCHMARKS: List[Tuple[str, Callable]] = []
+
+
+def benchmark(name: str):
+    """注册基准测试：被装饰的函数接收 BenchContext，返回需要计时的无参函数"""
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+def make_photo(width: int, height: int, format: str = "JPEG") -> bytes:
+    """生成带渐变和噪声的测试图片，压缩特性接近照片"""
+    from PIL import Image
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    noise = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    image = Image.blend(gradient, noise, 0.3)
+    buffer = BytesIO()
+    image.save(buffer, format=format, quality=92)
+    return buffer.getvalue()
+
+
+def _fake_response(payload: Dict):
+    import requests
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(payload).encode("utf-8")
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+class BenchContext:
+    def __init__(self, plugin, work_dir: str):
+        self.plugin = plugin
+        self.work_dir = work_dir
+        self.images = {size: make_photo(size, size) for size in (512, 1024, 2048)}
+        # 大响应：4张约1MB的图片和对应文本
+        image_b64 = base64.b64encode(make_png(600, 600)).decode("utf-8")
+        parts = []
+        for index in range(4):
+            parts.append({"text": f"Image {index + 1}: " + "a detailed description " * 20})
+            parts.append({"inlineData": {"mimeType": "image/png", "data": image_b64}})
+        self.large_response = {"candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+                               "usageMetadata": {"promptTokenCount": 1200, "candidatesTokenCount": 5200}}
+        self.small_image_response = {"candidates": [{"content": {"role": "model", "parts": [
+            {"text": "done"}, {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(make_png(64, 64)).decode("utf-8")}}
+        ]}, "finishReason": "STOP"}]}
+
+        # 10轮会话历史，模型回复中带有已保存的图片
+        history_image = os.path.join(work_dir, "history.png")
+        with open(history_image, "wb") as f:
+            f.write(self.images[512])
+        self.history = []
+        for turn in range(5):
+            self.history.append({"role": "user", "parts": [{"text": f"第{turn + 1}轮修改：把天空换成晚霞"}]})
+            self.history.append({"role": "model", "parts": [{"text": "已完成修改"}, {"image_url": history_image}]})
+
+
+def _stub_upstream(plugin, payload: Dict) -> None:
+    """把上游请求替换为固定响应，只测量请求构建和响应处理"""
+    plugin._upstream_post = lambda op, url, **kwargs: _fake_response(payload)
+
+
+@benchmark("compress_image[512]")
+def bench_compress_512(ctx: BenchContext):
+    return lambda: ctx.plugin._compress_image(ctx.images[512], max_size=800, quality=85)
+
+
+@benchmark("compress_image[1024]")
+def bench_compress_1024(ctx: BenchContext):
+    return lambda: ctx.plugin._compress_image(ctx.images[1024], max_size=800, quality=85)
+
+
+@benchmark("compress_image[2048]")
+def bench_compress_2048(ctx: BenchContext):
+    return lambda: ctx.plugin._compress_image(ctx.images[2048], max_size=1200, quality=95)
+
+
+@benchmark("verify_image_integrity[1024]")
+def bench_verify(ctx: BenchContext):
+    return lambda: ctx.plugin._verify_image_integrity(ctx.images[1024], "基准测试")
+
+
+@benchmark("generate_request[history=10]")
+def bench_generate_request(ctx: BenchContext):
+    _stub_upstream(ctx.plugin, ctx.small_image_response)
+    return lambda: ctx.plugin._request_image_generation("a cat wearing sunglasses", ctx.history)
+
+
+@benchmark("edit_request[history=10]")
+def bench_edit_request(ctx: BenchContext):
+    _stub_upstream(ctx.plugin, ctx.small_image_response)
+    return lambda: ctx.plugin._request_image_edit("make the sky orange", ctx.images[1024], ctx.history)
+
+
+@benchmark("process_multi_image_response[4x1MB]")
+def bench_process_response(ctx: BenchContext):
+    return lambda: ctx.plugin._process_multi_image_response(ctx.large_response)
+
+
+@benchmark("safe_api_response_for_logging[4x1MB]")
+def bench_safe_logging(ctx: BenchContext):
+    return lambda: ctx.plugin._safe_api_response_for_logging(ctx.large_response)
+
+
+@benchmark("on_handle_context[non-command]")
+def bench_command_matching(ctx: BenchContext):
+    from bridge.context import Context, ContextType
+    from plugins import EventContext
+
+    class Msg:
+        from_user_id = "group0@chatroom"
+        actual_user_id = "wxid_bench"
+        is_group = True
+
+    def run():
+        context = Context(ContextType.TEXT, "今天中午吃什么好呢", {"session_id": "group0@chatroom", "isgroup": True, "msg": Msg()})
+        ctx.plugin.on_handle_context(EventContext(econtext={"context": context, "channel": None, "reply": None}))
+    return run
+
+
+def measure(fn: Callable, rounds: int, min_time: float) -> Dict[str, float]:
+    """先确定每轮循环次数（总耗时不少于 min_time），再测量 rounds 轮，返回单次调用耗时统计（秒）"""
+    fn()  # 预热
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops = loops * 10 if elapsed < min_time / 10 else max(loops + 1, int(loops * min_time / max(elapsed, 1e-9)))
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - started) / loops)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "loops": loops,
+        "rounds": rounds,
+    }
+
+
+def _format_time(seconds: float) -> str:
+    if seconds >= 1:
+        return f"{seconds:.3f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.3f}ms"
+    return f"{seconds * 1e6:.1f}us"
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> Tuple[List[str], List[str]]:
+    """返回 (报告行, 回归的基准名列表)"""
+    lines = [f"{'基准':<40}{'最小值':>12}{'基线':>12}{'变化':>9}"]
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            lines.append(f"{name:<40}{_format_time(result['min']):>12}{'-':>12}{'':>9}")
+            continue
+        change = result["min"] / base["min"] - 1 if base["min"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  回归"
+            regressions.append(name)
+        lines.append(f"{name:<40}{_format_time(result['min']):>12}{_format_time(base['min']):>12}{change * 100:>+8.1f}%{flag}")
+    return lines, regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="GeminiImage 微基准测试")
+    parser.add_argument("--dow-root", required=True, help="dify-on-wechat 项目目录")
+    parser.add_argument("--filter", default="", help="只运行名称包含该字符串的基准")
+    parser.add_argument("--rounds", type=int, default=7, help="每个基准测量的轮数")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮的最短耗时（秒）")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.2, help="最小耗时变慢超过该比例视为回归")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="覆盖插件配置项，值按JSON解析，可重复")
+    parser.add_argument("--list", action="store_true", help="只列出基准名称")
+    args = parser.parse_args(argv)
+
+    selected = [(name, fn) for name, fn in BENCHMARKS if args.filter in name]
+    if args.list:
+        print("\n".join(name for name, _ in selected))
+        return 0
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    work_dir = tempfile.mkdtemp(prefix="gemini_bench_")
+    os.makedirs(os.path.join(work_dir, "images"), exist_ok=True)
+    args.translate = False
+    # 上游地址指向不可用的端口：基准测试中的上游请求都已被替换为固定响应
+    plugin = load_plugin(args.dow_root, build_plugin_config("http://127.0.0.1:9", work_dir, args))
+    ctx = BenchContext(plugin, work_dir)
+
+    results = {}
+    for name, factory in selected:
+        results[name] = measure(factory(ctx), args.rounds, args.min_time)
+        print(f"{name:<40}{_format_time(results[name]['median']):>12}  (min {_format_time(results[name]['min'])}, {results[name]['loops']}次/轮)", flush=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "machine": platform.node(),
+                "python": platform.python_version(),
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": baseline,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n已保存基线: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\n没有找到基线文件 {args.baseline}，使用 --save-baseline 生成")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    lines, regressions = compare(results, baseline.get("results", {}), args.threshold)
+    print(f"\n与基线比较（{baseline.get('machine', '')} / Python {baseline.get('python', '')} / {baseline.get('created_at', '')}）")
+    print("\n".join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} 个基准超过回归阈值 {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""端到端压测：用模拟群聊流量驱动 GeminiImage.on_handle_context，统计延迟分位数和吞吐量
+
+插件在 dify-on-wechat 环境中运行，需要通过 --dow-root 指定 dify-on-wechat 的目录。
+默认在进程内启动 tools/mock_gemini_server.py 的模拟服务，也可以用 --mock-url 指向已启动的服务。
+
+用法：
+    python tools/load_test.py --dow-root ../dify-on-wechat --scenarios 200 --concurrency 16 \\
+        --mix generate=4,edit=2,chat=3,expand=1,analysis=1,merge=1 --image-latency lognormal:8,0.4 --errors 503:0.05
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+from mock_gemini_server import add_mock_arguments, make_png, options_from_args, start_in_thread  # noqa: E402
+
+# 场景 -> 期望的最终回复类型（图片或文本）
+SCENARIO_EXPECTS = {
+    "generate": "IMAGE", "edit": "IMAGE", "reference": "IMAGE", "merge": "IMAGE",
+    "chat": "TEXT", "expand": "TEXT", "analysis": "TEXT", "reverse": "TEXT",
+}
+DEFAULT_MIX = "generate=4,edit=2,reference=1,merge=1,chat=3,expand=1,analysis=1,reverse=1"
+PROMPTS = ["一只戴着墨镜的橘猫在海边冲浪", "赛博朋克风格的夜晚城市街道", "水彩风格的江南古镇", "宇航员在月球上种花",
+           "一杯冒着热气的咖啡，窗外下着雨", "像素风的勇者与巨龙", "极简主义的山水", "蒸汽朋克机械鸟"]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩法计算分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct * len(ordered) / 100))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def load_plugin(dow_root: str, plugin_config: Dict):
+    """在 dify-on-wechat 环境中以 plugins.GeminiImage 的包名加载本插件并实例化"""
+    dow_root = os.path.abspath(dow_root)
+    sys.path.insert(0, dow_root)
+    from config import write_plugin_config
+    write_plugin_config({"GeminiImage": plugin_config})
+
+    import plugins  # noqa: F401  dify-on-wechat 的插件框架
+    spec = importlib.util.spec_from_file_location(
+        "plugins.GeminiImage", os.path.join(PLUGIN_DIR, "__init__.py"), submodule_search_locations=[PLUGIN_DIR]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    plugin = module.GeminiImage()
+    if not plugin.enable:
+        raise RuntimeError("插件初始化失败，请检查日志")
+    return plugin
+
+
+def build_plugin_config(mock_url: str, work_dir: str, args: argparse.Namespace) -> Dict:
+    with open(os.path.join(PLUGIN_DIR, "config.json.template"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config.update({
+        "enable": True,
+        "gemini_api_key": "mock-key",
+        "use_proxy_service": True,
+        "proxy_service_url": mock_url,
+        "enable_proxy": False,
+        "translate_api_base": f"{mock_url}/v1",
+        "translate_api_key": "mock-key",
+        "enable_translate": args.translate,
+        "translate_cache_file": os.path.join(work_dir, "translate_cache.json"),
+        "enable_points": False,
+        "save_path": os.path.join(work_dir, "images"),
+        "session_store": "memory",
+        "state_backend": "memory",
+        "admins": [],
+    })
+    for override in args.set or []:
+        key, _, value = override.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+    return config
+
+
+class _Msg:
+    """模拟 dify-on-wechat 的消息对象，插件只读取其中的用户标识字段；私聊时 group_id 与 user_id 相同"""
+
+    def __init__(self, group_id: str, user_id: str, is_group: bool = True):
+        self.from_user_id = group_id
+        self.actual_user_id = user_id
+        self.actual_user_nickname = user_id
+        self.other_user_id = group_id
+        self.is_group = is_group
+
+
+class _Channel:
+    """收集插件通过通道发送的中间回复"""
+
+    def __init__(self):
+        self.replies = []
+
+    def send(self, reply, context):
+        content = getattr(reply, "content", None)
+        if hasattr(content, "read"):
+            content.read()
+            content.close()
+        self.replies.append(reply)
+
+
+class LoadGenerator:
+    def __init__(self, plugin, image_paths: List[str], users: int, groups: int):
+        from bridge.context import Context, ContextType
+        from plugins import EventContext
+        self.plugin = plugin
+        self.image_paths = image_paths
+        self.Context = Context
+        self.ContextType = ContextType
+        self.EventContext = EventContext
+        # 同一用户同一时间只执行一个场景，避免等待上传图片等状态相互覆盖
+        self.free_users = [(f"group{i % groups}@chatroom", f"wxid_user{i}") for i in range(users)]
+        self.free_lock = threading.Condition()
+
+    def _acquire_user(self) -> Tuple[str, str]:
+        with self.free_lock:
+            while not self.free_users:
+                self.free_lock.wait()
+            return self.free_users.pop(random.randrange(len(self.free_users)))
+
+    def _release_user(self, user: Tuple[str, str]) -> None:
+        with self.free_lock:
+            self.free_users.append(user)
+            self.free_lock.notify()
+
+    def _send(self, group_id: str, user_id: str, kind: str, content: str):
+        context = self.Context(getattr(self.ContextType, kind), content, {
+            "session_id": group_id,
+            "isgroup": True,
+            "msg": _Msg(group_id, user_id),
+            "from_user_id": group_id,
+            "receiver": group_id,
+        })
+        channel = _Channel()
+        e_context = self.EventContext(econtext={"context": context, "channel": channel, "reply": None})
+        self.plugin.on_handle_context(e_context)
+        replies = list(channel.replies)
+        if e_context["reply"] is not None:
+            # 最终回复由框架发送，这里按通道的方式读取并关闭文件
+            channel.send(e_context["reply"], context)
+            replies.append(e_context["reply"])
+        return replies
+
+    def _steps(self, scenario: str) -> List[Tuple[str, str]]:
+        prompt = random.choice(PROMPTS)
+        image = lambda: ("IMAGE", random.choice(self.image_paths))
+        plugin = self.plugin
+        if scenario == "generate":
+            return [("TEXT", f"{plugin.commands[0]} {prompt}")]
+        if scenario == "edit":
+            return [image(), ("TEXT", f"{plugin.edit_commands[0]} 把背景换成{random.choice(['雪山', '沙漠', '星空'])}")]
+        if scenario == "reference":
+            return [("TEXT", f"{plugin.reference_edit_commands[0]} {prompt}"), image()]
+        if scenario == "merge":
+            return [("TEXT", f"{plugin.merge_commands[0]} {prompt}"), image(), image()]
+        if scenario == "chat":
+            return [("TEXT", f"{plugin.chat_commands[0]} {prompt}用英语怎么说")]
+        if scenario == "expand":
+            return [("TEXT", f"{plugin.expand_commands[0]} {prompt}")]
+        if scenario == "analysis":
+            return [("TEXT", plugin.image_analysis_commands[0]), image()]
+        if scenario == "reverse":
+            return [("TEXT", plugin.image_reverse_commands[0]), image()]
+        raise ValueError(f"未知场景: {scenario}")
+
+    def run_scenario(self, scenario: str) -> Dict:
+        user = self._acquire_user()
+        started = time.perf_counter()
+        replies = []
+        error = None
+        try:
+            for kind, content in self._steps(scenario):
+                replies.extend(self._send(user[0], user[1], kind, content))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            self._release_user(user)
+        elapsed = time.perf_counter() - started
+        reply_types = [getattr(reply.type, "name", str(reply.type)) for reply in replies]
+        return {
+            "scenario": scenario,
+            "latency": elapsed,
+            "ok": error is None and SCENARIO_EXPECTS[scenario] in reply_types,
+            "error": error,
+        }
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    mix = []
+    for item in filter(None, spec.split(",")):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIO_EXPECTS:
+            raise ValueError(f"未知场景 {name}，可选: {', '.join(SCENARIO_EXPECTS)}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def summarize(results: List[Dict], wall_time: float) -> Dict:
+    """汇总为 {"overall": {...}, "scenarios": {场景: {...}}}，延迟单位为秒"""
+    def stats(items: List[Dict]) -> Dict:
+        latencies = [item["latency"] for item in items]
+        ok = sum(1 for item in items if item["ok"])
+        return {
+            "count": len(items),
+            "ok": ok,
+            "error_rate": round(1 - ok / len(items), 4) if items else 0.0,
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(max(latencies), 4) if latencies else 0.0,
+        }
+
+    by_scenario = defaultdict(list)
+    for item in results:
+        by_scenario[item["scenario"]].append(item)
+    overall = stats(results)
+    overall["wall_time"] = round(wall_time, 3)
+    overall["throughput"] = round(len(results) / wall_time, 3) if wall_time else 0.0
+    return {"overall": overall, "scenarios": {name: stats(items) for name, items in sorted(by_scenario.items())}}
+
+
+def format_report(summary: Dict) -> str:
+    overall = summary["overall"]
+    lines = [
+        f"场景数 {overall['count']}，成功 {overall['ok']}，耗时 {overall['wall_time']}s，吞吐量 {overall['throughput']} 场景/秒",
+        f"{'场景':<10}{'数量':>6}{'成功率':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+    ]
+    for name, item in list(summary["scenarios"].items()) + [("overall", overall)]:
+        lines.append(f"{name:<10}{item['count']:>6}{(1 - item['error_rate']) * 100:>8.1f}%"
+                     f"{item['p50']:>9.3f}{item['p95']:>9.3f}{item['p99']:>9.3f}{item['max']:>9.3f}")
+    return "\n".join(lines)
+
+
+def run_load_test(args: argparse.Namespace) -> Dict:
+    """按参数执行一轮压测并返回汇总结果（供 benchmark 等工具复用）"""
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.log_level:
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level=args.log_level)
+    work_dir = tempfile.mkdtemp(prefix="gemini_load_")
+    os.makedirs(os.path.join(work_dir, "images"), exist_ok=True)
+
+    server = None
+    mock_url = args.mock_url
+    if not mock_url:
+        server, mock_url = start_in_thread(options_from_args(args))
+
+    try:
+        image_paths = []
+        for index in range(4):
+            path = os.path.join(work_dir, f"upload_{index}.png")
+            with open(path, "wb") as f:
+                f.write(make_png(640, 480))
+            image_paths.append(path)
+
+        plugin = load_plugin(args.dow_root, build_plugin_config(mock_url, work_dir, args))
+        generator = LoadGenerator(plugin, image_paths, args.users, args.groups)
+        mix = parse_mix(args.mix)
+        names = [name for name, _ in mix]
+        weights = [weight for _, weight in mix]
+        scenarios = random.choices(names, weights=weights, k=args.scenarios)
+
+        results = []
+        interval = 1.0 / args.rate if args.rate else 0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="load") as pool:
+            futures = []
+            for index, scenario in enumerate(scenarios):
+                if interval:
+                    # 开环模式：按固定到达速率提交，不等待前面的场景完成
+                    delay = started + index * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(generator.run_scenario, scenario))
+            for future in futures:
+                results.append(future.result())
+        summary = summarize(results, time.perf_counter() - started)
+        if server is not None:
+            summary["upstream"] = server.RequestHandlerClass.state.snapshot()
+        errors = [item["error"] for item in results if item["error"]]
+        if errors:
+            summary["exceptions"] = errors[:10]
+        return summary
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="GeminiImage 端到端压测")
+    parser.add_argument("--dow-root", required=True, help="dify-on-wechat 项目目录")
+    parser.add_argument("--mock-url", default="", help="使用已启动的模拟服务，不指定时在进程内启动")
+    parser.add_argument("--scenarios", type=int, default=100, help="执行的场景总数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发执行的场景数")
+    parser.add_argument("--rate", type=float, default=0, help="开环模式下每秒发起的场景数，0表示闭环（完成一个再发起一个）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="场景权重，例如 generate=4,chat=3")
+    parser.add_argument("--users", type=int, default=40, help="模拟用户数")
+    parser.add_argument("--groups", type=int, default=5, help="模拟群聊数")
+    parser.add_argument("--translate", action="store_true", help="开启前置翻译（请求模拟的 chat/completions 接口）")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="覆盖插件配置项，值按JSON解析，可重复")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--log-level", default="WARNING", help="插件日志级别，压测时默认只输出警告和错误")
+    add_mock_arguments(parser)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    summary = run_load_test(args)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(format_report(summary))
+        if "upstream" in summary:
+            print(f"上游请求: {json.dumps(summary['upstream'], ensure_ascii=False)}")
+        for error in summary.get("exceptions", []):
+            print(f"异常: {error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
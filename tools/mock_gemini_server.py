@@ -0,0 +1,401 @@
+"""本地模拟的Gemini / 翻译接口，用于压测和基准测试，不消耗真实配额
+
+实现插件用到的接口：
+    POST /v1beta/models/{model}:generateContent         图像模型返回文本+图片，其他模型返回文本
+    POST /v1beta/models/{model}:streamGenerateContent   同上，分块返回（?alt=sse 时为SSE格式）
+    POST /v1beta/cachedContents                          上下文缓存
+    POST .../chat/completions                            OpenAI兼容接口（前置翻译）
+    GET  /stats                                          各接口请求数、错误数
+
+指定预设响应（MockOptions.responses）时，图像模型的请求依次返回预设的 parts 和 finishReason（例如只有文字、
+安全拦截），用完后恢复默认的文本+图片，供测试驱动插件的重试和拦截处理。
+
+指定回放脚本（ReplayScript）时，带有 X-Replay-Key 请求头的请求按脚本中录制的延迟和状态码响应，
+脚本中没有对应记录的请求仍按配置的延迟分布和错误率处理。
+
+用法：
+    python tools/mock_gemini_server.py --port 8765 --image-latency lognormal:8,0.4 --errors 503:0.05,429:0.02
+插件配置 use_proxy_service=true、proxy_service_url=http://127.0.0.1:8765 即可指向该服务。
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+
+class LatencyModel:
+    """延迟分布，格式：
+        fixed:秒数
+        uniform:最小值,最大值
+        normal:均值,标准差
+        lognormal:中位数,sigma   （长尾，接近真实的图像生成耗时）
+    """
+
+    def __init__(self, spec: str = "fixed:0"):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value] if params else []
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"不支持的延迟分布: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "uniform":
+            return random.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, random.gauss(self.params[0], self.params[1]))
+        median, sigma = self.params
+        return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+# 回放时由 tools/replay.py 注入的请求头：录制消息的编号和插件内部的请求类型（generate/translate等）
+REPLAY_HEADER = "X-Replay-Key"
+REPLAY_OP_HEADER = "X-Replay-Op"
+
+
+class ReplayScript:
+    """回放脚本：录制的上游请求按消息分组，模拟服务按请求头中的编号依次取出，复现当时的耗时和状态码"""
+
+    def __init__(self, speed: float = 1.0):
+        self.speed = speed
+        self.calls: Dict[str, List[Dict]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, key: str, calls: List[Dict]) -> None:
+        # 排队时就被取消的请求没有发出，不会到达模拟服务
+        self.calls[key] = [call for call in calls if call.get("latency") is not None]
+
+    def take(self, key: Optional[str], op: Optional[str], kind: str) -> Optional[Dict]:
+        """取出该消息下一个同类请求的记录：有请求类型时按类型匹配，否则按 image/text 匹配"""
+        if not key:
+            return None
+        with self.lock:
+            calls = self.calls.get(key) or []
+            for index, call in enumerate(calls):
+                if (call.get("op") == op) if op else (call.get("kind") == kind):
+                    return calls.pop(index)
+        return None
+
+
+def parse_error_rates(spec: str) -> List[Tuple[int, float]]:
+    """解析 "503:0.05,429:0.02" 形式的错误率"""
+    rates = []
+    for item in filter(None, (spec or "").split(",")):
+        status, _, rate = item.partition(":")
+        rates.append((int(status), float(rate)))
+    return rates
+
+
+def make_png(width: int, height: int, noise: bool = True) -> bytes:
+    """生成测试图片；随机噪声图片几乎不可压缩，体积接近真实生成的图片"""
+    if noise:
+        image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    else:
+        image = Image.new("RGB", (width, height), (120, 160, 200))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class MockOptions:
+    def __init__(self, image_latency: str = "fixed:0", text_latency: str = "fixed:0", errors: str = "",
+                 image_size: str = "1024x1024", image_variants: int = 4, noise: bool = True,
+                 image_models: str = "image", seed: Optional[int] = None, script: Optional[ReplayScript] = None,
+                 responses: Optional[List[Dict]] = None, record_bodies: bool = False):
+        self.image_latency = LatencyModel(image_latency)
+        self.text_latency = LatencyModel(text_latency)
+        self.error_rates = parse_error_rates(errors)
+        width, _, height = image_size.lower().partition("x")
+        # 预先生成若干张图片轮流返回，避免编码图片的开销计入模拟服务的延迟
+        self.images = [base64.b64encode(make_png(int(width), int(height or width), noise)).decode("utf-8")
+                       for _ in range(max(1, image_variants))]
+        self.image_model_markers = [marker for marker in image_models.split(",") if marker]
+        self.script = script
+        # 预设的图像模型响应：{"parts": [...], "finishReason": "..."}，按顺序各使用一次
+        self.responses = list(responses or [])
+        self.responses_lock = threading.Lock()
+        self.record_bodies = record_bodies  # 保存所有POST请求体（测试用，压测时不要开启）
+        if seed is not None:
+            random.seed(seed)
+
+    def is_image_model(self, model: str) -> bool:
+        return any(marker in model for marker in self.image_model_markers)
+
+    def next_response(self) -> Optional[Dict]:
+        with self.responses_lock:
+            return self.responses.pop(0) if self.responses else None
+
+
+class MockState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # 路由 -> 请求数
+        self.errors = defaultdict(int)    # 路由:状态码 -> 次数
+        self.scripted = 0                 # 按回放脚本响应的请求数
+        self.bodies: List[Tuple[str, Dict]] = []  # (路径, 请求体)，仅在 record_bodies 时记录
+
+    def record(self, route: str, status: int) -> None:
+        with self.lock:
+            self.requests[route] += 1
+            if status != 200:
+                self.errors[f"{route}:{status}"] += 1
+
+    def record_scripted(self) -> None:
+        with self.lock:
+            self.scripted += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {"requests": dict(self.requests), "errors": dict(self.errors), "scripted": self.scripted}
+
+
+def _last_user_text(body: Dict) -> str:
+    for content in reversed(body.get("contents") or []):
+        for part in content.get("parts") or []:
+            if part.get("text"):
+                return part["text"]
+    return ""
+
+
+def _has_inline_image(body: Dict) -> bool:
+    return any("inlineData" in part or "inline_data" in part
+               for content in body.get("contents") or [] for part in content.get("parts") or [])
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options: MockOptions = None
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, status: int, payload, content_type: str = "application/json") -> None:
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, route: str, status: int) -> None:
+        message = "Resource has been exhausted (e.g. check quota)." if status == 429 else "The model is overloaded. Please try again later."
+        self._send_json(status, {"error": {"code": status, "message": message, "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"}})
+        self.state.record(route, status)
+
+    def _maybe_fail(self, route: str) -> bool:
+        """按配置的错误率返回错误，返回True表示已发送错误响应"""
+        roll = random.random()
+        for status, rate in self.options.error_rates:
+            if roll < rate:
+                self._send_error(route, status)
+                return True
+            roll -= rate
+        return False
+
+    def _simulate(self, route: str, kind: str, latency: LatencyModel) -> bool:
+        """模拟上游耗时和错误，返回True表示已发送错误响应
+
+        有回放记录时按录制的耗时（除以回放倍速）和状态码响应；录制时超时或连接失败的请求
+        （状态不是数字）在同样的耗时后返回504。
+        """
+        script = self.options.script
+        call = script.take(self.headers.get(REPLAY_HEADER), self.headers.get(REPLAY_OP_HEADER), kind) if script else None
+        if call is None:
+            time.sleep(latency.sample())
+            return self._maybe_fail(route)
+        self.state.record_scripted()
+        time.sleep(call["latency"] / script.speed)
+        status = str(call.get("status", "200"))
+        code = int(status) if status.isdigit() else 504
+        if code != 200:
+            self._send_error(route, code)
+            return True
+        return False
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self._send_json(200, self.state.snapshot())
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        body = self._read_json()
+        if self.options.record_bodies:
+            with self.state.lock:
+                self.state.bodies.append((path, body))
+
+        if path.endswith("/chat/completions"):
+            self._handle_chat_completions(body)
+            return
+        if path.rstrip("/").endswith("/cachedContents"):
+            self._handle_cached_contents(body)
+            return
+        match = re.search(r"/models/([^:/]+):(generateContent|streamGenerateContent)$", path)
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": f"unknown endpoint {path}"}})
+            return
+        model, method = match.groups()
+        self._handle_generate(model, method, body, parse_qs(parsed.query).get("alt") == ["sse"])
+
+    def _handle_generate(self, model: str, method: str, body: Dict, sse: bool) -> None:
+        is_image = self.options.is_image_model(model)
+        route = f"{'image' if is_image else 'text'}:{method}"
+        if self._simulate(route, "image" if is_image else "text", self.options.image_latency if is_image else self.options.text_latency):
+            return
+
+        prompt = _last_user_text(body)
+        canned = self.options.next_response() if is_image else None
+        finish_reason = canned.get("finishReason", "STOP") if canned else "STOP"
+        if canned:
+            parts = canned.get("parts", [])
+        elif is_image:
+            parts = [
+                {"text": f"Here is the image for: {prompt[:60]}"},
+                {"inlineData": {"mimeType": "image/png", "data": random.choice(self.options.images)}},
+            ]
+        elif _has_inline_image(body):
+            parts = [{"text": f"图片分析结果（模拟）：画面主体清晰，色彩丰富。问题：{prompt[:60]}"}]
+        else:
+            parts = [{"text": f"模拟回答：{prompt[:80]}\n\n英文版: a detailed illustration of {prompt[:40]}"}]
+        usage = {"promptTokenCount": len(prompt) // 4 + 1, "candidatesTokenCount": 32}
+
+        if method == "generateContent":
+            self._send_json(200, {
+                "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": finish_reason, "index": 0}],
+                "usageMetadata": usage,
+                "modelVersion": model,
+            })
+        else:
+            # 每个part作为一个分块返回，最后一块带上结束原因
+            chunks = []
+            for index, part in enumerate(parts or [None]):
+                chunk = {"candidates": [{"content": {"role": "model", "parts": [part] if part else []}, "index": 0}], "modelVersion": model}
+                if index == max(len(parts), 1) - 1:
+                    chunk["candidates"][0]["finishReason"] = finish_reason
+                    chunk["usageMetadata"] = usage
+                chunks.append(chunk)
+            if sse:
+                payload = "".join(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n" for chunk in chunks).encode("utf-8")
+                self._send_json(200, payload, content_type="text/event-stream")
+            else:
+                self._send_json(200, chunks)
+        self.state.record(route, 200)
+
+    def _handle_cached_contents(self, body: Dict) -> None:
+        if self._simulate("cachedContents", "text", self.options.text_latency):
+            return
+        self._send_json(200, {
+            "name": f"cachedContents/{uuid.uuid4().hex[:12]}",
+            "model": body.get("model", ""),
+            "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 600)),
+        })
+        self.state.record("cachedContents", 200)
+
+    def _handle_chat_completions(self, body: Dict) -> None:
+        if self._simulate("chat/completions", "text", self.options.text_latency):
+            return
+        messages = body.get("messages") or [{}]
+        text = str(messages[-1].get("content", "")).split("\n")[-1]
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "model": body.get("model", ""),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": f"[en] {text}"}, "finish_reason": "stop"}],
+        })
+        self.state.record("chat/completions", 200)
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认的监听队列只有5，高并发压测时新连接会被拒绝
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # 客户端超时或取消后断开连接属于正常情况，不打印异常
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def build_server(options: MockOptions, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """创建模拟服务（port为0时随机分配），调用方负责 serve_forever"""
+    handler = type("BoundMockGeminiHandler", (MockGeminiHandler,), {"options": options, "state": MockState()})
+    return MockHTTPServer((host, port), handler)
+
+
+def start_in_thread(options: MockOptions, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """在后台线程中启动模拟服务，返回服务对象和基础地址"""
+    server = build_server(options, host, port)
+    threading.Thread(target=server.serve_forever, name="mock-gemini", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("模拟服务")
+    group.add_argument("--image-latency", default="lognormal:8,0.4", help="图像模型延迟分布，例如 fixed:2 / uniform:5,15 / lognormal:8,0.4")
+    group.add_argument("--text-latency", default="lognormal:1.5,0.5", help="文本模型和翻译接口的延迟分布")
+    group.add_argument("--errors", default="", help="错误率，例如 503:0.05,429:0.02")
+    group.add_argument("--image-size", default="1024x1024", help="返回图片的尺寸")
+    group.add_argument("--flat-images", action="store_true", help="返回纯色图片（体积小），默认返回随机噪声图片")
+    group.add_argument("--image-models", default="image", help="按模型名中包含的关键字识别图像模型，逗号分隔")
+    group.add_argument("--seed", type=int, default=None, help="随机种子，用于复现延迟和错误序列")
+
+
+def options_from_args(args: argparse.Namespace) -> MockOptions:
+    return MockOptions(
+        image_latency=args.image_latency,
+        text_latency=args.text_latency,
+        errors=args.errors,
+        image_size=args.image_size,
+        noise=not args.flat_images,
+        image_models=args.image_models,
+        seed=args.seed,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="本地模拟Gemini接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = build_server(options_from_args(args), args.host, args.port)
+    print(f"模拟Gemini服务已启动: http://{args.host}:{server.server_address[1]}  (GET /stats 查看统计)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
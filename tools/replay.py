@@ -0,0 +1,284 @@
+"""流量回放：按录制文件（插件配置 traffic_capture 开启后生成）重放真实流量，用于复现延迟问题和比较插件版本
+
+每条录制消息按原始时间间隔（除以 --speed）发送给插件，同一用户的消息按顺序处理。插件的上游请求指向
+进程内的模拟服务，模拟服务按录制的耗时（同样除以 --speed）和状态码响应；录制中没有的请求按
+--image-latency / --text-latency 的分布处理。图片内容不在录制中，按录制的尺寸和哈希生成测试图片。
+
+回放期间插件自身也开启流量录制，结束后按命令对比录制与回放的耗时分位数和成功率。
+加速回放只缩短消息间隔和上游耗时，插件自身的重试等待、发送间隔等不会缩短。
+
+用法：
+    python tools/replay.py --dow-root ../dify-on-wechat traffic.jsonl                 # 按原速回放
+    python tools/replay.py --dow-root ../dify-on-wechat traffic.jsonl --speed 10 --json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+
+from load_test import _Channel, _Msg, build_plugin_config, load_plugin, percentile  # noqa: E402
+from mock_gemini_server import (REPLAY_HEADER, REPLAY_OP_HEADER, ReplayScript, add_mock_arguments,  # noqa: E402
+                                make_png, options_from_args, start_in_thread)
+
+# 当前回放的消息编号，插件提交到线程池的任务会携带该上下文变量
+replay_key: ContextVar[Optional[str]] = ContextVar("replay_key", default=None)
+
+
+def load_capture(path: str, limit: Optional[int] = None) -> List[Dict]:
+    """读取录制文件，按时间排序，跳过无法解析的行"""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records[:limit] if limit else records
+
+
+def build_script(records: List[Dict], speed: float) -> ReplayScript:
+    script = ReplayScript(speed)
+    for index, record in enumerate(records):
+        script.add(str(index), record.get("upstream", []))
+    return script
+
+
+def install_replay_headers(plugin) -> None:
+    """在插件的上游请求中带上当前消息编号和请求类型，模拟服务据此查找录制的耗时和状态码"""
+    upstream_post = plugin._upstream_post
+
+    def _upstream_post(op: str, url: str, **kwargs):
+        key = replay_key.get()
+        if key is not None:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), REPLAY_HEADER: key, REPLAY_OP_HEADER: op}
+        return upstream_post(op, url, **kwargs)
+
+    plugin._upstream_post = _upstream_post
+
+
+def record_label(record: Dict) -> str:
+    if record.get("command"):
+        return record["command"]
+    return "image" if record.get("type") == "IMAGE" else "exit"
+
+
+class Replayer:
+    def __init__(self, plugin, records: List[Dict], speed: float, work_dir: str):
+        from bridge.context import Context, ContextType
+        from plugins import EventContext
+        self.plugin = plugin
+        self.records = records
+        self.speed = speed
+        self.work_dir = work_dir
+        self.Context = Context
+        self.ContextType = ContextType
+        self.EventContext = EventContext
+        self._images: Dict[str, str] = {}
+        self._images_lock = threading.Lock()
+        self.lags: List[float] = []
+        self.errors: List[str] = []
+
+    def _image_path(self, image: Dict) -> str:
+        """按录制的尺寸生成测试图片：录制中哈希相同的图片对应同一张测试图片，
+        不同的图片对应不同的测试图片，插件按图片内容命中缓存的行为与录制时一致"""
+        size = (int(image.get("width") or 640), int(image.get("height") or 480))
+        key = image.get("sha256") or f"{size[0]}x{size[1]}"
+        with self._images_lock:
+            path = self._images.get(key)
+            if path is None:
+                path = os.path.join(self.work_dir, f"replay_{key[:16]}.png")
+                with open(path, "wb") as f:
+                    f.write(make_png(*size))
+                self._images[key] = path
+        return path
+
+    def _play(self, index: int, record: Dict) -> None:
+        is_group = bool(record.get("group"))
+        user_id = f"wxid_{record.get('user') or 'unknown'}"
+        session_id = f"{record.get('session') or 'unknown'}@chatroom" if is_group else user_id
+        if record.get("type") == "IMAGE":
+            kind, content = "IMAGE", self._image_path(record.get("image") or {})
+        else:
+            kind, content = "TEXT", record.get("text", "")
+        context = self.Context(getattr(self.ContextType, kind), content, {
+            "session_id": session_id,
+            "isgroup": is_group,
+            "msg": _Msg(session_id, user_id, is_group),
+            "from_user_id": session_id,
+            "receiver": session_id,
+        })
+        channel = _Channel()
+        e_context = self.EventContext(econtext={"context": context, "channel": channel, "reply": None})
+        token = replay_key.set(str(index))
+        try:
+            self.plugin.on_handle_context(e_context)
+            if e_context["reply"] is not None:
+                channel.send(e_context["reply"], context)
+        finally:
+            replay_key.reset(token)
+
+    def run_stream(self, items: List[Tuple[int, Dict]], started: float, first_ts: float) -> None:
+        """按顺序回放同一用户的消息，每条消息不早于其（缩放后的）原始时间发送"""
+        for index, record in items:
+            due = started + (record.get("ts", first_ts) - first_ts) / self.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.lags.append(max(0.0, -delay))
+            try:
+                self._play(index, record)
+            except Exception as e:
+                self.errors.append(f"#{index} {record_label(record)}: {type(e).__name__}: {e}")
+
+    def run(self) -> float:
+        streams = defaultdict(list)
+        for index, record in enumerate(self.records):
+            streams[(record.get("session"), record.get("user"))].append((index, record))
+        first_ts = self.records[0].get("ts", 0) if self.records else 0
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, len(streams)), thread_name_prefix="replay") as pool:
+            for future in [pool.submit(self.run_stream, items, started, first_ts) for items in streams.values()]:
+                future.result()
+        return time.perf_counter() - started
+
+
+def summarize_capture(records: List[Dict]) -> Dict[str, Dict]:
+    """按命令汇总录制记录：数量、成功率、耗时分位数（秒）、上游请求数和上游错误数"""
+    groups = defaultdict(list)
+    for record in records:
+        groups[record_label(record)].append(record)
+        groups["overall"].append(record)
+    summary = {}
+    for label, items in sorted(groups.items()):
+        durations = [item.get("duration", 0.0) for item in items]
+        upstream = [call for item in items for call in item.get("upstream", [])]
+        statuses = defaultdict(int)
+        for item in items:
+            statuses[item.get("status", "unknown")] += 1
+        summary[label] = {
+            "count": len(items),
+            "ok_rate": round(statuses.get("ok", 0) / len(items), 4),
+            "statuses": dict(statuses),
+            "p50": round(percentile(durations, 50), 3),
+            "p95": round(percentile(durations, 95), 3),
+            "p99": round(percentile(durations, 99), 3),
+            "max": round(max(durations), 3),
+            "upstream": len(upstream),
+            "upstream_errors": sum(1 for call in upstream if str(call.get("status")) != "200"),
+        }
+    return summary
+
+
+def format_comparison(recorded: Dict[str, Dict], replayed: Dict[str, Dict]) -> str:
+    lines = [f"{'命令':<12}{'数量':>11}{'成功率':>15}{'p50':>15}{'p95':>15}{'p99':>15}{'上游错误':>11}",
+             f"{'':<12}{'录制/回放':>11}{'录制/回放':>15}{'录制/回放':>15}{'录制/回放':>15}{'录制/回放':>15}{'录制/回放':>11}"]
+    labels = sorted((set(recorded) | set(replayed)) - {"overall"}) + ["overall"]
+    empty = {"count": 0, "ok_rate": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "upstream_errors": 0}
+    for label in labels:
+        a, b = recorded.get(label, empty), replayed.get(label, empty)
+        lines.append(
+            f"{label:<12}{a['count']:>5}/{b['count']:<5}"
+            f"{a['ok_rate'] * 100:>7.1f}/{b['ok_rate'] * 100:<6.1f}"
+            f"{a['p50']:>7.2f}/{b['p50']:<7.2f}{a['p95']:>7.2f}/{b['p95']:<7.2f}{a['p99']:>7.2f}/{b['p99']:<7.2f}"
+            f"{a['upstream_errors']:>5}/{b['upstream_errors']:<5}"
+        )
+    return "\n".join(lines)
+
+
+def run_replay(args: argparse.Namespace) -> Dict:
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        raise SystemExit(f"录制文件中没有可回放的记录: {args.capture}")
+    if args.log_level:
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level=args.log_level)
+
+    work_dir = tempfile.mkdtemp(prefix="gemini_replay_")
+    os.makedirs(os.path.join(work_dir, "images"), exist_ok=True)
+    options = options_from_args(args)
+    options.script = build_script(records, args.speed)
+    server, mock_url = start_in_thread(options)
+    try:
+        # 录制时开启了前置翻译，回放时也需要开启，否则翻译请求的录制记录不会被用到
+        args.translate = args.translate or any(call.get("op") == "translate" for record in records for call in record.get("upstream", []))
+        config = build_plugin_config(mock_url, work_dir, args)
+        replay_path = os.path.join(work_dir, "replay.jsonl")
+        config.update({"traffic_capture": True, "traffic_capture_path": replay_path, "traffic_capture_salt": ""})
+        plugin = load_plugin(args.dow_root, config)
+        install_replay_headers(plugin)
+
+        replayer = Replayer(plugin, records, args.speed, work_dir)
+        wall_time = replayer.run()
+        plugin.traffic_capture.close()
+        if args.output:
+            shutil.copyfile(replay_path, args.output)
+
+        span = (records[-1].get("ts", 0) - records[0].get("ts", 0)) / args.speed
+        return {
+            "records": len(records),
+            "speed": args.speed,
+            "wall_time": round(wall_time, 3),
+            "scheduled_time": round(span, 3),
+            "lag_p95": round(percentile(replayer.lags, 95), 3),
+            "recorded": summarize_capture(records),
+            "replayed": summarize_capture(load_capture(replay_path)),
+            "upstream": server.RequestHandlerClass.state.snapshot(),
+            "exceptions": replayer.errors[:10],
+            "replay_capture": args.output or replay_path,
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="GeminiImage 流量回放")
+    parser.add_argument("capture", help="录制文件（traffic_capture_path）")
+    parser.add_argument("--dow-root", required=True, help="dify-on-wechat 项目目录")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，2表示消息间隔和上游耗时都缩短为一半")
+    parser.add_argument("--limit", type=int, default=0, help="只回放前N条记录")
+    parser.add_argument("--translate", action="store_true", help="开启前置翻译（录制中有翻译请求时自动开启）")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="覆盖插件配置项，值按JSON解析，可重复")
+    parser.add_argument("--output", default="", help="保存回放期间的录制文件，可作为下一次回放或比较的输入")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--log-level", default="WARNING", help="插件日志级别")
+    add_mock_arguments(parser)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.speed <= 0:
+        raise SystemExit("--speed 必须大于0")
+    result = run_replay(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return 0
+    print(f"回放 {result['records']} 条记录，倍速 {result['speed']}，计划耗时 {result['scheduled_time']}s，"
+          f"实际耗时 {result['wall_time']}s，发送延迟 p95 {result['lag_p95']}s")
+    print(format_comparison(result["recorded"], result["replayed"]))
+    print(f"上游请求: {json.dumps(result['upstream'], ensure_ascii=False)}")
+    for error in result["exceptions"]:
+        print(f"异常: {error}")
+    print(f"回放录制文件: {result['replay_capture']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
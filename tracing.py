@@ -0,0 +1,292 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+from loguru import logger
+
+# OTLP 状态码
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class _Trace:
+    """一次命令的所有span，根span结束时整体导出"""
+
+    __slots__ = ("trace_id", "sampled", "spans", "lock")
+
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self.lock = threading.Lock()
+
+
+class Span:
+    """一个计时阶段，属性和状态按OpenTelemetry的约定记录"""
+
+    __slots__ = ("name", "trace", "span_id", "parent", "sequence", "start_ns", "end_ns", "attributes", "events",
+                 "status", "status_message", "_child_counts")
+
+    def __init__(self, name: str, trace: _Trace, parent: Optional["Span"] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes or {})
+        self.events: List[Dict[str, Any]] = []
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self._child_counts = defaultdict(int)
+        # 同一父span下同名span的序号（从1开始），重试的每次尝试依次递增
+        self.sequence = 1
+        if parent is not None:
+            with trace.lock:
+                parent._child_counts[name] += 1
+                self.sequence = parent._child_counts[name]
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes) -> None:
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def set_status(self, ok: bool, message: str = "") -> None:
+        self.status = STATUS_OK if ok else STATUS_ERROR
+        self.status_message = message
+
+    def end(self) -> None:
+        self.end_ns = time.time_ns()
+        with self.trace.lock:
+            self.trace.spans.append(self)
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+class _NoopSpan:
+    """未采样时使用的空span，所有操作都不做任何事"""
+
+    sequence = 1
+    duration = 0.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def add_event(self, name: str, **attributes) -> None:
+        pass
+
+    def set_status(self, ok: bool, message: str = "") -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+# 当前线程所在的span，提交到线程池时需配合 contextvars.copy_context() 传递
+current_span: ContextVar[Optional[Span]] = ContextVar("gemini_current_span", default=None)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def to_otlp(spans: List[Span], service_name: str) -> Dict[str, Any]:
+    """将一条trace的span转换为OTLP/JSON（ExportTraceServiceRequest）"""
+    otlp_spans = []
+    for span in spans:
+        item = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": {"code": span.status, "message": span.status_message} if span.status_message else {"code": span.status},
+        }
+        if span.parent is not None:
+            item["parentSpanId"] = span.parent.span_id
+        if span.events:
+            item["events"] = [
+                {"name": event["name"], "timeUnixNano": str(event["time_ns"]), "attributes": _otlp_attributes(event["attributes"])}
+                for event in span.events
+            ]
+        otlp_spans.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": service_name})},
+            "scopeSpans": [{"scope": {"name": "gemini_image"}, "spans": otlp_spans}],
+        }]
+    }
+
+
+class FileSpanExporter:
+    """每条trace追加一行OTLP/JSON，可由 OpenTelemetry Collector 的 otlpjsonfile 接收器读取"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, payload: Dict[str, Any]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+
+class OTLPHttpSpanExporter:
+    """通过OTLP/HTTP（JSON编码）发送到收集器，例如 http://127.0.0.1:4318/v1/traces"""
+
+    def __init__(self, endpoint: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, payload: Dict[str, Any]) -> None:
+        response = requests.post(self.endpoint, json=payload, timeout=self.timeout)
+        if response.status_code >= 300:
+            raise RuntimeError(f"收集器返回状态码 {response.status_code}")
+
+
+class Tracer:
+    """轻量的命令级追踪
+
+    每条命令开启一个根span，各阶段通过 span() 开启子span。是否导出在根span结束时决定：
+    命中采样率、出错，或耗时超过 slow_threshold 的命令会被导出。sample_rate 与 slow_threshold
+    都为0时不记录任何span，span() 只返回空对象。导出在后台线程中进行，不阻塞消息处理。
+    """
+
+    def __init__(self, exporter: Any = None, sample_rate: float = 0.0, slow_threshold: float = 0.0, service_name: str = "GeminiImage"):
+        self.exporter = exporter
+        self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+        self.slow_threshold = float(slow_threshold or 0)
+        self.service_name = service_name
+        self.stats = defaultdict(int)  # exported / dropped / failed
+        self._queue: "queue.Queue[List[Span]]" = queue.Queue(maxsize=1000)
+        self._worker = None
+        if self.enabled:
+            self._worker = threading.Thread(target=self._export_loop, name="gemini-trace-export", daemon=True)
+            self._worker.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and (self.sample_rate > 0 or self.slow_threshold > 0)
+
+    @contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Any]:
+        """开启一条trace的根span，结束时按采样规则决定是否导出"""
+        if not self.enabled:
+            yield NOOP_SPAN
+            return
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold <= 0:
+            yield NOOP_SPAN
+            return
+        root = Span(name, _Trace(sampled), attributes=attributes)
+        token = current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.set_status(False, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            current_span.reset(token)
+            root.end()
+            if sampled or root.status == STATUS_ERROR or root.duration >= self.slow_threshold > 0:
+                self._enqueue(root.trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Any]:
+        """在当前span下开启子span，不在trace中时返回空对象"""
+        parent = current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        span = Span(name, parent.trace, parent, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_status(False, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def _enqueue(self, trace: _Trace) -> None:
+        # 根span结束后仍在运行的子任务（如被取消的变体生成）产生的span不再导出
+        with trace.lock:
+            spans = list(trace.spans)
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _export_loop(self) -> None:
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                break
+            try:
+                self.exporter.export(to_otlp(spans, self.service_name))
+                self.stats["exported"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.warning(f"导出追踪数据失败: {e}")
+
+    def close(self, timeout: float = 5) -> None:
+        """导出队列中剩余的trace后停止导出线程"""
+        if self._worker is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            # 导出端点不可用导致积压，丢弃剩余数据以保证线程能够退出
+            logger.warning("追踪队列已满，停止导出线程时丢弃剩余数据")
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self.stats["dropped"] += 1
+                except queue.Empty:
+                    break
+            self._queue.put_nowait(None)
+        self._worker.join(timeout)
+        self._worker = None
+
+    def flush(self, timeout: float = 5) -> None:
+        """等待队列中的trace导出完成（用于测试和退出前）"""
+        deadline = time.time() + timeout
+        while not self._queue.empty() and time.time() < deadline:
+            time.sleep(0.05)
+
+
+def create_tracer(config: Dict[str, Any], base_dir: str) -> Tracer:
+    """根据配置创建追踪器，未开启时返回不记录任何数据的追踪器"""
+    sample_rate = config.get("trace_sample_rate", 0)
+    slow_threshold = config.get("trace_slow_threshold", 0)
+    if not sample_rate and not slow_threshold:
+        return Tracer()
+    target = config.get("trace_export", "file")
+    if target == "otlp":
+        exporter = OTLPHttpSpanExporter(config.get("trace_otlp_endpoint", "http://127.0.0.1:4318/v1/traces"))
+    else:
+        exporter = FileSpanExporter(os.path.join(base_dir, config.get("trace_export_path", "traces.jsonl")))
+    logger.info(f"已开启请求追踪: 采样率={sample_rate}, 慢请求阈值={slow_threshold}秒, 导出={target}")
+    return Tracer(exporter, sample_rate, slow_threshold)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+
+class CaptureRecord:
+    """一条消息的录制数据，命令处理结束时写入文件"""
+
+    __slots__ = ("fields", "started_at", "upstream", "replies", "lock")
+
+    def __init__(self, fields: Dict[str, Any]):
+        self.fields = fields
+        self.started_at = time.time()
+        self.upstream: List[Dict[str, Any]] = []
+        self.replies: List[str] = []
+        self.lock = threading.Lock()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            record = {"ts": round(self.started_at, 3), **self.fields}
+            if self.upstream:
+                record["upstream"] = sorted(self.upstream, key=lambda call: call["offset"])
+            if self.replies:
+                record["replies"] = list(self.replies)
+        return {key: value for key, value in record.items() if value is not None}
+
+
+# 当前线程正在录制的消息，提交到线程池时需配合 contextvars.copy_context() 传递
+current_capture: ContextVar[Optional[CaptureRecord]] = ContextVar("gemini_current_capture", default=None)
+
+
+class TrafficRecorder:
+    """流量录制：每条相关消息写一行JSON，供 tools/replay.py 回放
+
+    只记录回放需要的信息：命令文本、图片的哈希/大小/尺寸、处理耗时和结果，以及每次上游请求的
+    操作、模型、状态码、排队时间和耗时。不记录图片内容、API密钥和模型返回的内容；用户和会话标识
+    加盐哈希后写入。未配置盐时每个进程随机生成一个，标识只在本次运行内保持一致；每条记录的 id_salt
+    为盐的指纹（不是盐本身），指纹相同的记录之间标识才可比较。path 为空时不做任何事。
+    """
+
+    def __init__(self, path: Optional[str] = None, salt: str = "", max_text: int = 1000):
+        self.path = path
+        # 不加盐的sha256可以通过枚举微信ID反推，未配置时使用随机盐
+        self.salt = salt or secrets.token_hex(16)
+        self.salt_id = hashlib.sha256(self.salt.encode("utf-8")).hexdigest()[:8]
+        self.max_text = max_text
+        self._lock = threading.Lock()
+        self._file = None
+        self.written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def anonymize(self, value: Optional[str]) -> Optional[str]:
+        if not value:
+            return None
+        return hashlib.sha256(f"{self.salt}{value}".encode("utf-8")).hexdigest()[:12]
+
+    @contextmanager
+    def record(self, session_id: Optional[str], user_id: Optional[str], is_group: bool, msg_type: str,
+               text: Optional[str] = None, command: Optional[str] = None) -> Iterator[Optional[CaptureRecord]]:
+        """录制一条消息的处理过程，处理结束（包括异常）时写入"""
+        if not self.enabled:
+            yield None
+            return
+        record = CaptureRecord({
+            "session": self.anonymize(session_id),
+            "user": self.anonymize(user_id),
+            "group": 1 if is_group else None,
+            "type": msg_type,
+            "text": text[:self.max_text] if text else None,
+            "command": command,
+            "id_salt": self.salt_id,
+        })
+        token = current_capture.set(record)
+        try:
+            yield record
+        finally:
+            current_capture.reset(token)
+            record.fields["duration"] = round(time.time() - record.started_at, 3)
+            self._write(record.to_dict())
+
+    def note_image(self, image_data: bytes, size: Optional[Tuple[int, int]] = None, format: Optional[str] = None) -> None:
+        """记录当前消息中图片的摘要（不记录内容）"""
+        record = current_capture.get()
+        if record is None:
+            return
+        image = {"sha256": hashlib.sha256(image_data).hexdigest(), "bytes": len(image_data)}
+        if size:
+            image["width"], image["height"] = size
+        if format:
+            image["format"] = format
+        record.fields["image"] = image
+
+    def note_upstream(self, op: str, kind: str, model: str, status: str,
+                      latency: Optional[float], queue_wait: Optional[float], started_at: float) -> None:
+        """记录一次上游请求；latency 为None表示请求未发出（排队时取消或超时）"""
+        record = current_capture.get()
+        if record is None:
+            return
+        call = {
+            "offset": round(started_at - record.started_at, 3),
+            "op": op,
+            "kind": kind,
+            "model": model,
+            "status": status,
+            "queue_wait": round(queue_wait, 3) if queue_wait is not None else None,
+            "latency": round(latency, 3) if latency is not None else None,
+        }
+        with record.lock:
+            record.upstream.append({key: value for key, value in call.items() if value is not None})
+
+    def note_reply(self, reply_type: Any) -> None:
+        record = current_capture.get()
+        if record is None:
+            return
+        with record.lock:
+            record.replies.append(getattr(reply_type, "name", str(reply_type)))
+
+    def note(self, **fields) -> None:
+        """补充当前消息的字段，例如处理结果"""
+        record = current_capture.get()
+        if record is not None:
+            record.fields.update(fields)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                self._file.write(line)
+                self.written += 1
+        except OSError as e:
+            logger.warning(f"写入流量录制文件失败: {e}")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def create_recorder(config: Dict[str, Any], base_dir: str) -> TrafficRecorder:
+    """根据配置创建流量录制器，未开启时返回不记录任何数据的录制器"""
+    if not config.get("traffic_capture", False):
+        return TrafficRecorder()
+    path = config.get("traffic_capture_path", "traffic.jsonl")
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    logger.info(f"已开启流量录制: {path}")
+    return TrafficRecorder(path, salt=config.get("traffic_capture_salt", ""))
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+
+class TTLCache:
+    """带过期时间的LRU缓存（线程安全）
+
+    - 超过 max_entries 时淘汰最久未使用的条目
+    - 条目写入后超过 ttl 秒视为过期，读取时惰性清理
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expire_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expire_at, value = entry
+            if expire_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expire_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry else default
+
+    def find(self, predicate: Callable[[Hashable, Any], bool]) -> Optional[Tuple[Hashable, Any]]:
+        """返回第一个满足 predicate(key, value) 的未过期条目，并将其标记为最近使用"""
+        now = time.time()
+        with self._lock:
+            for key, (expire_at, value) in list(self._data.items()):
+                if expire_at < now:
+                    del self._data[key]
+                    continue
+                if predicate(key, value):
+                    self._data.move_to_end(key)
+                    return key, value
+        return None
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """返回所有未过期条目的快照（按最近使用顺序，由旧到新）"""
+        now = time.time()
+        with self._lock:
+            return [(key, value) for key, (expire_at, value) in self._data.items() if expire_at >= now]
+
+    def dump(self) -> List[Tuple[Hashable, Any, float]]:
+        """导出所有未过期条目 (key, value, expire_at)，用于持久化"""
+        now = time.time()
+        with self._lock:
+            return [(key, value, expire_at) for key, (expire_at, value) in self._data.items() if expire_at >= now]
+
+    def load(self, entries: List[Tuple[Hashable, Any, float]]) -> int:
+        """导入 dump() 导出的条目，跳过已过期的条目，返回导入数量"""
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for key, value, expire_at in entries:
+                if expire_at < now:
+                    continue
+                self._data[key] = (expire_at, value)
+                self._data.move_to_end(key)
+                loaded += 1
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return loaded
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)